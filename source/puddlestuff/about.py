@@ -6,7 +6,7 @@ from PyQt4.QtGui import *
 import cPickle as pickle
 import mutagen, pyparsing, puddlestuff
 from puddlestuff.puddleobjects import OKCancel
-import puddlestuff.resource
+import puddlestuff.resources
 from puddlestuff.translations import translate
 
 desc  = translate("About", '''puddletag is an audio tag editor for GNU/Linux similar to the Windows program Mp3tag.
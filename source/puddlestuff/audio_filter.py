@@ -5,7 +5,8 @@ from pyparsing import *
 import puddlestuff.findfunc as findfunc
 import puddlestuff.audioinfo as audioinfo
 from puddlestuff.util import to_string
-from puddlestuff.puddleobjects import gettaglist, timemethod
+from puddlestuff.puddleobjects import gettaglist
+import threading
 import time
 import re
 
@@ -20,128 +21,192 @@ def str_cmp(a, b):
 
 FIELDS = set(z.lower() for z in gettaglist()).union(audioinfo.FILETAGS)
 
+#Maximum number of compiled expressions kept by compile_filter.
+CACHE_SIZE = 256
+
+_cache = {}
+
+class Value(object):
+    """An operand of a filter expression.
+
+    Calling it with an audio file returns the operand's value for that
+    file. literal is the value if it's the same for all files,
+    None otherwise."""
+    __slots__ = ('field', 'pattern', 'literal')
+
+    def __init__(self, text):
+        self.field = None
+        self.pattern = None
+        self.literal = None
+        if text[0] == u'%' and text[-1] == u'%':
+            self.field = text[1:-1]
+        elif text in FIELDS:
+            self.field = text
+        else:
+            if text[0] == u'"' and text[-1] == u'"':
+                text = text[1:-1]
+            self.pattern = findfunc.compile_format(text)
+            self.literal = self.pattern.literal
+
+    def __call__(self, audio):
+        if self.field is not None:
+            value = audio.get(self.field, u'')
+            #Shortcut for the usual [u'value'] so that to_string
+            #doesn't need to check if it's empty.
+            if isinstance(value, list) and value and \
+                isinstance(value[0], unicode) and value[0]:
+                return value[0]
+            return to_string(value)
+        elif self.literal is not None:
+            return self.literal
+        return self.pattern(audio)
+
 def parse_arg(audio, text):
     if not isinstance(text, basestring):
         return text
-    if text[0] == u'%' and text[-1] == u'%':
-        return to_string(audio.get(text[1:-1], u''))
-    elif text in FIELDS:
-        return to_string(audio.get(text, u''))
-    else:
-        if text[0] == u'"' and text[-1] == u'"':
-            text = text[1:-1]
-        return findfunc.parsefunc(text, audio)
-    return u""
-
-def wrap_nonzero(nonzero):
-    def __nonzero__(self):
-        if hasattr(self, 'args'):
-            self.args = [parse_arg(self.audio, z) for z in self.args]
-        else:
-            self.arg = parse_arg(self.audio, self.arg)
-        return nonzero(self)
-    return __nonzero__
+    return Value(text)(audio)
+
+def operand(arg):
+    if isinstance(arg, basestring):
+        return Value(arg)
+    return arg
+
+def contains_text(audio, text):
+    """Returns True if the lowercase string text is found
+    in any of audio's values."""
+    for value in audio.values():
+        if isinstance(value, basestring):
+            value = [value]
+        if text in u'\\\\'.join(value).lower():
+            return True
+    return False
 
 class BoolOperand(object):
+    """Base class for the operators in a filter expression.
+
+    Operators are created once when the expression is compiled.
+    Calling one with an audio file returns whether the file matches.
+    They aren't modified afterwards so can be used from
+    multiple threads."""
     def __init__(self,t):
-        self.args = t[0][0::2]
-    
+        self.args = map(operand, t[0][0::2])
+
 class BoolAnd(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('and: ' + unicode(self.args))
+    def __call__(self, audio):
         for a in self.args:
-            if not bool(a):
+            if not a(audio):
                 return False
         return True
 
 class BoolOr(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('or: ' + unicode(self.args))
+    def __call__(self, audio):
         for a in self.args:
-            if bool(a):
+            if a(audio):
                 return True
         return False
 
 class BoolNot(BoolOperand):
     def __init__(self,t):
-        self.arg = t[0][1]
+        self.arg = operand(t[0][1])
 
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('not: ' + unicode(self.arg))
-        if isinstance(self.arg, basestring):
-            arg = self.arg.lower()
-            for v in self.audio.values():
-                if isinstance(v, basestring):
-                    v = [v]
-                v = u'\\\\'.join(v).lower()
-                if arg in v:
-                    return False
-            return True
-        return not bool(self.arg)
+    def __call__(self, audio):
+        arg = self.arg(audio)
+        if isinstance(arg, basestring):
+            return not contains_text(audio, arg.lower())
+        return not arg
+
+def _numbers(args):
+    try:
+        return map(float, args)
+    except ValueError:
+        return args
 
 class Greater(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('greater: ' + unicode(self.args))
-        try: self.args = map(float, self.args)
-        except ValueError: pass
-        return self.args[0] > self.args[1]
+    def __call__(self, audio):
+        args = _numbers([a(audio) for a in self.args])
+        return args[0] > args[1]
 
 class Less(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('less: ' + unicode(self.args))
-        try: self.args = map(float, self.args)
-        except ValueError: pass
-        return self.args[0] < self.args[1]
+    def __call__(self, audio):
+        args = _numbers([a(audio) for a in self.args])
+        return args[0] < args[1]
 
 class Equal(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('equal: ' + unicode(self.args))
-        return str_cmp(self.args[0], self.args[1])
+    def __call__(self, audio):
+        return str_cmp(self.args[0](audio), self.args[1](audio))
 
 class Missing(BoolOperand):
     def __init__(self, t):
         self.arg = t[0][1]
 
-    def __nonzero__(self):
-        logging.debug('missing: ' + unicode(self.arg))
-        if getattr(self, "audio", None):
-            return not (self.arg in self.audio)
+    def __call__(self, audio):
+        if audio:
+            return not (self.arg in audio)
         return False
 
 class Present(BoolOperand):
     def __init__(self, t):
         self.arg = t[0][1]
 
-    def __nonzero__(self):
-        logging.debug('present: ' + unicode(self.arg))
-        if getattr(self, "audio", None):
-            return (self.arg in self.audio)
+    def __call__(self, audio):
+        if audio:
+            return (self.arg in audio)
         return False
 
-class BoolIs(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('is: ' + unicode(self.args))
-        return str_cmp(self.args[0], self.args[1])
+class BoolIs(Equal):
+    pass
 
 class Has(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('has: ' + unicode(self.args))
-        return self.args[1].lower() in self.args[0].lower()
+    def __init__(self, t):
+        BoolOperand.__init__(self, t)
+        literal = getattr(self.args[1], 'literal', None)
+        self.sub = literal.lower() if literal is not None else None
+
+    def __call__(self, audio):
+        text = self.args[0](audio)
+        sub = self.sub
+        if sub is None:
+            sub = self.args[1](audio).lower()
+        return sub in text.lower()
 
 class Matches(BoolOperand):
-    @wrap_nonzero
-    def __nonzero__(self):
-        logging.debug('matches: ' + unicode(self.args))
-        return not re.search(self.args[1].lower(), self.args[0].lower()) is None
-    
+    def __init__(self, t):
+        BoolOperand.__init__(self, t)
+        #Compile the regular expression now if it's the same for all files.
+        self.regex = None
+        literal = getattr(self.args[1], 'literal', None)
+        if literal is not None:
+            try:
+                self.regex = re.compile(literal.lower())
+            except re.error:
+                pass
+
+    def __call__(self, audio):
+        text = self.args[0](audio).lower()
+        if self.regex is not None:
+            return self.regex.search(text) is not None
+        return re.search(self.args[1](audio).lower(), text) is not None
+
+class TextSearch(object):
+    """Matches files containing text in any of their values. Used when
+    the expression is just a single word."""
+    def __init__(self, text):
+        self.text = text.lower()
+
+    def __call__(self, audio):
+        text = self.text
+        for field, value in audio.items():
+            if isinstance(value, basestring):
+                value = [value]
+            elif isinstance(value, (int, float)):
+                value = [unicode(value)]
+            try:
+                if text in u'\\\\'.join(value).lower():
+                    return True
+            except TypeError, e:
+                continue
+        return False
+
 bool_exprs = [
     (CaselessLiteral("missing"), 1, opAssoc.RIGHT, Missing),
     (CaselessLiteral("present"), 1, opAssoc.RIGHT, Present),
@@ -162,25 +227,36 @@ tokens = QuotedString('"', unquoteResults=False) \
 bool_expr = operatorPrecedence(tokens, bool_exprs)
 bool_expr.enablePackrat()
 
-def parse(audio, expr):
-    for i in bool_exprs:
-        i[3].audio = audio
-    res = bool_expr.parseString(expr)[0]
+_parse_lock = threading.Lock()
+
+def compile_filter(expr):
+    """Parses the filter expression, expr, and returns a function
+    that takes an audio file and returns True if it matches.
+
+    Compiled expressions are cached, so it's cheap to call this
+    repeatedly with the same expression. The returned function can
+    be called from multiple threads.
+
+    >>> matches = compile_filter(u'artist is "Carl Douglas"')
+    >>> [audio for audio in files if matches(audio)]"""
+    try:
+        return _cache[expr]
+    except KeyError:
+        pass
+
+    #pyparsing's packrat cache isn't thread-safe.
+    with _parse_lock:
+        res = bool_expr.parseString(expr)[0]
     if isinstance(res, basestring):
-        res = res.lower()
-        for field, value in audio.items():
-            if isinstance(value, basestring):
-                value = [value]
-            elif isinstance(value, (int, float)):
-                value = [unicode(value)]
-            try:
-                if res in u'\\\\'.join(value).lower():
-                    return True
-            except TypeError, e:
-                continue
-    else:
-        return bool(res)
-    return False
+        res = TextSearch(res)
+
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[expr] = res
+    return res
+
+def parse(audio, expr):
+    return bool(compile_filter(expr)(audio))
 
 if __name__ == '__main__':
     audio = audioinfo.Tag('clen.mp3')
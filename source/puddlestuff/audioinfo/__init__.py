@@ -4,6 +4,17 @@ import mutagen
 from util import *
 from constants import *
 
+try:
+    from puddlestuff.profiling import timer
+except ImportError:
+    class timer(object):
+        def __init__(self, name):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc_info):
+            pass
+
 AbstractTag = MockTag
 
 extensions = {}
@@ -57,8 +68,7 @@ def setmapping(m):
         except IndexError:
             pass
 
-def Tag(filename):
-    """Class that operates on audio tags.
+TAG_DOC = """Class that operates on audio tags.
     Currently supports ogg, mp3, mp4, apev2 and flac files
 
     It can be used in two ways.
@@ -83,23 +93,69 @@ def Tag(filename):
     There are caveats associated with each module, so check out their docstrings
     for more info."""
 
-    fileobj = file(filename, "rb")
-    ext = splitext(filename)
-    try:
-        return extensions[ext][1](filename)
-    except KeyError:
-        pass
+def _magic(header):
+    """Returns the part of a file's header that determines its type.
 
-    try:
-        header = fileobj.read(128)
-        results = [Kind[0].score(filename, fileobj, header) for Kind in options]
-    finally:
-        fileobj.close()
-    results = zip(results, options)
-    results.sort()
-    score, Kind = results[-1]
-    if score > 0: return Kind[1](filename)
-    else: return None
+    Used as a key for caching header sniffing results."""
+    if header.startswith('ID3'):
+        return header[:3]
+    elif header.startswith('OggS'):
+        #The codec is identified in the first packet.
+        return header[:4] + header[28:37]
+    return header[:12]
+
+def tag_loader(extensions, options):
+    """Creates a function that loads files using the
+    [mutagen class, Tag class, name] entries in options and
+    extensions (a dictionary of file extension => entry).
+
+    Files with a known extension are loaded without being opened first.
+    Otherwise the first 128 bytes of the file are scored by each option.
+    The results are cached by extension and magic bytes so that
+    files of the same kind aren't scored again.
+
+    The returned function has an extra attribute:
+        kind(filename) -> Returns the entry used to load filename or None."""
+
+    sniffed = {}
+
+    def kind(filename):
+        ext = splitext(filename)
+        try:
+            return extensions[ext]
+        except KeyError:
+            pass
+
+        fileobj = open(filename, "rb")
+        try:
+            header = fileobj.read(128)
+            key = (ext, _magic(header))
+            if key in sniffed:
+                index = sniffed[key]
+            else:
+                results = [(Kind[0].score(filename, fileobj, header), i)
+                    for i, Kind in enumerate(options)]
+                score, index = max(results)
+                if score <= 0:
+                    index = None
+                sniffed[key] = index
+        finally:
+            fileobj.close()
+
+        if index is not None:
+            return options[index]
+
+    def Tag(filename):
+        with timer('audioinfo.Tag'):
+            Kind = kind(filename)
+            if Kind is not None:
+                return Kind[1](filename)
+
+    Tag.__doc__ = TAG_DOC
+    Tag.kind = kind
+    return Tag
+
+Tag = tag_loader(extensions, options)
 
 import id3, vorbis, apev2, mp4
 tag_modules = (id3, vorbis, apev2, mp4)
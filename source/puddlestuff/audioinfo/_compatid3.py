@@ -29,6 +29,8 @@ try:
 except ImportError:
     from mutagen.id3._util import BitPaddedInt
 
+import util
+
 SEPARATOR = ' / '
 
 class XDOR(TextFrame):
@@ -107,8 +109,15 @@ class CompatID3(ID3):
             insize = BitPaddedInt(insize)
             if id3 != 'ID3': insize = -10
 
-            if insize >= framesize: outsize = insize
-            else: outsize = (framesize + 1023) & ~0x3FF
+            def default():
+                if insize >= framesize: return insize - framesize
+                return ((framesize + 1023) & ~0x3FF) - framesize
+
+            f.seek(0, 2)
+            trailing = f.tell() - max(insize + 10, 0)
+            outsize = framesize + util.new_padding(insize - framesize,
+                trailing, default)
+            util.count_save('in_place' if outsize == insize else 'rewritten')
             framedata += '\x00' * (outsize - framesize)
 
             framesize = BitPaddedInt.to_str(outsize, width=4)
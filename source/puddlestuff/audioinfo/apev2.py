@@ -2,7 +2,8 @@
 
 from copy import deepcopy
 
-from mutagen.apev2 import APEv2File, APEValue, BINARY, APENoHeaderError
+from mutagen.apev2 import (APEv2, APEv2File, APEValue, BINARY,
+    APENoHeaderError)
 from mutagen.monkeysaudio import MonkeysAudio, MonkeysAudioHeaderError
 from mutagen.musepack import Musepack, MusepackHeaderError
 from mutagen.wavpack import WavPack, WavPackHeaderError
@@ -10,8 +11,8 @@ from mutagen.wavpack import WavPack, WavPackHeaderError
 import util
 from util import (CaselessDict, FILENAME, MockTag, PATH,
     cover_info, del_deco, fn_hash, get_mime, get_total,
-    getdeco, info_to_dict, isempty, keys_deco, parse_image, set_total,
-    setdeco, str_filesize, unicode_list, usertags)
+    getdeco, image_info, info_to_dict, isempty, keys_deco, lazy_images,
+    parse_image, set_total, setdeco, str_filesize, unicode_list, usertags)
 
 ATTRIBUTES = ['length', 'accessed', 'size', 'created',
     'modified', 'filetype']
@@ -45,12 +46,22 @@ def pic_to_bin(pic):
         return {key: APEValue(''.join((desc, '\x00', data)), BINARY)}
     return {}
 
+def images_from(tag):
+    """Returns the images stored in the APEv2 tag."""
+    images = []
+    for key in tag:
+        if key.lower() in COVER_KEYS:
+            images.append(bin_to_pic(tag[key].value,
+                COVER_KEYS[key.lower()]))
+    return images
+
 def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
     class APEv2Base(MockTag):
         """Tag class for APEv2 files.
 
         Tags are used as in ogg.py"""
         IMAGETAGS = (util.MIMETYPE, util.DESCRIPTION, util.DATA, util.IMAGETYPE)
+        _image_keys = tuple(COVER_KEYS)
         mapping = {}
         revmapping = {}
         apev2 = True
@@ -82,6 +93,19 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
 
         images = property(_get_images, _set_images)
 
+        def _read_images(self):
+            try:
+                return images_from(APEv2(self.filepath))
+            except APENoHeaderError:
+                return []
+
+        @staticmethod
+        def _split_images(audio):
+            images = map(image_info, images_from(audio))
+            for key in [k for k in audio if k.lower() in COVER_KEYS]:
+                del(audio[key])
+            return images
+
         def __contains__(self, key):
             if key == '__image':
                 return bool(self.images)
@@ -181,10 +205,11 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
                 else header_error
 
             self.__images = []
+            images = []
             try:
-                tags, audio = self.load(filename, mutagen_file)
+                tags, audio, images = self.load_split(filename, mutagen_file)
             except no_header: #Try loading just APEv2
-                tags, audio = self.load(filename, APEv2File)
+                tags, audio, images = self.load_split(filename, APEv2File)
             except APENoHeaderError:
                 audio = mutagen_file()
                 tags, audio = self.load(filename, None)
@@ -193,19 +218,15 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
             if audio is None:
                 return
 
-            images = []
             for key in audio:
                 try:
-                    if key.lower() in COVER_KEYS:
-                        img_type = COVER_KEYS.get(key.lower(), 3)
-                        images.append(
-                            bin_to_pic(audio[key].value, img_type))
-                    else:
+                    if key.lower() not in COVER_KEYS:
                         self.__tags[key.lower()] = audio.tags[key][:]
                 except TypeError:
                     pass
 
-            self.images = images
+            self.__images = lazy_images(images, self._read_images)
+            cover_info(self.__images, self.__tags)
             self.__tags.update(info_to_dict(audio.info))
             self.__tags.update(tags)
             self.__tags['__tag_read'] = u'APEv2'
@@ -214,6 +235,7 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
             self.__tags['__filetype'] = filetype
             self.update_tag_list()
             self.mut_obj = audio
+            self._store_state()
             return self
 
         def save(self):
@@ -222,10 +244,9 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
             if self.filepath != self.mut_obj.filename:
                 self.mut_obj.filename = self.filepath
             audio = self.mut_obj
+            state, self._state = self._state, None
 
             newtag = {}
-            if self.images:
-                [newtag.update(pic_to_bin(z)) for z in self.images]
             for field, value in usertags(self.__tags).items():
                 try:
                     if isinstance(field, unicode):
@@ -238,7 +259,27 @@ def get_class(mutagen_file, filetype, attrib_fields, header_error=None):
             for z in toremove:
                 del(audio[z])
             audio.tags.update(newtag)
-            audio.save()
+            if self._unchanged(state):
+                return
+
+            def add_images():
+                covers = {}
+                [covers.update(pic_to_bin(z)) for z in self.images]
+                audio.tags.update(covers)
+                return images_from(audio)
+
+            def remove_images():
+                for key in [k for k in audio if k.lower() in COVER_KEYS]:
+                    del(audio[key])
+
+            with util.TemporaryImages(add_images, remove_images,
+                self._read_images) as saved:
+                #APEv2 tags are at the end of the file, so they're
+                #always written in place.
+                audio.save()
+            util.count_save('in_place')
+            self.__images = saved.images
+            self._store_state()
 
         def set_fundamentals(self, tags, mut_obj, images=None):
             self.__tags = tags
@@ -24,8 +24,8 @@ from _compatid3 import CompatID3
 from constants import MODES
 from util import (CaselessDict, FILENAME, MockTag, PATH,
     cover_info, del_deco, fn_hash, get_mime, get_total,
-    getdeco, info_to_dict, isempty, keys_deco, parse_image, set_total,
-    setdeco, str_filesize, unicode_list, usertags)
+    getdeco, image_info, info_to_dict, isempty, keys_deco, lazy_images,
+    parse_image, set_total, setdeco, str_filesize, unicode_list, usertags)
 
 TagBase = MockTag
 
@@ -723,6 +723,10 @@ def tag_factory(id3_filetype):
     class Tag(TagBase):
         IMAGETAGS = (util.MIMETYPE, util.DESCRIPTION, util.DATA,
             util.IMAGETYPE)
+        _image_keys = ('apic',)
+        #(major, minor) version of the ID3v2 tag in the file, as read or
+        #last written. None if the file has none.
+        _tag_version = None
         mapping = {}
         revmapping = {}
 
@@ -764,6 +768,22 @@ def tag_factory(id3_filetype):
 
         images = property(_get_images, _set_images)
 
+        def _read_images(self):
+            tags = id3_filetype(self.filepath).tags
+            if tags is None:
+                return []
+            return map(bin_to_pic, tags.getall("APIC"))
+
+        @staticmethod
+        def _split_images(audio):
+            if not audio.tags:
+                return []
+            audio.tags.update_to_v24()
+            images = [image_info(bin_to_pic(apic))
+                for apic in audio.tags.getall("APIC")]
+            audio.tags.delall("APIC")
+            return images
+
         def _info(self):
             info = self.mut_obj.info
             fileinfo = [('Path', self[PATH]),
@@ -938,7 +958,7 @@ def tag_factory(id3_filetype):
             """Links the audio, filename
             returns self if successful, None otherwise."""
             self.__images = []
-            tags, audio = self.load(filename, id3_filetype)
+            tags, audio, images = self.load_split(filename, id3_filetype)
             if audio is None:
                 return
 
@@ -946,12 +966,8 @@ def tag_factory(id3_filetype):
                 audio.tags.update_to_v24()
                 self.__tags.update(handle(audio))
 
-                #Get the image data.
-                apics = audio.tags.getall("APIC")
-                if apics:
-                    self.images = map(bin_to_pic, apics)
-                else:
-                    self.images = [];
+                self.__images = lazy_images(images, self._read_images)
+                cover_info(self.__images, self.__tags)
 
             self.__tags.update(tags)
             self.__tags.update(info_to_dict(audio.info))
@@ -969,7 +985,10 @@ def tag_factory(id3_filetype):
                 self.__tags['__tag_read'] = u''
             self.mut_obj = audio
             self._originaltags = audio.keys()
+            self._tag_version = audio.tags.version[:2] \
+                if audio.tags is not None else None
             self.update_tag_list()
+            self._store_state()
             return self
 
         def save(self, v1=None, v2=None):
@@ -984,6 +1003,7 @@ def tag_factory(id3_filetype):
                 self.mut_obj.filename = filename
             audio = self.mut_obj
             util.MockTag.save(self)
+            state, self._state = self._state, None
 
             userkeys = usertags(self.__tags).keys()
             frames = []
@@ -994,21 +1014,7 @@ def tag_factory(id3_filetype):
             toremove = [z for z in self._originaltags if z in audio
                         and not (z in hashes or z.startswith('APIC'))]
             audio.update(hashes)
-
-            old_apics = [z for z in audio if z.startswith(u'APIC')]
-            if self.__images:
-                newimages = []
-                for image in filter(None, map(pic_to_bin, self.__images)):
-                    i = 0
-                    while image.HashKey in newimages:
-                        i += 1
-                        #Pad with spaces so that each key is unique.
-                        image.desc += u' '*i
-                    audio[image.HashKey] = image
-                    newimages.append(image.HashKey)
-                [toremove.append(z) for z in old_apics if z not in newimages]
-            else:
-                toremove.extend(old_apics)
+            toremove.extend(z for z in audio if z.startswith(u'APIC'))
 
             for z in set(toremove):
                 try:
@@ -1020,16 +1026,47 @@ def tag_factory(id3_filetype):
             v1 = v1_option if v1 is None else v1
             v2 = v2_option if v2 is None else v2
 
+            if self._versions_match(v1, v2) and self._unchanged(state):
+                return
+
+            def add_images():
+                apics = []
+                for image in filter(None, map(pic_to_bin, self.__images)):
+                    i = 0
+                    while image.HashKey in audio:
+                        i += 1
+                        #Pad with spaces so that each key is unique.
+                        image.desc += u' '*i
+                    audio[image.HashKey] = image
+                    apics.append(image)
+                return map(bin_to_pic, apics)
+
+            with util.TemporaryImages(add_images,
+                lambda: audio.tags.delall("APIC"), self._read_images) as saved:
+                self._write_tags(audio, v1, v2)
+            #mutagen keeps the version read from file in audio.tags, and
+            #the v2.3 tag is written from a copy of it.
+            self._tag_version = (2, v2)
+            self.__images = saved.images
+            self._store_state()
+
+            self.__tags['__tag_read'] = u'ID3v2.4' if v2 == 4 else u'ID3v2.3'
+            self.update_tag_list()
+            self._originaltags = audio.keys()
+
+        def _write_tags(self, audio, v1, v2):
             if AIFF is not None and id3_filetype is AIFFFileType:
                 if v2 == 3:
-                    audio.tags.save(v2_version=3) #AIFF doesn't support id3v1
+                    #AIFF doesn't support id3v1
+                    util.padded_save(audio.tags.save, v2_version=3)
                 else:
-                    audio.tags.save() #AIFF doesn't support id3v1
-            if DSF is not None and id3_filetype is DSFFileType:
+                    util.padded_save(audio.tags.save) #AIFF doesn't support id3v1
+            elif DSF is not None and id3_filetype is DSFFileType:
                 if v2 == 3:
-                    audio.tags.save(v2_version=3) #DSF doesn't support id3v1
+                    #DSF doesn't support id3v1
+                    util.padded_save(audio.tags.save, v2_version=3)
                 else:
-                    audio.tags.save() #DSF doesn't support id3v1
+                    util.padded_save(audio.tags.save) #DSF doesn't support id3v1
             else:
                 if v2 == 4:
                     audio.tags.update_to_v24()
@@ -1041,9 +1078,24 @@ def tag_factory(id3_filetype):
                     c.update_to_v23()
                     c.save(v1=v1, v2=3)
 
-            self.__tags['__tag_read'] = u'ID3v2.4' if v2 == 4 else u'ID3v2.3'
-            self.update_tag_list()
-            self._originaltags = audio.keys()
+        def _versions_match(self, v1, v2):
+            """Returns True if saving with v1 and v2 wouldn't change
+            the versions of the tags in the file."""
+            if self._tag_version is not None and \
+                self._tag_version != (2, v2):
+                return False
+            if v1 == 1 or id3_filetype is not ID3FileType:
+                return True
+            try:
+                with open(self.filepath, 'rb') as fo:
+                    fo.seek(0, 2)
+                    if fo.tell() < 128:
+                        return v1 == 0
+                    fo.seek(-128, 2)
+                    has_v1 = fo.read(3) == 'TAG'
+            except EnvironmentError:
+                return False
+            return has_v1 == (v1 == 2)
 
         def set_fundamentals(self, tags, mut_obj, images=None):
             self.__tags = tags
@@ -13,7 +13,8 @@ from util import (usertags, strlength, strbitrate, READONLY, isempty,
     getfilename, strfrequency, getinfo, FILENAME, PATH,
     INFOTAGS, getdeco, setdeco, EXTENSION, DIRPATH,
     FILETAGS, str_filesize, DIRNAME, fn_hash, CaselessDict, keys_deco,
-    del_deco, cover_info, info_to_dict, parse_image, get_total)
+    del_deco, cover_info, info_to_dict, parse_image, get_total, lazy_images,
+    image_info)
 
 ATTRIBUTES = ('frequency', 'bitrate', 'length', 'accessed', 'size', 'created',
     'modified', 'bitspersample', 'channels')
@@ -181,6 +182,7 @@ class Tag(util.MockTag):
     mapping = {}
     revmapping = {}
     IMAGETAGS = (util.MIMETYPE, util.DATA)
+    _image_keys = ('covr',)
 
     def __init__(self, filename=None):
         self.__images = []
@@ -292,6 +294,20 @@ class Tag(util.MockTag):
 
     images = property(_get_images, _set_images)
 
+    def _read_images(self):
+        audio = MP4(self.filepath)
+        if audio.tags is None or 'covr' not in audio:
+            return []
+        return map(bin_to_pic, audio['covr'])
+
+    @staticmethod
+    def _split_images(audio):
+        if audio.tags is None or 'covr' not in audio:
+            return []
+        images = [image_info(bin_to_pic(cover)) for cover in audio['covr']]
+        del(audio['covr'])
+        return images
+
     def _info(self):
         info = self.mut_obj.info
         fileinfo = [('Path', self[PATH]),
@@ -313,7 +329,7 @@ class Tag(util.MockTag):
         """Links the audio, filename
         returns self if successful, None otherwise."""
 
-        tags, audio = self.load(filename, MP4)
+        tags, audio, images = self.load_split(filename, MP4)
         self.images = []
 
         if audio is None:
@@ -327,10 +343,10 @@ class Tag(util.MockTag):
 
         if audio.tags: #Not empty
             keys = audio.keys()
-            try:
-                self.images = map(bin_to_pic, audio['covr'])
-                keys.remove('covr')
-            except KeyError:
+            if images:
+                self.__images = lazy_images(images, self._read_images)
+                cover_info(self.__images, self.__tags)
+            else:
                 self.images = []
 
             convert = lambda k, v: FUNCS[k][1](v)
@@ -386,6 +402,7 @@ class Tag(util.MockTag):
         self.set_attrs(ATTRIBUTES, self.__tags)
         self.update_tag_list()
         self.mut_obj = audio
+        self._store_state()
 
     @keys_deco
     def keys(self):
@@ -397,6 +414,7 @@ class Tag(util.MockTag):
         if self.filepath != self.mut_obj.filename:
             self.mut_obj.filename = self.filepath
         audio = self.mut_obj
+        state, self._state = self._state, None
 
         newtag = {}
         tuples = (('track', ['trkn', 'totaltracks']),
@@ -425,15 +443,29 @@ class Tag(util.MockTag):
             except KeyError:
                 newtag[self.__freeform[tag].encode('utf8')] = encode(self.__tags[tag])
 
-        if self.images:
-            newtag['covr'] = filter(None, map(pic_to_bin, self.images))
-
         toremove = [z for z in audio.keys() if
             z not in newtag and z not in self.__errors]
         for key in toremove:
             del(audio[key])
         audio.update(newtag)
-        audio.save()
+        if self._unchanged(state):
+            return
+
+        def add_images():
+            covers = filter(None, map(pic_to_bin, self.images))
+            if covers:
+                audio['covr'] = covers
+            return map(bin_to_pic, covers)
+
+        def remove_images():
+            if 'covr' in audio:
+                del(audio['covr'])
+
+        with util.TemporaryImages(add_images, remove_images,
+            self._read_images) as saved:
+            util.padded_save(audio.save)
+        self.__images = saved.images
+        self._store_state()
 
     def set_fundamentals(self, tags, images, mut_obj, freeform=None, errors=None):
         self.__freeform = {} if freeform is None else freeform
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Parses audio files using a pool of worker processes.
+
+Only the mutagen parsing is done in the workers. The parsed objects
+(without their images, see tagcache) are pickled, sent back and handed
+to tagcache.preload so that the following audioinfo.Tag(filename) call
+links them without opening the file again.
+
+The workers are forked from the calling process, so they have to be
+started by start_pool before the QApplication's created (or any other
+thread is started). If they weren't, files are parsed in the
+current process.
+
+>>>start_pool()
+>>>app = QApplication(sys.argv)
+>>>for filename in parse_files(filenames):
+...     tag = audioinfo.Tag(filename)"""
+
+import cPickle as pickle
+import logging
+import multiprocessing
+import os
+
+from collections import deque
+from itertools import islice
+
+import tagcache
+
+#Loads with less files than this are done in the current process.
+MIN_FILES = 32
+
+#Number of files sent to a worker at a time.
+CHUNKSIZE = 8
+
+_pool = None
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def start_pool(processes=None):
+    """Starts the pool of worker processes returned by get_pool.
+
+    Has to be called before any threads are started, as the workers are
+    forked from the current process. Does nothing on systems that can't
+    fork or if processes (defaults to the number of CPUs) is 1."""
+    global _pool
+    if _pool is not None or os.name != 'posix':
+        return
+    if processes is None or processes < 1:
+        processes = cpu_count()
+    if processes == 1:
+        return
+    try:
+        _pool = multiprocessing.Pool(processes)
+    except (EnvironmentError, ImportError):
+        logging.exception('Could not start the worker processes.')
+
+def get_pool():
+    """Returns the multiprocessing.Pool started by start_pool or None
+    if it wasn't started.
+
+    It's shared, so it mustn't be terminated by users."""
+    return _pool
+
+def _parse(filename):
+    """Worker function.
+
+    Returns (filename, filetype, pickled (mutagen object, image info))
+    as returned by tagcache.parse. The last two are None if the file
+    couldn't be parsed. The error will be raised (and reported) again
+    when the file's loaded normally.
+
+    Uses the same rules as audioinfo.Tag to find the file's type."""
+    import puddlestuff.audioinfo as audioinfo
+    try:
+        Kind = audioinfo._Tag.kind(filename)
+        if Kind is None:
+            return filename, None, None
+        filetype = Kind[0]
+        parsed = tagcache.parse(filename, filetype,
+            getattr(Kind[1], '_split_images', None))
+        return filename, filetype, pickle.dumps(parsed,
+            pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return filename, None, None
+
+def _parse_chunk(filenames):
+    """Worker function. Returns the result of _parse for each file."""
+    return map(_parse, filenames)
+
+def parse_files(filenames, processes=None, chunksize=CHUNKSIZE):
+    """Generator that parses filenames in the worker processes.
+
+    Yields each filename (in the order passed) as soon as it's
+    ready to be loaded with audioinfo.Tag.
+
+    processes is the maximum number of workers to keep busy. Defaults
+    to the number of CPUs. If it's 1, start_pool wasn't called or there
+    are only a few files to parse, filenames are yielded as is and
+    parsed when they're loaded.
+
+    Files that have an up to date entry in the tag cache aren't sent
+    to the workers. Closing the generator stops files from being sent,
+    but the ones already sent are still parsed."""
+    if processes is None or processes < 1:
+        processes = cpu_count()
+
+    pool = get_pool()
+    if pool is None or processes == 1 or len(filenames) < MIN_FILES:
+        for filename in filenames:
+            yield filename
+        return
+
+    to_parse = [f for f in filenames if not tagcache.is_cached(f)]
+    if len(to_parse) < MIN_FILES:
+        for filename in filenames:
+            yield filename
+        return
+
+    chunks = (to_parse[i: i + chunksize]
+        for i in xrange(0, len(to_parse), chunksize))
+    #Chunks sent to the workers, but not yet preloaded.
+    window = processes * 2
+    sent = deque()
+    unparsed = set(to_parse)
+    try:
+        for filename in filenames:
+            while filename in unparsed:
+                for chunk in islice(chunks, window - len(sent)):
+                    sent.append(pool.apply_async(_parse_chunk, (chunk,)))
+                for parsed, filetype, data in sent.popleft().get():
+                    unparsed.discard(parsed)
+                    if filetype is None:
+                        continue
+                    try:
+                        audio, images = pickle.loads(data)
+                        tagcache.preload(parsed, filetype, audio, images)
+                    except Exception:
+                        logging.exception('Invalid data from worker.')
+            yield filename
+    finally:
+        tagcache.clear_preloaded()
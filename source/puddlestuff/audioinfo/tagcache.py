@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of parsed audio files.
+
+Parsing a file with mutagen is the most expensive part of creating a Tag
+object. This module keeps the parsed mutagen objects in an SQLite database
+so that files which haven't changed since they were last read don't have to
+be parsed again.
+
+Embedded images aren't cached. Formats that load their images lazily pass
+a function that removes them from the parsed object (see load). Only the
+image metadata returned by it is stored with the object.
+
+A file is considered unchanged if its path, size, modification time,
+change time and inode are the same as when it was cached.
+
+Usage:
+
+>>>set_cache(TagCache('/path/to/tagcache.db'))
+>>>tag = audioinfo.Tag(filename) #Parsed and stored.
+>>>tag = audioinfo.Tag(filename) #Loaded from the cache.
+>>>get_cache().stats()
+{'hits': 1, 'misses': 1, 'stores': 1, 'invalidated': 0, 'errors': 0}
+
+If no cache is set (the default), load just calls the filetype."""
+
+import cPickle as pickle
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from os import path
+
+FS_ENC = sys.getfilesystemencoding()
+
+#Increase this whenever the pickled objects become incompatible.
+SCHEMA_VERSION = 2
+
+#Number of stores after which changes are committed to disk.
+COMMIT_INTERVAL = 200
+
+_cache = None
+
+#Objects parsed elsewhere (eg. by a worker process) waiting to be linked.
+_preloaded = {}
+
+def _encode(filename):
+    if isinstance(filename, unicode):
+        return filename.encode(FS_ENC)
+    return filename
+
+def file_key(filename, fileinfo=None):
+    """Returns the (size, mtime, ctime, inode) tuple used to check if
+    filename has changed since it was cached."""
+    if fileinfo is None:
+        fileinfo = os.stat(filename)
+    return (fileinfo.st_size, fileinfo.st_mtime, fileinfo.st_ctime,
+        fileinfo.st_ino)
+
+def filetype_name(filetype):
+    return u'%s.%s' % (filetype.__module__, filetype.__name__)
+
+class TagCache(object):
+    """SQLite backed cache of parsed mutagen objects.
+
+    filename is the path of the database. It'll be created
+    if it doesn't exist.
+
+    Methods of interest:
+        get -> Retrieve the cached object (and image info) for a file.
+        put -> Store a parsed object.
+        invalidate -> Remove files from the cache.
+        stats -> Dictionary of cache statistics.
+
+    All methods are safe to call from multiple threads."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = path.dirname(filename)
+        if dirname and not path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._stats = dict.fromkeys(
+            ['hits', 'misses', 'stores', 'invalidated', 'errors'], 0)
+
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._create_tables()
+
+    def _create_tables(self):
+        conn = self._conn
+        conn.execute('CREATE TABLE IF NOT EXISTS info '
+            '(key TEXT PRIMARY KEY, value TEXT)')
+        row = conn.execute("SELECT value FROM info WHERE key='version'")
+        row = row.fetchone()
+        if row is None or int(row[0]) != SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS files')
+            conn.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)",
+                (unicode(SCHEMA_VERSION),))
+        conn.execute('CREATE TABLE IF NOT EXISTS files '
+            '(path BLOB PRIMARY KEY, size INTEGER, mtime REAL, ctime REAL, '
+            'inode INTEGER, filetype TEXT, data BLOB)')
+        conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def contains(self, filename, key=None):
+        """Returns True if an up to date entry for filename is cached."""
+        filename = _encode(filename)
+        if key is None:
+            key = file_key(filename)
+        with self._lock:
+            if self._conn is None:
+                return False
+            row = self._conn.execute('SELECT size, mtime, ctime, inode '
+                'FROM files WHERE path=?',
+                (sqlite3.Binary(filename),)).fetchone()
+        return row is not None and tuple(row) == key
+
+    def flush(self):
+        """Commits pending changes to disk."""
+        with self._lock:
+            if self._conn is not None and self._pending:
+                self._conn.commit()
+                self._pending = 0
+
+    def get(self, filename, filetype, key=None):
+        """Returns (mutagen object, image info) as cached for filename
+        or None if it wasn't found or the file changed since it was cached.
+
+        filetype is the mutagen class used to parse the file.
+        key is the file_key of filename. It'll be retrieved if
+        not passed."""
+        filename = _encode(filename)
+        if key is None:
+            key = file_key(filename)
+        with self._lock:
+            if self._conn is None:
+                return
+            row = self._conn.execute('SELECT size, mtime, ctime, inode, '
+                'filetype, data FROM files WHERE path=?',
+                (sqlite3.Binary(filename),)).fetchone()
+
+            if row is None or tuple(row[:4]) != key or \
+                row[4] != filetype_name(filetype):
+                self._stats['misses'] += 1
+                return
+
+        try:
+            audio, images = pickle.loads(str(row[5]))
+        except Exception:
+            logging.exception(u'Invalid cache entry for %s',
+                filename.decode(FS_ENC, 'replace'))
+            self.invalidate(filename)
+            with self._lock:
+                self._stats['errors'] += 1
+            return
+        audio.filename = filename
+        with self._lock:
+            self._stats['hits'] += 1
+        return audio, images
+
+    def invalidate(self, filenames=None):
+        """Removes filenames from the cache.
+
+        filenames can be a single path or a list of them.
+        If None, the whole cache is cleared."""
+        with self._lock:
+            if self._conn is None:
+                return
+            if filenames is None:
+                count = self._conn.execute('DELETE FROM files').rowcount
+            else:
+                if isinstance(filenames, basestring):
+                    filenames = [filenames]
+                count = self._conn.executemany(
+                    'DELETE FROM files WHERE path=?',
+                    [(sqlite3.Binary(_encode(f)),) for f in filenames]
+                    ).rowcount
+            self._conn.commit()
+            self._pending = 0
+            self._stats['invalidated'] += max(count, 0)
+
+    def put(self, filename, filetype, audio, key=None, images=None):
+        """Stores the parsed mutagen object, audio, for filename.
+
+        images is the info of the images removed from audio (if any)."""
+        filename = _encode(filename)
+        try:
+            if key is None:
+                key = file_key(filename)
+            data = pickle.dumps((audio, images), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            #Some mutagen objects can't be pickled. They just won't be cached.
+            with self._lock:
+                self._stats['errors'] += 1
+            return False
+
+        with self._lock:
+            if self._conn is None:
+                return False
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)', (sqlite3.Binary(filename),)
+                + tuple(key) + (filetype_name(filetype),
+                sqlite3.Binary(data)))
+            self._stats['stores'] += 1
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+        return True
+
+    def stats(self):
+        """Returns a dictionary containing the number of cache hits,
+        misses, stores, invalidated entries and errors along with the
+        number of entries currently cached ('entries')."""
+        with self._lock:
+            ret = self._stats.copy()
+            if self._conn is not None:
+                ret['entries'] = self._conn.execute(
+                    'SELECT COUNT(*) FROM files').fetchone()[0]
+            else:
+                ret['entries'] = 0
+        return ret
+
+def get_cache():
+    return _cache
+
+def set_cache(cache):
+    """Sets the TagCache used when loading files.
+
+    Pass None to disable caching. The previous cache
+    (if any) is closed."""
+    global _cache
+    if _cache is not None and _cache is not cache:
+        _cache.close()
+    _cache = cache
+
+def invalidate(filenames=None):
+    """Removes filenames from the current cache if one is set."""
+    if _cache is not None:
+        _cache.invalidate(filenames)
+
+def is_cached(filename):
+    """Returns True if filename has an up to date entry in the current
+    cache."""
+    if _cache is None:
+        return False
+    try:
+        return _cache.contains(filename)
+    except EnvironmentError:
+        return False
+
+def clear_preloaded():
+    """Discards objects passed to preload that haven't been loaded."""
+    _preloaded.clear()
+
+def preload(filename, filetype, audio, images=None):
+    """Makes the next load of filename with filetype return audio (and
+    images) instead of parsing the file again.
+
+    Used to hand over objects that were parsed in another process.
+    images is the info returned by the split_images function passed
+    to load."""
+    _preloaded[_encode(filename)] = (filetype, audio, images)
+
+def parse(filename, filetype, split_images=None):
+    """Parses filename with filetype.
+
+    Returns (audio, images) where images is what split_images returned
+    for the parsed object or None if split_images is None."""
+    audio = filetype(filename)
+    if split_images is None:
+        return audio, None
+    return audio, split_images(audio)
+
+def load(filename, filetype, split_images=None):
+    """Returns (filetype(filename), image info) using the cached object if
+    the file hasn't changed since it was cached.
+
+    split_images is a function that removes the images from the parsed
+    object and returns their info (eg. as returned by util.image_info).
+    If it's None, the object's returned (and cached) as is and the
+    image info is None."""
+    preloaded = _preloaded.pop(_encode(filename), None)
+    if preloaded is not None:
+        if preloaded[0] is not filetype:
+            preloaded = None
+        elif preloaded[2] is None and split_images is not None:
+            preloaded = (filetype, preloaded[1], split_images(preloaded[1]))
+
+    if _cache is None:
+        if preloaded is not None:
+            return preloaded[1:]
+        return parse(filename, filetype, split_images)
+
+    try:
+        key = file_key(_encode(filename))
+    except EnvironmentError:
+        return parse(filename, filetype, split_images)
+
+    if preloaded is not None:
+        audio, images = preloaded[1:]
+        _cache.put(filename, filetype, audio, key, images)
+        return audio, images
+
+    cached = _cache.get(filename, filetype, key)
+    if cached is not None:
+        return cached
+    audio, images = parse(filename, filetype, split_images)
+    _cache.put(filename, filetype, audio, key, images)
+    return audio, images
@@ -1,15 +1,18 @@
 ## -*- coding: utf-8 -*-
 
-import base64, calendar, imghdr, json, logging, pdb, os, sys, time
+import base64, calendar, hashlib, imghdr, json, logging, pdb, os, sys, time
+import threading, weakref
 import mutagen
 import logging
 
+from collections import OrderedDict
 from errno import ENOENT
 from decimal import Decimal
 from copy import copy, deepcopy
 from os import path, stat
 
 from constants import *
+import tagcache
 
 try:
     import puddlestuff
@@ -77,7 +80,8 @@ def commontags(audios):
     images = []
     combined = {}
     tags = {}
-    images = []
+    #field: set of the values in combined[field]
+    seen = {}
     imagetags = set()
 
     for audio in audios:
@@ -100,9 +104,14 @@ def commontags(audios):
                     tags[field] += 1
                 else:
                     values = combined[field]
-                    [values.append(v) for v in value if v not in values]
+                    found = seen[field]
+                    for v in value:
+                        if v not in found:
+                            values.append(v)
+                            found.add(v)
             else:               
                 combined[field] = value
+                seen[field] = set(value)
                 tags[field] = 1
     combined['__image'] = commonimages(images)
     return combined, tags, imagetags
@@ -122,7 +131,11 @@ def cover_info(images, d=None):
 
     if d is supplied, it'll be updated with the returned
         dictionary.
+
+    The image data of LazyImages isn't loaded.
     """
+    if isinstance(images, LazyImages):
+        images = images.info
     info = {}
     if not images:
         info[NUM_IMAGES] = u'0'
@@ -258,6 +271,21 @@ def img_to_b64(img):
     ret['data'] = base64.b64encode(img['data'])
     return ret
         
+def image_info(image):
+    """Returns a copy of image without the image data.
+
+    The size of the data is stored in the 'size' key. The mimetype
+    is determined if it's not already in image. image can be
+    info returned by this function."""
+    info = dict((k, v) for k, v in image.iteritems() if k != DATA)
+    if DATA not in image and 'size' in image:
+        return info
+    data = image.get(DATA, '')
+    info['size'] = len(data)
+    if not info.get(MIMETYPE):
+        info[MIMETYPE] = get_mime(data)
+    return info
+
 def info_to_dict(info):
     """Create a dictionary representation of info's attributes.
 
@@ -651,6 +679,259 @@ class CaselessDict(dict):
         for k,v in other.items():
             self[k] = v
 
+class ImageBudget(object):
+    """Limits the amount of image data held by LazyImages objects.
+
+    Once more than limit bytes are loaded, the least recently
+    loaded images are unloaded. They'll be read from
+    file again when they're accessed.
+
+    It's shared by the threads that read and write files. The lock's
+    reentrant since the weakref callbacks can run during a collection
+    triggered while it's held."""
+
+    def __init__(self, limit=64 * 1024 ** 2):
+        self.limit = limit
+        self.size = 0
+        self._loaded = OrderedDict()
+        self._lock = threading.RLock()
+
+    def add(self, images, size):
+        key = id(images)
+        with self._lock:
+            if key in self._loaded:
+                self.size -= self._loaded.pop(key)[1]
+            self._loaded[key] = (weakref.ref(images, self._collected(key)),
+                size)
+            self.size += size
+            self.evict()
+
+    def _collected(self, key):
+        def remove(ref):
+            with self._lock:
+                if key in self._loaded and self._loaded[key][0] is ref:
+                    self.size -= self._loaded.pop(key)[1]
+        return remove
+
+    def discard(self, images):
+        key = id(images)
+        with self._lock:
+            if key in self._loaded:
+                self.size -= self._loaded.pop(key)[1]
+
+    def evict(self):
+        """Unloads images until less than limit bytes are loaded.
+
+        The most recently loaded images are always kept."""
+        with self._lock:
+            while self.size > self.limit and len(self._loaded) > 1:
+                key, (ref, size) = self._loaded.popitem(last=False)
+                self.size -= size
+                images = ref()
+                if images is not None:
+                    images.unload(False)
+
+image_budget = ImageBudget()
+
+class LazyImages(object):
+    """List-like container for the images embedded in a file.
+
+    Only the metadata of each image (as returned by image_info) is kept
+    until the image data is first needed. Then loader (a function that
+    reads the images from the file) is called and the result kept
+    until it's unloaded by image_budget.
+
+    len() and bool() don't load the images."""
+
+    def __init__(self, info, loader):
+        self.info = info
+        self._loader = loader
+        self._images = None
+
+    def _get_images(self):
+        #Kept in a local since another thread may unload them.
+        images = self._images
+        if images is None:
+            images = [parse_image(i) for i in self._loader()]
+            self._images = images
+            image_budget.add(self, sum(len(i[DATA]) for i in images))
+        return images
+
+    images = property(_get_images)
+    loaded = property(lambda self: self._images is not None)
+
+    def unload(self, discard=True):
+        """Drops the loaded image data."""
+        self._images = None
+        if discard:
+            image_budget.discard(self)
+
+    def __copy__(self):
+        return list(self.images)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self.images, memo)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyImages):
+            if self is other:
+                return True
+            if self.info != other.info:
+                return False
+            other = other.images
+        return self.images == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getitem__(self, index):
+        return self.images[index]
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __len__(self):
+        return len(self.info)
+
+    def __nonzero__(self):
+        return bool(self.info)
+
+    def __repr__(self):
+        return '<LazyImages: %d images, loaded=%s>' % (len(self.info),
+            self.loaded)
+
+def lazy_images(images, loader):
+    """Returns a LazyImages object for images or [] if images is empty.
+
+    images is a list of image dictionaries as read from the file.
+    loader is a function that returns them again."""
+    if not images:
+        return []
+    return LazyImages(map(image_info, images), loader)
+
+class TemporaryImages(object):
+    """Context manager that adds images to a tag only while it's
+    being saved, so that their data isn't kept in memory afterwards.
+
+    add is called on entry and returns the images it added to the tag.
+    remove takes them out again on exit, even if saving failed.
+    After a successful save, images holds the LazyImages (as returned
+    by lazy_images) that the tag's images should be replaced with."""
+
+    def __init__(self, add, remove, loader):
+        self._add = add
+        self._remove = remove
+        self._loader = loader
+        self._added = []
+        self.images = []
+
+    def __enter__(self):
+        self._added = self._add()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._remove()
+        if exc_type is None:
+            self.images = lazy_images(self._added, self._loader)
+
+#Padding policies used when saving tags.
+#default: The format's own. For most formats, existing padding is
+#   reused if the tag fits, but large amounts are trimmed.
+#keep: Existing padding is never trimmed and padding_size bytes are added
+#   when the tag grows, so that following edits can be done in place.
+PADDING_DEFAULT = 'default'
+PADDING_KEEP = 'keep'
+
+padding_policy = PADDING_DEFAULT
+padding_size = 8 * 1024
+
+#Mutagen added the padding argument to save in 1.31.
+MUTAGEN_PADDING = getattr(mutagen, 'version', (0,)) >= (1, 31)
+
+_save_stats = dict.fromkeys(['skipped', 'in_place', 'rewritten',
+    'unknown'], 0)
+_save_lock = threading.Lock()
+
+def set_padding(policy=None, size=None):
+    """Sets the padding policy (PADDING_DEFAULT or PADDING_KEEP) and
+    the number of bytes added by PADDING_KEEP."""
+    global padding_policy, padding_size
+    if policy is not None:
+        if policy not in (PADDING_DEFAULT, PADDING_KEEP):
+            raise ValueError('Invalid padding policy: %s' % policy)
+        padding_policy = policy
+    if size is not None:
+        padding_size = max(int(size), 0)
+
+def new_padding(available, size, default):
+    """Returns the number of bytes of padding to leave after a tag.
+
+    available is the padding left if the tag's written in place
+    (negative if it doesn't fit). size is the size of the file's
+    data that follows the tag. default is called to get the
+    padding used by PADDING_DEFAULT.
+
+    The file's only rewritten if the value returned isn't available."""
+    if padding_policy != PADDING_KEEP:
+        return default()
+    if available >= 0:
+        return available
+    return max(1024 + size // 1000, padding_size)
+
+def count_save(key):
+    with _save_lock:
+        _save_stats[key] += 1
+
+def save_stats():
+    """Returns a dictionary with the number of saves that were skipped
+    because nothing changed ('skipped'), written in place ('in_place'),
+    that rewrote the whole file ('rewritten') or for which it isn't
+    known ('unknown')."""
+    with _save_lock:
+        return _save_stats.copy()
+
+def padded_save(save, *args, **kwargs):
+    """Calls save, a mutagen save method, with the padding policy
+    and counts how the file was written."""
+    if not MUTAGEN_PADDING:
+        save(*args, **kwargs)
+        count_save('unknown')
+        return
+
+    resized = []
+    def padding(info):
+        ret = new_padding(info.padding, info.size, info.get_default_padding)
+        resized.append(ret != info.padding)
+        return ret
+
+    save(*args, padding=padding, **kwargs)
+    if not resized:
+        count_save('unknown')
+    elif True in resized:
+        count_save('rewritten')
+    else:
+        count_save('in_place')
+
+def tag_state(audio, exclude=()):
+    """Returns a digest of the tags in audio, a mutagen object.
+
+    Two objects with the same digest are written to file the same way.
+    Fields are compared in sorted order, but the values of a
+    field keep theirs. Fields starting with any of exclude (compared
+    case-insensitively) are skipped."""
+    digest = hashlib.sha1()
+    tags = audio.tags
+    if tags is None:
+        return digest.digest()
+    items = tags.items() if hasattr(tags, 'items') else list(tags)
+    items.sort(key=lambda item: item[0])
+    for key, value in items:
+        if exclude and key.lower().startswith(exclude):
+            continue
+        digest.update(repr(key))
+        digest.update(repr(value))
+    return digest.digest()
+
 class MockTag(object):
     """Use as base for all tag classes."""
 
@@ -755,16 +1036,29 @@ class MockTag(object):
     def iteritems(self):
         return ((key, self[key]) for key in self)
 
+    #Function that removes the images from a parsed mutagen object and
+    #returns their info (see image_info). Defined by formats that load
+    #their images lazily so that they aren't cached with the object.
+    _split_images = None
+
     def load(self, filename, filetype=None):
         filename = getfilename(filename)
         self.filepath = filename
         if filetype is not None:
-            audio = filetype(filename)
+            audio = tagcache.load(filename, filetype)[0]
         else:
             audio = None
         tags = getinfo(filename)
         return tags, audio
 
+    def load_split(self, filename, filetype):
+        """Like load, but the images are removed from the mutagen object
+        by _split_images. Returns (tags, mutagen object, image info)."""
+        filename = getfilename(filename)
+        self.filepath = filename
+        audio, images = tagcache.load(filename, filetype, self._split_images)
+        return getinfo(filename), audio, images
+
     def real(self, key):
         if key in self.revmapping:
             return self.revmapping[key]
@@ -774,6 +1068,33 @@ class MockTag(object):
         if not path.exists(self.filepath):
             raise IOError(ENOENT, os.strerror(ENOENT), self.filepath)
 
+    #Lowercase prefixes of the fields in self.mut_obj that images are
+    #written to. Images are compared separately by _unchanged.
+    _image_keys = ()
+    #State of the tags in the file. None if it's not known.
+    _state = None
+
+    def _store_state(self):
+        """Stores the state of the tags after they're read from or
+        written to file."""
+        self._state = (tag_state(self.mut_obj, self._image_keys),
+            self.images)
+
+    def _unchanged(self, state):
+        """Returns True if the tags in self.mut_obj (and self.images)
+        are the same as when state was stored, in which case the file
+        doesn't need to be written."""
+        if state is None:
+            return False
+        tags, images = state
+        if images is not self.images and (images or self.images):
+            return False
+        if tags != tag_state(self.mut_obj, self._image_keys):
+            return False
+        count_save('skipped')
+        self._state = state
+        return True
+
     def set_attrs(self, attrs, tags=None):
         if tags is None:
             tags = self
@@ -18,7 +18,7 @@ from util import (strlength, strbitrate, strfrequency, usertags, PATH,
     getdeco, setdeco, str_filesize, unicode_list,
     CaselessDict, del_deco, keys_deco, fn_hash, cover_info,
     MONO, STEREO, get_total, set_total, parse_image, info_to_dict,
-    get_mime)
+    get_mime, image_info, lazy_images)
 from tag_versions import tags_in_file
 
 PICARGS = ('type', 'mime', 'desc', 'width', 'height', 'depth', 'data')
@@ -60,6 +60,7 @@ def image_to_bin(image):
 def vorbis_tag(base, name):
     class Tag(util.MockTag):
         IMAGETAGS = (util.MIMETYPE, util.DESCRIPTION, util.DATA, util.IMAGETYPE)
+        _image_keys = (COVER_KEY,)
         mapping = {}
         revmapping = {}
 
@@ -93,6 +94,26 @@ def vorbis_tag(base, name):
             cover_info(images, self.__tags)
 
         images = property(_get_images, _set_images)
+
+        @staticmethod
+        def _images_from(audio):
+            if base == FLAC:
+                return filter(None, map(bin_to_image, audio.pictures))
+            elif COVER_KEY in audio:
+                return map(base64_to_image, audio[COVER_KEY])
+            return []
+
+        @staticmethod
+        def _split_images(audio):
+            images = map(image_info, Tag._images_from(audio))
+            if base == FLAC:
+                audio.clear_pictures()
+            elif COVER_KEY in audio:
+                del(audio[COVER_KEY])
+            return images
+
+        def _read_images(self):
+            return self._images_from(base(self.filepath))
                 
         def __contains__(self, key):
             if key == '__image':
@@ -168,20 +189,16 @@ def vorbis_tag(base, name):
             """Links the audio, filename
             returns self if successful, None otherwise."""
             self.__images = []
-            tags, audio = self.load(filename, base)
+            tags, audio, images = self.load_split(filename, base)
             if audio is None:
                 return
 
             for key in audio:
-                if key == COVER_KEY:
-                    self.images = map(base64_to_image, audio[key])
-                else:
+                if key != COVER_KEY:
                     self.__tags[key.lower()] = audio.tags[key]
 
-            if base == FLAC:
-                self.images = filter(None, map(bin_to_image, audio.pictures))
-            elif not self.images:
-                self.images = []
+            self.__images = lazy_images(images, self._read_images)
+            cover_info(self.__images, self.__tags)
 
             self.__tags.update(info_to_dict(audio.info))
             self.__tags.update(tags)
@@ -189,6 +206,7 @@ def vorbis_tag(base, name):
             self.mut_obj = audio
             self._originaltags = self.__tags.keys()
             self.update_tag_list()
+            self._store_state()
             return self
 
         def save(self):
@@ -201,27 +219,42 @@ def vorbis_tag(base, name):
             if filepath != self.mut_obj.filename:
                 self.mut_obj.filename = filepath
             audio = self.mut_obj
+            state, self._state = self._state, None
 
             newtag = {}
             for tag, value in usertags(self.__tags).items():
                 newtag[tag] = value
 
-            if self.__images:
-                if base == FLAC:
-                    audio.clear_pictures()
-                    map(lambda p: audio.add_picture(image_to_bin(p)),
-                        self.__images)
-                else:
-                    newtag[COVER_KEY] = filter(None, map(image_to_base64, self.__images))
-            else:
-                if base == FLAC:
-                    audio.clear_pictures()
-
             toremove = [z for z in audio if z not in newtag]
             for z in toremove:
                 del(audio[z])
             audio.update(newtag)
-            audio.save()
+            if base == FLAC:
+                audio.clear_pictures()
+            if self._unchanged(state):
+                return
+
+            def add_images():
+                if self.__images:
+                    if base == FLAC:
+                        map(lambda p: audio.add_picture(image_to_bin(p)),
+                            self.__images)
+                    else:
+                        audio[COVER_KEY] = filter(None,
+                            map(image_to_base64, self.__images))
+                return self._images_from(audio)
+
+            def remove_images():
+                if base == FLAC:
+                    audio.clear_pictures()
+                elif COVER_KEY in audio:
+                    del(audio[COVER_KEY])
+
+            with util.TemporaryImages(add_images, remove_images,
+                self._read_images) as saved:
+                util.padded_save(audio.save)
+            self.__images = saved.images
+            self._store_state()
 
         def set_fundamentals(self, tags, mut_obj, images=None):
             self.__tags = tags
@@ -2,7 +2,7 @@
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 import sys, os, pdb
-import puddlestuff.constants, puddlestuff.resource
+import puddlestuff.constants, puddlestuff.resources
 from decimal import Decimal
 from puddlestuff.puddleobjects import ListButtons, ListBox, OKCancel, PuddleConfig
 from matchfuncs import Algo, funcinfo, funcs, _ratio
@@ -117,7 +117,8 @@ class DupeTree(QTreeWidget):
                                 sorted(z[1:], key=title_sort)]
                     self.emit(SIGNAL('toplevel'), item)
                 yield None
-        s = progress(what, 'Checking ', len(artists))
+        #Stops the worker processes if the scan's cancelled.
+        s = progress(what, 'Checking ', len(artists), dupes.close)
         self.connect(self, SIGNAL('toplevel'), self._addItem)
         if self.parentWidget():
             s(self.parentWidget())
@@ -3,6 +3,40 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import sys, pdb
 
+from collections import deque
+from math import ceil
+from matchfuncs import _ratio, exact
+from puddlestuff.audioinfo.parallel import cpu_count, get_pool
+
+#Lists with less strings than this are compared using brute force.
+MIN_INDEXED = 64
+
+#Functions with similarity ratio <= 2 * (characters in common) / (total
+#length). Candidates for these can be found using an index. Others
+#(eg. jaro) are compared with every string.
+RATIO_FUNCS = set([_ratio])
+
+try:
+    from Levenshtein import ratio
+    RATIO_FUNCS.add(ratio)
+except ImportError:
+    pass
+
+def _first_intersections(groups, others):
+    """Returns the intersection of each set in groups with the
+    first set in others it intersects (if any)."""
+    first = {}
+    for i, group in enumerate(others):
+        for item in group:
+            first.setdefault(item, i)
+
+    ret = []
+    for group in groups:
+        found = [first[item] for item in group if item in first]
+        if found:
+            ret.append(group.intersection(others[min(found)]))
+    return ret
+
 def dupes(tracks, tags, func, matchcase = False, threshold = 1, prevdupe = None):
     if matchcase:
         strings = [[(i, t.get(field, u'')) for i, t in enumerate(tracks)] for field in tags]
@@ -17,61 +51,187 @@ def dupes(tracks, tags, func, matchcase = False, threshold = 1, prevdupe = None)
         ret = finddupes(strings[0], func, threshold)
 
     for s in strings[start:]:
-        l = []
         dups = finddupes(s, func, threshold)
         if len(dups) > len(ret):
-            for z in dups:
-                x = [z.intersection(r) for r in ret if z.intersection(r)]
-                if x:
-                    l.append(x[0])
+            ret = _first_intersections(dups, ret)
         else:
-            for z in ret:
-                x = [z.intersection(r) for r in dups if z.intersection(r)]
-                if x:
-                    l.append(x[0])            
-        ret = l
+            ret = _first_intersections(ret, dups)
     return ret
 
-def delete(l, dellist):
-    while dellist:
-        del(l[dellist[0]])
-        dellist = [z - 1 for z in dellist][1:]
-
-def finddupes(strings, func, threshold = 1):
+def _brute_dupes(strings, func, threshold):
+    used = [False] * len(strings)
     dupes = []
-    while strings:
-        index, mainstring = strings[0]
+    for i, (index, mainstring) in enumerate(strings):
+        if used[i]:
+            continue
         dupeset = set([index])
-        li = strings[1:]
-        todelete = []
-        for z, s in enumerate(li):
-            if func(s[1], mainstring) >= threshold:
-                dupeset.add(s[0])
-                todelete.append(z + 1)
-        delete(strings, todelete)
-        strings = strings[1:]
+        for j in xrange(i + 1, len(strings)):
+            if not used[j] and func(strings[j][1], mainstring) >= threshold:
+                dupeset.add(strings[j][0])
+                used[j] = True
         if len(dupeset) > 1:
             dupes.append(dupeset)
     return dupes
 
-def dupesinlib(library, algs, maintag = None, artists = None):
+def _exact_dupes(strings, threshold):
+    if threshold > 1:
+        return []
+    groups = {}
+    order = []
+    for index, string in strings:
+        if string not in groups:
+            groups[string] = set()
+            order.append(string)
+        groups[string].add(index)
+    return [groups[z] for z in order if len(groups[z]) > 1]
+
+def _char_counts(text):
+    counts = {}
+    for c in text:
+        counts[c] = counts.get(c, 0) + 1
+    return counts
+
+def _ratio_dupes(strings, func, threshold):
+    """Same as _brute_dupes, but func is only called for pairs of strings
+    that could reach threshold.
+
+    Each string is treated as a set of (character, occurrence) tokens.
+    Two strings can only have a ratio >= threshold if they have at least
+    threshold * len / (2 - threshold) tokens in common. Which means that
+    they share one of the rarest len - that + 1 tokens of each
+    string (prefix filtering), so only those are indexed."""
+    texts = [z[1] for z in strings]
+    counts = map(_char_counts, texts)
+    tokens = [[(c, k) for c, n in count.iteritems() for k in xrange(1, n + 1)]
+        for count in counts]
+
+    frequency = {}
+    for toks in tokens:
+        for token in toks:
+            frequency[token] = frequency.get(token, 0) + 1
+
+    eps = 1e-9
+    index = {}
+    prefixes = []
+    for i, toks in enumerate(tokens):
+        length = len(toks)
+        if not length:
+            #Empty strings can only match other empty strings.
+            prefix = [None]
+        else:
+            toks.sort(key=lambda token: (frequency[token], token))
+            overlap = int(ceil(threshold * length / (2 - threshold) - eps))
+            prefix = toks[:max(length - overlap + 1, 1)]
+        prefixes.append(prefix)
+        for token in prefix:
+            index.setdefault(token, []).append(i)
+
+    lengths = map(len, texts)
+    used = [False] * len(strings)
+    dupes = []
+    for i, (index_i, mainstring) in enumerate(strings):
+        if used[i]:
+            continue
+        candidates = set()
+        for token in prefixes[i]:
+            candidates.update(j for j in index[token] if j > i and not used[j])
+
+        dupeset = set([index_i])
+        length, count = lengths[i], counts[i]
+        for j in sorted(candidates):
+            total = length + lengths[j]
+            if total:
+                if 2.0 * min(length, lengths[j]) / total < threshold - eps:
+                    continue
+                other = counts[j]
+                common = sum(min(n, other.get(c, 0))
+                    for c, n in count.iteritems())
+                if 2.0 * common / total < threshold - eps:
+                    continue
+            if func(strings[j][1], mainstring) >= threshold:
+                dupeset.add(strings[j][0])
+                used[j] = True
+        if len(dupeset) > 1:
+            dupes.append(dupeset)
+    return dupes
+
+def finddupes(strings, func, threshold = 1):
+    """Groups the (index, string) tuples in strings.
+
+    The first string is grouped with all the strings for which
+    func(string, first) >= threshold. The rest are grouped
+    in the same way, ignoring strings that are already grouped.
+
+    Returns a list of sets of indexes, one for each group
+    with more than one string."""
+    if func is exact and threshold > 0:
+        return _exact_dupes(strings, threshold)
+    elif func in RATIO_FUNCS and 0 < threshold <= 1 and \
+        len(strings) >= MIN_INDEXED:
+        return _ratio_dupes(strings, func, threshold)
+    return _brute_dupes(strings, func, threshold)
+
+def tracks_dupes(stringtags, algs):
+    """Returns the duplicates (as sets of indexes) found in stringtags
+    using algs. Used to process one artist in dupesinlib."""
+    alg = algs[0]
+    ret = dupes(stringtags, alg.tags, alg.func, alg.matchcase, alg.threshold)
+    for alg in algs:
+        ret = dupes(stringtags, alg.tags, alg.func, alg.matchcase,
+            alg.threshold, ret)
+    return ret
+
+def dupesinlib(library, algs, maintag = None, artists = None,
+    processes = None):
+    """Generator that finds duplicates in library.
+
+    The first value yielded is the list of artists (values of maintag)
+    that are checked. After that a list of duplicate groups (lists of
+    tracks) is yielded for each artist, in the same order.
+
+    Artists are checked in parallel by up to processes (defaults to the
+    number of CPUs) of the worker processes started by
+    audioinfo.parallel.start_pool. If it wasn't called, they're checked
+    one after the other. Tracks are still retrieved from the library in
+    the calling thread. Closing the generator stops artists from being
+    sent to the workers."""
     alg = algs[0]
-    func = alg.func
-    percent = alg.threshold
-    tags = alg.tags
 
     if not maintag:
         maintag = alg.tags[0]
     if not artists:
         artists = sorted(library.distinct_values(maintag))
     yield artists
+
+    if processes is None or processes < 1:
+        processes = cpu_count()
+
+    pool = None
+    if processes > 1 and len(artists) > 1:
+        pool = get_pool()
+
+    if pool is None:
+        for a in artists:
+            tracks = library.get_tracks(maintag, a)
+            st = [z.stringtags() for z in tracks]
+            ret = tracks_dupes(st, algs)
+            yield [[tracks[i]  for i in z] for z in ret]
+        return
+
+    #Number of artists sent to the workers, but not yet yielded.
+    window = processes * 4
+    pending = deque()
     for a in artists:
         tracks = library.get_tracks(maintag, a)
-        st = [z.stringtags() for z in library.get_tracks(maintag, a)]
-        ret = dupes(st, tags, alg.func, alg.matchcase, alg.threshold)
-        for alg in algs:
-            ret = dupes(st, alg.tags, alg.func, alg.matchcase, alg.threshold, ret)
-        yield [[tracks[i]  for i in z] for z in ret]
+        st = [z.stringtags() for z in tracks]
+        pending.append((tracks, pool.apply_async(tracks_dupes, (st, algs))))
+        while pending and (len(pending) >= window or pending[0][1].ready()):
+            tracks, result = pending.popleft()
+            yield [[tracks[i]  for i in z] for z in result.get()]
+
+    while pending:
+        tracks, result = pending.popleft()
+        yield [[tracks[i]  for i in z] for z in result.get()]
 
 if __name__ == '__main__':
     import prokyon
@@ -8,6 +8,7 @@ from pyparsing import (Word, alphas,Literal, OneOrMore, alphanums,
     CharsNotIn, originalTextFor, nestedExpr, 
     Optional)
 from puddleobjects import PuddleConfig, safe_name
+from puddlestuff import profiling
 from funcprint import pprint
 from puddlestuff.util import PluginFunction, translate, to_list, to_string
 import cPickle as pickle
@@ -267,41 +268,15 @@ def get_function_arguments(funcname, func, arguments, reserved, fmt=True, *dicts
 
     return topass
 
-def run_format_func(funcname, arguments, m_audio, s_audio=None, extra=None,
-    state=None):
-    '''Runs the function function using the arguments specified from pudlestuff.function.
-
-    Arguments:
-    funcname  -- String with the function name. Looked up using the
-                 dictionary pudlestuff.function.functions
-    arguments -- List of arguments to pass to the function. Patterns
-                 should not be evaluated. They'll be evaluated here.
-    m_audio   -- Audio file containg multiple multiple values per key.
-                 Eg. {'artist': [u'Artist1': 'Artist2']}
-
-    Keyword Arguments
-    s_audio -- Same as m_audio, but containing strings as values.
-               Generated on each run unless also passed.
-    extra -- Dictionary containing extra fields that are to be used
-             when matching fields.
-    state -- Dictionary that hold state. Like {'__count': 15}.
-             Used by some functions in puddlestuff.functions
-    
-    '''
-    
-    #Get function
+def _lookup_function(funcname):
     try:
-        if isinstance(funcname, basestring):
-            func = functions[funcname]
-        else:
-            func = funcname
+        return functions[funcname]
     except KeyError:
         raise ParseError(SYNTAX_ERROR.arg(funcname).arg(
             translate('Defaults', 'function does not exist.')))
 
-    extra = {} if extra is None else extra
-    s_audio = stringtags(m_audio) if s_audio is None else s_audio
-    
+def _call_format_func(funcname, func, arguments, m_audio, s_audio, extra,
+    state):
     reserved = {'tags': s_audio, 'm_tags': m_audio, 'state': state}
     dicts = [s_audio, extra, state]
     topass = get_function_arguments(funcname, func, arguments,  reserved, True, *dicts)
@@ -319,86 +294,219 @@ def run_format_func(funcname, arguments, m_audio, s_audio=None, extra=None,
         message = SYNTAX_ERROR.arg(funcname).arg(e.message)
         raise ParseError(message)
 
-def parsefunc(s, m_audio, s_audio=None, state=None, extra=None, ret_i=False, path_sep=None):
-    """Parses format strings. Returns the parsed string.
+def run_format_func(funcname, arguments, m_audio, s_audio=None, extra=None,
+    state=None):
+    '''Runs the function function using the arguments specified from pudlestuff.function.
 
-    Arguments
-    ---------
-    s  -- *Unicode* format string. Eg. $replace(%artist%, name, surname)
-    m_audio -- Audio file containg multiple multiple values per key.
-        Eg. {'artist': [u'Artist1': 'Artist2']}
+    Arguments:
+    funcname  -- String with the function name. Looked up using the
+                 dictionary pudlestuff.function.functions
+    arguments -- List of arguments to pass to the function. Patterns
+                 should not be evaluated. They'll be evaluated here.
+    m_audio   -- Audio file containg multiple multiple values per key.
+                 Eg. {'artist': [u'Artist1': 'Artist2']}
 
     Keyword Arguments
     s_audio -- Same as m_audio, but containing strings as values.
-        Generated on each run unless also passed.
+               Generated on each run unless also passed.
     extra -- Dictionary containing extra fields that are to be used
              when matching fields.
     state -- Dictionary that hold state. Like {'__count': 15}.
              Used by some functions in puddlestuff.functions
+    
+    '''
+    
+    #Get function
+    if isinstance(funcname, basestring):
+        func = _lookup_function(funcname)
+    else:
+        func = funcname
 
-    >>> audio = {'artist': [u'Artist1'], 'track':u'10'}
-    >>> parsefunc(u'%track% - %artist%', audio)
-    Artist1 - 10
-    >>> state = {'__count': u'5'}
-    >>> parsefunc(u'$num(%track%, 2)/$num(%__count%, 2). %artist%', audio,
-    ... state = state)
-    u'05/05. Artist1'
+    extra = {} if extra is None else extra
+    s_audio = stringtags(m_audio) if s_audio is None else s_audio
 
-    """
+    return _call_format_func(funcname, func, arguments, m_audio, s_audio,
+        extra, state)
 
-    #Yes I know this is a big ass function...but it works and I can't
-    #see a way to split it without making it complicated.
-    
-    tokens = []
+#Characters that can be escaped with a backslash inside a function.
+ESCAPE_CHARS = set(u'()$%\\,')
+FUNC_START = re.compile(u'\$(\w+)\(')
+
+#Maximum number of compiled patterns kept by compile_format and replacevars.
+CACHE_SIZE = 1024
+
+_format_cache = {}
+_fields_cache = {}
+
+class _Fields(object):
+    """A pattern compiled for replacevars.
+
+    pieces is a list of literal strings and (field,) tuples."""
+    __slots__ = ('literal', 'pieces')
+
+    def __init__(self, pattern):
+        in_quote = False
+        in_field = False
+        ret = []
+        field_start = 0
+        escape = False
+
+        for i, c in enumerate(pattern):
+            try:
+                next_char = pattern[i + 1]
+            except IndexError:
+                next_char = None
+            if c == u'\\' and next_char == '"' and not escape:
+                escape = True
+                continue
+            elif escape:
+                escape = False
+            elif c == u'"':
+                in_quote = not in_quote
+                continue
+            elif c == u'%' and not in_quote:
+                if not in_field:
+                    field_start = len(ret)
+                    in_field = True
+                else:
+                    in_field = False
+                    field = u''.join(ret[field_start:])
+                    del(ret[field_start:])
+                    ret.append((field,))
+                continue
+            ret.append(c)
+
+        pieces = []
+        chars = []
+        for item in ret:
+            if isinstance(item, tuple):
+                if chars:
+                    pieces.append(u''.join(chars))
+                    chars = []
+                pieces.append(item)
+            else:
+                chars.append(item)
+        if chars or not pieces:
+            pieces.append(u''.join(chars))
+
+        self.pieces = pieces
+        if len(pieces) == 1 and not isinstance(pieces[0], tuple):
+            self.literal = pieces[0]
+        else:
+            self.literal = None
+
+    def fill(self, dicts):
+        """Replaces the fields with values from dicts. Later
+        dictionaries take precedence over earlier ones."""
+        if self.literal is not None:
+            return self.literal
+        dicts = [d for d in reversed(dicts) if d]
+        ret = []
+        for piece in self.pieces:
+            if isinstance(piece, tuple):
+                field = piece[0]
+                for d in dicts:
+                    if field in d:
+                        ret.append(d[field])
+                        break
+                else:
+                    ret.append(u'')
+            else:
+                ret.append(piece)
+        return u''.join(ret)
+
+def _compile_fields(pattern):
+    try:
+        return _fields_cache[pattern]
+    except KeyError:
+        pass
+    compiled = _Fields(pattern)
+    if len(_fields_cache) >= CACHE_SIZE:
+        _fields_cache.clear()
+    _fields_cache[pattern] = compiled
+    return compiled
+
+class _FuncCall(object):
+    """A $function(args) call in a compiled format string.
+
+    Each argument is either a string or a list of strings and
+    nested _FuncCall's that are joined once evaluated."""
+    __slots__ = ('name', 'func', 'args')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.func = functions.get(name)
+        self.args = args
+
+    def evaluate(self, m_audio, s_audio, state, extra):
+        arguments = []
+        for arg in self.args:
+            if isinstance(arg, list):
+                arg = u''.join([z.evaluate(m_audio, s_audio, state, extra)
+                    if isinstance(z, _FuncCall) else z for z in arg])
+            arguments.append(arg)
+
+        func = self.func
+        if func is None:
+            func = _lookup_function(self.name)
+        return _call_format_func(self.name, func, arguments, m_audio,
+            s_audio, {} if extra is None else extra, state)
+
+def _argument(token):
+    pieces = []
+    chars = []
+    for item in token:
+        if isinstance(item, _FuncCall):
+            if chars:
+                pieces.append(u''.join(chars))
+                chars = []
+            pieces.append(item)
+        else:
+            chars.append(item)
+    if not pieces:
+        return u''.join(chars)
+    if chars:
+        pieces.append(u''.join(chars))
+    return pieces
+
+def _compile(s, path_sep=None, start=0, ret_i=False):
+    """Does the work for compile_format.
+
+    If ret_i is True, s[start:] should begin with a function call.
+    It's compiled and returned along with the index of its closing
+    bracket."""
+    nodes = []
     token = []
     #List containing a function with it's arguments
     #Will look like ['replace', arg1, arg2, arg3]
-    #functions get evaluated as soon as closing bracket found.
     func = []
     #Flag determining if current within a function. Used for making comma's
     #significant
     in_func = False
     in_quote = False
-    #field_open == -1 if not current in the middle of processing a field
-    #eg. %artist%. Otherwise contains the index in s that the field started.
-    field_open = -1
     #Determine if next char should be escaped.
     escape = False
-        
-    
-    s_audio = stringtags(m_audio) if s_audio is None else s_audio
-    state = {} if state is None else state
-    tags = s_audio.copy()
-    tags.update(state)
-    tags.update(extra if extra is not None else {})
-
-    escape_chars = set('()$%\\,')
-
-    br_error = translate('Errors', 'No closing bracket found.')
 
+    #(number of preceding nodes, text before the separator) for each
+    #occurrence of path_sep outside of a function.
     paths = []
 
-    
-    i = 0
+    i = start
     while 1:
         try:
             c = s[i]
         except IndexError:  #  Parsing's done.
             if in_func:
-                raise ParseError(SYNTAX_ERROR.arg(func[0]).arg(br_error))
+                raise ParseError(SYNTAX_ERROR.arg(func[0]).arg(
+                    translate('Errors', 'No closing bracket found.')))
             if token:
-                tokens.append(replacevars(u''.join(token), tags))
+                nodes.append(_compile_fields(u''.join(token)))
             break
-        
+
         if c == u'"' and not escape:
             if in_func:
                 token.append(c)
             in_quote = not in_quote
-        elif c == u'"' and escape and in_func:
-            token.append(u'\\"')
-            i += 1
-            escape = False
-            continue
         elif escape:
             token.append(c)
             escape = False
@@ -406,64 +514,168 @@ def parsefunc(s, m_audio, s_audio=None, state=None, extra=None, ret_i=False, pat
             continue
         elif in_quote:
             token.append(c)
-        elif c == u'\\' and not escape:
-            escape = True
+        elif c == u'\\':
             i += 1
             try:
                 next_char = s[i]
             except IndexError:
                 next_char = None
 
-            if not in_func or (next_char not in escape_chars):
+            if in_func and next_char in ESCAPE_CHARS:
+                escape = True
+            else:
                 token.append(c)
-                escape = False
             continue
-        elif c == u'$' and not (escape or (field_open >= 0)):
-            func_name = re.search(u'^\$(\w+)\(', s[i:])
+        elif c == u'$':
+            func_name = FUNC_START.match(s, i)
             if not func_name:
                 token.append(c)
                 i += 1
                 continue
 
             if in_func:
-                func_parsed, offset = parsefunc(s[i:], m_audio, s_audio, state, extra, True)
-                token.append(func_parsed)
-                i += offset + 1
+                nested, i = _compile(s, None, i, True)
+                token.append(nested)
+                i += 1
                 continue
 
-            tokens.append(replacevars(u''.join(token), tags))
+            if token:
+                nodes.append(_compile_fields(u''.join(token)))
             token = []
-            func = []
-            func_name = func_name.groups(0)[0]
-            func.append(func_name)
+            func_name = func_name.group(1)
+            func = [func_name]
             in_func = True
             i += len(func_name) + 1
-        elif in_func and not in_quote and not token and c in whitespace:
+        elif in_func and not token and c in whitespace:
             'just increment counter'
-        elif c == u',' and in_func and not in_quote:
-            func.append(u''.join(token))
+        elif c == u',' and in_func:
+            func.append(token)
             token = []
         elif c == u')' and in_func:
             in_func = False
             if token or s[i-1] == u',':
-                func.append(u''.join(token))
+                func.append(token)
 
-            func_parsed = run_format_func(func[0], func[1:], m_audio, s_audio, state=state, extra=extra)
+            call = _FuncCall(func[0], map(_argument, func[1:]))
             if ret_i:
-                return func_parsed, i
-            tokens.append(func_parsed)
+                return call, i
+            nodes.append(call)
             token = []
         else:
             token.append(c)
             if path_sep and c == path_sep and not in_func:
-                paths.append(len(u''.join(tokens) + replacevars(u''.join(token), tags)) - 1)
+                paths.append((len(nodes), _compile_fields(u''.join(token))))
         escape = False
         i += 1
 
-    if path_sep and not ret_i:
-        return paths, u''.join(tokens)
-    else:
-        return u''.join(tokens)
+    return FormatPattern(s, nodes, paths if path_sep else None)
+
+class FormatPattern(object):
+    """A format string compiled by compile_format.
+
+    Call it with the same arguments as parsefunc (minus the
+    format string) to get the formatted text."""
+    __slots__ = ('pattern', 'nodes', 'paths', 'literal')
+
+    def __init__(self, pattern, nodes, paths=None):
+        self.pattern = pattern
+        self.nodes = nodes
+        self.paths = paths
+        if not nodes:
+            self.literal = u''
+        elif len(nodes) == 1 and isinstance(nodes[0], _Fields):
+            self.literal = nodes[0].literal
+        else:
+            self.literal = None
+
+    def __call__(self, m_audio, s_audio=None, state=None, extra=None):
+        if self.literal is not None and self.paths is None:
+            return self.literal
+
+        s_audio = stringtags(m_audio) if s_audio is None else s_audio
+        state = {} if state is None else state
+        dicts = (s_audio, state, extra)
+
+        tokens = [z.fill(dicts) if isinstance(z, _Fields) else
+            z.evaluate(m_audio, s_audio, state, extra) for z in self.nodes]
+        text = u''.join(tokens)
+
+        if self.paths is None:
+            return text
+
+        paths = [len(u''.join(tokens[:index]) + prefix.fill(dicts)) - 1
+            for index, prefix in self.paths]
+        return paths, text
+
+    def __repr__(self):
+        return u'<FormatPattern %r>' % self.pattern
+
+def clear_format_cache():
+    """Clears the compiled patterns. Should be called after the
+    functions dictionary changes."""
+    _format_cache.clear()
+    _fields_cache.clear()
+
+def compile_format(pattern, path_sep=None):
+    """Compiles the format string, pattern, for use with many files.
+
+    Returns a FormatPattern which is called with the audio
+    (and optionally s_audio, state and extra) as described in
+    parsefunc. Compiled patterns are cached so calling this
+    repeatedly with the same pattern is cheap.
+
+    If path_sep is passed, the FormatPattern returns a tuple
+    (indexes of path_sep in the text, text) like parsefunc does.
+
+    ParseError is raised if the pattern has unclosed brackets.
+
+    >>> pattern = compile_format(u'$num(%track%, 2). %title%')
+    >>> [pattern(audio) for audio in files]
+    [u'01. Title1', u'02. Title2']"""
+    key = (pattern, path_sep)
+    try:
+        return _format_cache[key]
+    except KeyError:
+        pass
+    compiled = _compile(pattern, path_sep)
+    if len(_format_cache) >= CACHE_SIZE:
+        _format_cache.clear()
+    _format_cache[key] = compiled
+    return compiled
+
+@profiling.timed('findfunc.parsefunc')
+def parsefunc(s, m_audio, s_audio=None, state=None, extra=None, path_sep=None):
+    """Parses format strings. Returns the parsed string.
+
+    Arguments
+    ---------
+    s  -- *Unicode* format string. Eg. $replace(%artist%, name, surname)
+    m_audio -- Audio file containg multiple multiple values per key.
+        Eg. {'artist': [u'Artist1': 'Artist2']}
+
+    Keyword Arguments
+    s_audio -- Same as m_audio, but containing strings as values.
+        Generated on each run unless also passed.
+    extra -- Dictionary containing extra fields that are to be used
+             when matching fields.
+    state -- Dictionary that hold state. Like {'__count': 15}.
+             Used by some functions in puddlestuff.functions
+    path_sep -- If passed, a tuple (indexes of path_sep in the
+        returned string, parsed string) is returned instead.
+
+    The format string is compiled once (see compile_format) and
+    the compiled version used for subsequent calls.
+
+    >>> audio = {'artist': [u'Artist1'], 'track':u'10'}
+    >>> parsefunc(u'%track% - %artist%', audio)
+    Artist1 - 10
+    >>> state = {'__count': u'5'}
+    >>> parsefunc(u'$num(%track%, 2)/$num(%__count%, 2). %artist%', audio,
+    ... state = state)
+    u'05/05. Artist1'
+
+    """
+    return compile_format(s, path_sep)(m_audio, s_audio, state, extra)
 
 def parse_field_list(fields, audio, selected=None):
     fields = fields[::]
@@ -533,44 +745,31 @@ def replacevars(pattern, *dicts):
     u'one '
 
     """
-    r_vars = {}
-    map(r_vars.update, [z for z in dicts if z])
-    
-    in_quote = False
-    in_field = False
-    ret = []
-    field_start = 0
-    escape = False
+    return _compile_fields(pattern).fill(dicts)
 
-    for i, c in enumerate(pattern):
-        try:
-            next_char = pattern[i + 1]
-        except IndexError:
-            next_char = None
-        if c == u'\\' and next_char == '"' and not escape:
-            escape = True
-            continue
-        elif escape:
-            escape = False
-        elif c == u'"':
-            in_quote = not in_quote
-            continue
-        elif c == u'%' and not in_quote:
-
-            if not in_field:
-                field_start = len(ret)
-                in_field = True
-            elif in_field:
-                in_field = False
-                field = u''.join(ret[field_start:])
-                del(ret[field_start:])
-                ret.append(r_vars.get(field, u''))
-            continue
-        ret.append(c)
 
-    return u''.join(ret)
+def action_fields(fields):
+    """Returns the list of fields that parse_field_list would return
+    for fields (the fields of an action) if it doesn't depend on the
+    file. Otherwise None is returned.
+
+    Results are cached, so that they're computed once per action
+    rather than once per file."""
+    key = tuple(fields)
+    try:
+        return _action_fields[key]
+    except KeyError:
+        pass
+    if '__all' in fields or [z for z in fields if z.startswith('~')]:
+        ret = None
+    else:
+        ret = parse_field_list(fields, {})
+    _action_fields[key] = ret
+    return ret
 
+_action_fields = {}
 
+@profiling.timed('findfunc.apply_actions')
 def apply_actions(actions, audio, state=None, ovr_fields=None):
     """Runs an action on audio
 
@@ -584,23 +783,35 @@ def apply_actions(actions, audio, state=None, ovr_fields=None):
     state['__counter'] = unicode(int(state['__counter']) + 1)
 
     r_tags = audio
-   
+
+    #The functions only replace values, so a shallow copy's enough
+    #to keep audio unchanged. Tag.tags is a new dictionary already.
     if hasattr(audio, 'tags'):
-        audio = deepcopy(audio.tags)
+        audio = audio.tags
+    elif isinstance(audio, audioinfo.CaselessDict):
+        audio = audioinfo.CaselessDict(audio)
     else:
-        audio = deepcopy(audio)
+        audio = dict(audio)
 
     changed = set()
+    s_audio = None
     for func in actions:
-        if ovr_fields is None:
-            fields = parse_field_list(func.tag, audio)
-        else:
+        if ovr_fields is not None:
             fields = ovr_fields[::]
+        else:
+            fields = action_fields(func.tag)
+            if fields is None:
+                fields = parse_field_list(func.tag, audio)
         ret = {}
 
+        #audio's only updated after each function, so the string
+        #version is reused until then.
+        if s_audio is None:
+            s_audio = stringtags(audio)
+
         for field in fields:
             val = audio.get(field, u'')
-            temp = func.runFunction(val, audio, state, None, r_tags)
+            temp = func.runFunction(val, audio, state, s_audio, r_tags)
             if temp is None:
                 continue
             if isinstance(temp, basestring):
@@ -624,6 +835,7 @@ def apply_actions(actions, audio, state=None, ovr_fields=None):
         if ret:
             [changed.add(z) for z in ret]
             audio.update(ret)
+            s_audio = None
     return dict([(z, audio[z]) for z in changed])
 
 def apply_macros(macros, audio, state, fields=None):
@@ -12,7 +12,7 @@ from PyQt4.QtCore import *
 
 from puddlestuff.util import pprint_tag
 import puddlestuff.findfunc as findfunc
-import puddlestuff.resource
+import puddlestuff.resources
 
 from audioinfo import commontags, PATH, FILE_FIELDS
 from puddlestuff.constants import HOMEDIR, KEEP
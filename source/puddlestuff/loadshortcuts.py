@@ -2,7 +2,7 @@
 from puddleobjects import PuddleConfig, get_icon
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-import sys, pdb, resource,os
+import sys, pdb, resources,os
 from constants import CONFIGDIR, DATADIR
 import StringIO
 from util import open_resourcefile
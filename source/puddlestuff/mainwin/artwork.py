@@ -4,7 +4,6 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from puddlestuff.constants import RIGHTDOCK, LEFTDOCK, SELECTIONCHANGED
 from puddlestuff.puddleobjects import PicWidget, open_resourcefile
-from puddlestuff.audioinfo.util import commonimages
 from puddlestuff.constants import KEEP, BLANK
 from PyQt4.QtSvg import QSvgGenerator
 
@@ -66,35 +65,30 @@ class ArtworkWidget(QWidget):
         vbox.addLayout(hbox)
         self.setLayout(vbox)
         status['images'] = self.images
-        self._audios = []
+        #True if the selection changed while hidden.
+        self._pending = False
         self._status = status
         self._readOnly = None
 
-    def fill(self, audios=None):
-        if audios is None:
-            audios = self._status['selectedfiles']
-        if not audios:
+    def fill(self, *args):
+        stats = self._status['selectionstats']
+        if not stats:
+            self._pending = False
             self.picwidget.setEnabled(False)
             self.picwidget.setImages(None)
             return
         if not self.isVisible():
-            self._audios = audios
+            self._pending = True
             return
-        self.picwidget.currentFile = audios[0]
+        self._pending = False
+        self.picwidget.currentFile = stats.first
         self.picwidget.filePattern = self._status['cover_pattern']
         pics = list(self._readOnlyPics())
         self.picwidget.setEnabled(True)
-        images = []
-        imagetags = set()
-        for audio in audios:
-            imagetags = imagetags.union(audio.IMAGETAGS)
-            if audio.IMAGETAGS:
-                images.append(audio.images)
-            else:
-                images.append({})
-
-        self.picwidget.lastfilename = audios[0].filepath
-        images = commonimages(images)
+        imagetags = stats.imagetags()
+
+        self.picwidget.lastfilename = stats.first.filepath
+        images = stats.images()
         self.picwidget.setImageTags(imagetags)
         
         if images == 0:
@@ -135,8 +129,7 @@ class ArtworkWidget(QWidget):
 
     def showEvent(self, event):
         QWidget.showEvent(self, event)
-        if self._audios:
-            self.fill(self._audios)
-            self._audios = []
+        if self._pending:
+            self.fill()
 
 control = ('Artwork', ArtworkWidget, RIGHTDOCK, False)
\ No newline at end of file
@@ -5,7 +5,7 @@ import pdb, sys, os, sip
 from puddlestuff.audioinfo import GENRES, INFOTAGS, READONLY
 from puddlestuff.audioinfo.util import commonimages
 from puddlestuff.puddleobjects import ListButtons, PuddleConfig, PicWidget
-import puddlestuff.resource as resource
+import puddlestuff.resources
 pyqtRemoveInputHook()
 from puddlestuff.constants import LEFTDOCK, SELECTIONCHANGED, BLANK, KEEP, SEPARATOR
 from functools import partial
@@ -134,6 +134,7 @@ class FrameCombo(QGroupBox):
     
     def _enablePreview(self):
         self.__indexFuncs = []
+        self._audios = None
         for field, combo in self.combos.iteritems():
             func = partial(self._emitChange, field)
             edit = QLineEdit()
@@ -151,6 +152,11 @@ class FrameCombo(QGroupBox):
             combo.disconnect(combo, func)
     
     def _emitChange(self, field, text):
+        #The tags of the selected files before they're previewed. Kept
+        #until the selection changes so that KEEP can restore them.
+        if self._audios is None:
+            self._audios = [z.usertags for z in
+                self._status['selectedfiles']]
         text = unicode(text)
         if text == BLANK: text = u''
         elif text == KEEP:
@@ -165,11 +171,11 @@ class FrameCombo(QGroupBox):
         self.emit(SIGNAL('onetomanypreview'), {field: text})
 
     def fillCombos(self, *args):
-        audios = self._status['selectedfiles']
-        self._audios = [z.usertags for z in audios]
+        stats = self._status['selectionstats']
+        self._audios = None
         combos = self.combos
 
-        if not audios:
+        if not stats:
             for combo in combos.values():
                 combo.clear()
                 combo.setEnabled(False)
@@ -177,17 +183,7 @@ class FrameCombo(QGroupBox):
 
         [combo.blockSignals(True) for combo in combos.values()]
         self.initCombos(True)
-        tags = dict((tag, set()) for tag in combos)
-        for audio in audios:
-            for field in tags:
-                if field in audio:
-                    value = audio[field]
-                    if isinstance(value, basestring):
-                        tags[field].add(value)
-                    else:
-                        tags[field].add(SEPARATOR.join(value))
-                else:
-                    tags[field].add(u'')
+        tags = dict((field, stats.values(field)) for field in combos)
 
         for field, values in tags.iteritems():
             combo = combos[field]
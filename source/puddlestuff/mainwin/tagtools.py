@@ -61,6 +61,8 @@ def remove_tag(tag, parent):
                     yield m, 1
                 else:
                     yield m, len(rows)
+        if rows:
+            status['model'].updateTable(rows)
         status['model'].undolevel += 1
 
     s = progress(func, translate("Tag Tools",
@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
-import pdb, string
+import pdb, string, threading
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from copy import deepcopy
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
+from weakref import WeakKeyDictionary
 
 import puddlestuff
 
 from puddlestuff.audioinfo import FILENAME
 from puddlestuff.constants import VARIOUS
 from puddlestuff.findfunc import filenametotag
-from puddlestuff.puddleobjects import natcasecmp, ratio
+from puddlestuff.puddleobjects import natcasecmp, ratio, RatioScorer
 from puddlestuff.tagsources import RetrievalError
 from puddlestuff.translations import translate
 from puddlestuff.util import sorted_split_by_field, split_by_field, to_string
@@ -56,6 +59,12 @@ NAME = 'name'
 DESC = 'description'
 EXISTING_ONLY = 'field_exists'
 
+#Number of threads used to query tag sources.
+WORKERS = 4
+
+#Number of matches retrieved ahead of the one being checked.
+PREFETCH = 3
+
 DEFAULT_PATTERN = u'%artist% - %album%/%track% - %title%'
 DEFAULT_NAME = translate('Masstagging', 'Default Profile')
 
@@ -109,6 +118,63 @@ class MassTagFlag(object):
         self.stop = False
         object.__init__(self)
 
+_source_locks = WeakKeyDictionary()
+_source_locks_lock = threading.Lock()
+
+def source_lock(tag_source):
+    """Returns the lock held while a request is made to tag_source.
+
+    Tag sources aren't written to be used from multiple threads, so
+    each is sent one request at a time. Different tag sources are
+    queried in parallel. Their requests are rate limited per host by
+    tagsources.ratelimit."""
+    with _source_locks_lock:
+        try:
+            return _source_locks[tag_source]
+        except KeyError:
+            lock = _source_locks[tag_source] = threading.Lock()
+            return lock
+
+def create_pool(workers=WORKERS):
+    """Returns the ThreadPool used to query tag sources."""
+    return ThreadPool(max(workers, 1))
+
+def retrieve_matches(tsp, matches, pool=None, errors=None, prefetch=PREFETCH):
+    """Generator yielding (match, result) for each of matches, in order.
+
+    Up to prefetch matches following the one yielded are retrieved
+    in pool so that they're ready if it's rejected. Errors are passed
+    to errors in the calling thread, like TagSourceProfile.retrieve.
+
+    Once the generator's closed (eg. a match was accepted), prefetched
+    matches that haven't been sent to the tag source yet are dropped."""
+    matches = iter(list(matches))
+    if pool is None:
+        for match in matches:
+            yield match, tsp.fetch(match, errors)
+        return
+
+    abandoned = threading.Event()
+    def fetch(match):
+        return tsp.fetch(match, abandoned=abandoned)
+
+    pending = deque((match, pool.apply_async(fetch, (match,)))
+        for match in islice(matches, max(prefetch, 1)))
+
+    try:
+        while pending:
+            match, async_result = pending.popleft()
+            for following in islice(matches, 1):
+                pending.append((following,
+                    pool.apply_async(fetch, (following,))))
+            try:
+                result = async_result.get()
+            except RetrievalError, e:
+                result = tsp.retrieval_failed(e, errors)
+            yield match, result
+    finally:
+        abandoned.set()
+
 
 
 def brute_force_results(audios, retrieved):
@@ -244,6 +310,108 @@ get_lower = lambda f, key, default=u'': to_string(f.get(key,default)).lower()
 def ratio_compare(d1, d2, key):
     return ratio(get_lower(d1, key, u'a'), get_lower(d2, key, u'b'))
 
+def _hungarian(weights, rows, columns):
+    """Returns the assignment of rows to columns with the maximum total
+    weight as a list of (row, column) tuples.
+
+    weights[row][column] is the weight of the pair or missing if the
+    pair can't be assigned. len(rows) must be <= len(columns)."""
+    n, m = len(rows), len(columns)
+    inf = float('inf')
+    #Costs are negated weights, with 0 for pairs that can't be assigned.
+    cost = [[-weights[row].get(column, 0.0) for column in columns]
+        for row in rows]
+
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in xrange(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = inf
+            j1 = 0
+            row = cost[i0 - 1]
+            for j in xrange(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in xrange(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if not j0:
+                break
+
+    return [(rows[p[j] - 1], columns[j - 1]) for j in xrange(1, m + 1)
+        if p[j] and columns[j - 1] in weights[rows[p[j] - 1]]]
+
+def assign_matches(matched):
+    """Assigns each file to at most one track and vice versa so that the
+    total score is the highest possible.
+
+    matched is a dictionary of {file index: {track index: score}}.
+    Returns {track index: file index}.
+
+    The files and tracks are split into groups that don't share any
+    possible matches and each group is solved separately, since most
+    files only match a few tracks."""
+    by_track = defaultdict(dict)
+    for f_index, t_indexes in matched.iteritems():
+        for t_index, score in t_indexes.iteritems():
+            by_track[t_index][f_index] = score
+
+    assigned = {}
+    visited = set()
+    for start in matched:
+        if start in visited or not matched[start]:
+            continue
+        f_group, t_group = [], set()
+        visited.add(start)
+        stack = [start]
+        while stack:
+            f_index = stack.pop()
+            f_group.append(f_index)
+            for t_index in matched[f_index]:
+                if t_index in t_group:
+                    continue
+                t_group.add(t_index)
+                for other in by_track[t_index]:
+                    if other not in visited:
+                        visited.add(other)
+                        stack.append(other)
+
+        f_group.sort()
+        t_group = sorted(t_group)
+        if len(f_group) == 1 and len(t_group) == 1:
+            assigned[t_group[0]] = f_group[0]
+        elif len(f_group) <= len(t_group):
+            for f_index, t_index in _hungarian(matched, f_group, t_group):
+                assigned[t_index] = f_index
+        else:
+            for t_index, f_index in _hungarian(by_track, t_group, f_group):
+                assigned[t_index] = f_index
+    return assigned
+
 def match_files(files, tracks, minimum=0.7, keys=None, jfdi=False,
     existing=False, as_index=False):
 
@@ -254,63 +422,31 @@ def match_files(files, tracks, minimum=0.7, keys=None, jfdi=False,
         keys.remove('track')
     ret = {}
     replace_tracknumbers(files, tracks)
-    assigned = {}
     matched = defaultdict(lambda: {})
-    b = False
-    
-    for f_index, f in enumerate(files):
-        scores = {}
-        for t_index, track in enumerate(tracks):
-            totals = [ratio_compare(f, track, key) for key in keys]
-            if not totals:
-                continue
-            score = min(totals)
-            if score > minimum and score not in scores:
-                matched[f_index][t_index] = sum(totals)
 
-    def get_best(f_index, t_indexes):
-        if not t_indexes:
-            return
-        items = t_indexes.items()
-        best_match = max(items, key=itemgetter(1))
-        t_i = best_match[0]
-
-        while t_i in assigned:
-            try:
-                old_match = matched[assigned[t_i]][t_i]
-            except KeyError:
-                break
-            if best_match[1] > old_match:
-                old_f_index = assigned[t_i]
-                assigned[t_i] = f_index
-                get_best(old_f_index, matched[old_f_index])
-                return
-            else:
-                items.remove(best_match)
-                if not items:
-                    return
-                best_match = max(items, key=itemgetter(1))
-                t_i = best_match[0]
-
-        assigned[t_i] = f_index
-
-    for f_index, t_indexes in matched.iteritems():
-        best_match = max(t_indexes.items(), key=itemgetter(1))
-        t_index = best_match[0]
-        while t_index in assigned:
-            prev_matched = assigned[t_index]
-            if t_indexes[t_index] > matched[prev_matched][t_index]:
-                get_best(prev_matched, matched[prev_matched])
-                break
-            else:
-                del(t_indexes[t_index])
-                if not t_indexes:
+    #Strings are normalized once and scores are cached for repeated
+    #values (eg. the artist of a single artist album).
+    scorer = RatioScorer(minimum)
+    prepare = scorer.prepare
+    score = scorer.score
+    f_strings = [[prepare(get_lower(f, key, u'a')) for key in keys]
+        for f in files]
+    t_strings = [[prepare(get_lower(t, key, u'b')) for key in keys]
+        for t in tracks]
+
+    for f_index, f_values in enumerate(f_strings):
+        for t_index, t_values in enumerate(t_strings):
+            totals = []
+            for f_value, t_value in zip(f_values, t_values):
+                total = score(f_value, t_value)
+                if total is None:
                     break
-                best_match = max(t_indexes.items(), key=itemgetter(1))
-                t_index = best_match[0]
+                totals.append(total)
+            else:
+                if totals:
+                    matched[f_index][t_index] = sum(totals)
 
-        if t_indexes:
-            assigned[t_index] = f_index
+    assigned = assign_matches(matched)
 
     ret_indexes = {}
     for t_index, f_index in assigned.iteritems():
@@ -388,7 +524,19 @@ def merge_tsp_tracks(profiles, files=None):
     return ret
 
 def masstag(mtp, files=None, flag=None, mtp_error_func=None,
-    tsp_error_func=None, print_status=True):
+    tsp_error_func=None, print_status=True, pool=None):
+    """Searches the tag sources of mtp for files.
+
+    Tag sources are queried in parallel using pool (see create_pool).
+    If None, one is created for this call."""
+
+    if pool is None:
+        pool = create_pool()
+        try:
+            return masstag(mtp, files, flag, mtp_error_func,
+                tsp_error_func, print_status, pool)
+        finally:
+            pool.terminate()
 
     not_found = []
     found = []
@@ -416,8 +564,10 @@ def masstag(mtp, files=None, flag=None, mtp_error_func=None,
 
     mtp.regexps = DEFAULT_REGEXP if not mtp.regexps else mtp.regexps
 
-    for matches, results, tsp in mtp.search(files, errors=mtp_error_func):
+    searches = mtp.search(files, errors=mtp_error_func, pool=pool)
+    for matches, results, tsp in searches:
         if flag.stop:
+            searches.close()
             break
         if len(results) > 1:
             set_status(RESULTS_FOUND % len(results))
@@ -436,18 +586,19 @@ def masstag(mtp, files=None, flag=None, mtp_error_func=None,
             set_status(ONE_MATCHING_ALBUM_FOUND)
 
         set_status(get_match_str(matches[0].info))
-        result = tsp.retrieve(matches[0], errors=tsp_error_func)
-
-        while not check_result(result, files):
-            del(matches[0])
-            if matches:
+        result = None
+        retrieved = retrieve_matches(tsp, matches, pool, tsp_error_func)
+        for i, (match, fetched) in enumerate(retrieved):
+            if i:
                 set_status(RETRIEVING_NEXT)
-                set_status(get_match_str(matches[0].info))
-                result = tsp.retrieve(matches[0], errors=tsp_error_func)
-            else:
-                result = None
+                set_status(get_match_str(match.info))
+            tsp.set_result(match, fetched)
+            if check_result(fetched, files):
+                result = fetched
                 break
-            
+            del(matches[0])
+        retrieved.close()
+
         if result is None:
             set_status(NO_MATCHES % tsp.tag_source.name)
             not_found.append(tsp)
@@ -468,7 +619,7 @@ def masstag(mtp, files=None, flag=None, mtp_error_func=None,
             regexps=mtp.regexps)
 
         ret = masstag(new_mtp, audios_copy, flag,
-            mtp_error_func, tsp_error_func, False)
+            mtp_error_func, tsp_error_func, False, pool)
 
     if found:
         if not ret and print_status:
@@ -556,7 +707,13 @@ class MassTagProfile(object):
         for profile in self.profiles:
             profile.clear_results()
 
-    def search(self, files=None, profiles=None, regexps=None, errors=None):
+    def search(self, files=None, profiles=None, regexps=None, errors=None,
+        pool=None):
+        """Generator yielding (matches, results, profile) for each
+        profile in order.
+
+        All the profiles are searched in parallel using pool. If None,
+        they're searched one after the other as they're yielded."""
         files = self.files if files is None else files
         profiles = self.profiles if profiles is None else profiles
         regexps = self.regexps if regexps is None else regexps
@@ -566,27 +723,45 @@ class MassTagProfile(object):
 
         self.files = files
 
+        rxp_album = None
+        changed_files = None
         if regexps:
             changed_files = \
                 map(lambda f: apply_regexps(f, regexps), files)
             rxp_album = changed_files[0][0]
             changed_files = [z[1] for z in changed_files]
 
-        for profile in profiles:
+        def search_profile(profile):
             profile.clear_results()
             set_status(POLLING % profile.tag_source.name)
+            results = profile.search(files)
+            if rxp_album:
+                profile.clear_results()
+                set_status(translate('Masstagging',
+                    'Retrying search with album name: <b>%s</b>') %
+                    rxp_album)
+                results.extend(profile.search(changed_files))
+                profile.clear_results()
+            profile.results = results
+            if results:
+                profile.find_matches(self.album_bound, files)
+            profile.files = files
+            return results
+
+        if pool is not None:
+            searches = [pool.apply_async(search_profile, (profile,))
+                for profile in profiles]
+        else:
+            searches = [None] * len(profiles)
+
+        for profile, search in zip(profiles, searches):
             try:
-                results = profile.search(files)
-                if regexps and rxp_album:
-                    profile.clear_results()
-                    set_status(translate('Masstagging',
-                        'Retrying search with album name: <b>%s</b>') %
-                        rxp_album)
-                    rxp_results = profile.search(changed_files)
-                    results.extend(rxp_results)
-                    profile.clear_results()
-                profile.results = results
+                if search is None:
+                    search_profile(profile)
+                else:
+                    search.get()
             except RetrievalError, e:
+                profile.clear_results()
                 if errors is None:
                     raise e
                 if errors(e, profile):
@@ -594,9 +769,6 @@ class MassTagProfile(object):
                 yield [], [], profile
                 continue
 
-            if results:
-                profile.find_matches(self.album_bound, files)
-            profile.files = files
             yield profile.matched, profile.results, profile
 
 class Result(object):
@@ -680,33 +852,56 @@ class TagSourceProfile(object):
         self.matched = find_best(results, files, album_bound)
         return self.matched
 
-    def retrieve(self, result, errors=None):
-        info = result.info if hasattr(result, 'info') else result
+    def fetch(self, result, errors=None, abandoned=None):
+        """Retrieves the album of result without changing the profile.
 
-        try:
-            index = self.results.index(result)
-        except ValueError:
-            index = None
+        Returns the retrieved Result or result itself if the tag
+        source didn't return anything. Can be called from any thread.
+
+        If abandoned (a threading.Event) is set by the time the tag
+        source is free, nothing is retrieved and None is returned."""
+        info = result.info if hasattr(result, 'info') else result
 
         try:
-            results = self.tag_source.retrieve(info)
-            if results is not None:
-                self.result = Result(*results)
-            else:
-                self.result = result
-                return self.result
+            with source_lock(self.tag_source):
+                if abandoned is not None and abandoned.is_set():
+                    return None
+                results = self.tag_source.retrieve(info)
         except RetrievalError, e:
-            if errors is None:
-                raise
-            if errors(e, self):
-                raise e
-            else:
-                self.result = Result({}, [])
-        self.result.tag_source = self.tag_source
-        if index is not None:
-            self.results[index] = self.result
+            return self.retrieval_failed(e, errors)
+
+        if results is None:
+            return result
+        ret = Result(*results)
+        ret.tag_source = self.tag_source
+        return ret
+
+    def retrieval_failed(self, error, errors=None):
+        """Returns the empty Result used if a retrieval failed.
+
+        error is raised if errors is None or errors(error, self)
+        returns True."""
+        if errors is None or errors(error, self):
+            raise error
+        ret = Result({}, [])
+        ret.tag_source = self.tag_source
+        return ret
+
+    def retrieve(self, result, errors=None):
+        self.set_result(result, self.fetch(result, errors))
         return self.result
 
+    def set_result(self, match, result):
+        """Sets the retrieved result of match (one of self.results)."""
+        self.result = result
+        if result is match:
+            return
+        try:
+            index = self.results.index(match)
+        except ValueError:
+            return
+        self.results[index] = result
+
     def search(self, files=None, tag_source=None):
         tag_source = self.tag_source if tag_source is None else tag_source
         files = self.files if files is None else files
@@ -716,8 +911,9 @@ class TagSourceProfile(object):
 
         files = split_by_field(files, *tag_source.group_by)
         search_value = files.keys()[0]
-        self.results = map(lambda x: Result(*x),
-            tag_source.search(search_value, files[search_value]))
+        with source_lock(tag_source):
+            results = tag_source.search(search_value, files[search_value])
+        self.results = map(lambda x: Result(*x), results)
         for r in self.results:
             r.tag_source = self.tag_source
         return self.results
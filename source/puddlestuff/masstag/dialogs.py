@@ -16,11 +16,11 @@ from puddlestuff.util import to_list, to_string
 
 import puddlestuff.masstag
 from puddlestuff.masstag import (NO_MATCH_OPTIONS, combine_tracks,
-    fields_from_text, match_files, masstag, merge_tsp_tracks,
+    create_pool, fields_from_text, match_files, masstag, merge_tsp_tracks,
     split_files, MassTagFlag, MassTagProfile, TagSourceProfile)
 from puddlestuff.masstag.config import (PROFILEDIR, CONFIG, convert_mtps,
     load_all_mtps, mtp_from_file, save_mtp)
-from puddlestuff.webdb import strip as strip_fields
+from puddlestuff.webdb import initialized_sources, strip as strip_fields
 
 status_obj = QObject()
 
@@ -497,7 +497,7 @@ class MassTagWindow(QWidget):
         write = QPushButton(translate('Masstagging', '&Write Previews'))
         clear = QPushButton(translate('Masstagging', 'Clear &Preview'))
         self._log = QTextEdit()
-        self.tag_sources = status['initialized_tagsources']
+        self.tag_sources = initialized_sources(status)
 
         self.profileCombo = QComboBox()
         self.profile = None
@@ -630,23 +630,26 @@ class MassTagWindow(QWidget):
 
         def run_masstag():
             replace_fields = []
-            for files in tag_groups:
-                mtp.clear()
-
-                
-                masstag(mtp, files, self.__flag, search_error,
-                    retrieval_error)
-
-                retrieved = merge_tsp_tracks(mtp.profiles)
-                ret = match_files(files, retrieved,
-                        mtp.track_bound, mtp.fields,
-                        mtp.jfdi, mtp.leave_existing, True)[0]
-
-                if ret:
-                    thread.emit(SIGNAL('enable_preview_mode'))
-                    thread.emit(SIGNAL('setpreview'), ret)
-
-                set_status('<hr width="45%" /><br />')
+            pool = create_pool()
+            try:
+                for files in tag_groups:
+                    mtp.clear()
+
+                    masstag(mtp, files, self.__flag, search_error,
+                        retrieval_error, pool=pool)
+
+                    retrieved = merge_tsp_tracks(mtp.profiles)
+                    ret = match_files(files, retrieved,
+                            mtp.track_bound, mtp.fields,
+                            mtp.jfdi, mtp.leave_existing, True)[0]
+
+                    if ret:
+                        thread.emit(SIGNAL('enable_preview_mode'))
+                        thread.emit(SIGNAL('setpreview'), ret)
+
+                    set_status('<hr width="45%" /><br />')
+            finally:
+                pool.terminate()
 
         def finished(value):
             if not (value is True):
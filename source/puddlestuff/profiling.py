@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Optional timers and counters for finding out where time goes.
+
+Everything here does nothing unless profiling's enabled, either with the
+--profile command-line option or by setting the PUDDLETAG_PROFILE
+environment variable to the filename of the trace to write.
+
+When enabled, each timed call is recorded along with the totals for its
+name. At exit, they're written to a JSON file in the Trace Event Format
+that can be opened in chrome://tracing, Perfetto, speedscope...
+
+>>>with timer('scanfiles.read_dir'):
+...     entries = os.listdir(dirpath)
+>>>@timed('findfunc.parsefunc')
+...def parsefunc(text, audio):
+...     pass
+>>>count('webclient.cache_hits')"""
+
+import atexit
+import json
+import logging
+import os
+import thread
+import threading
+import time
+
+from functools import wraps
+
+ENV_VAR = 'PUDDLETAG_PROFILE'
+
+#Timed calls recorded after this many are only added to the totals.
+MAX_EVENTS = 500000
+
+enabled = False
+filename = None
+
+_start = time.time()
+_pid = os.getpid()
+_lock = threading.Lock()
+_events = []
+#name: [calls, total seconds, longest call in seconds]
+_totals = {}
+_counters = {}
+_registered = False
+
+def enable(trace_filename):
+    """Starts recording. The trace's written to trace_filename at exit."""
+    global enabled, filename, _registered
+    filename = trace_filename
+    enabled = True
+    if not _registered:
+        atexit.register(_write_at_exit)
+        _registered = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def clear():
+    with _lock:
+        del(_events[:])
+        _totals.clear()
+        _counters.clear()
+
+def _us(t):
+    return int((t - _start) * 1000000)
+
+def _record(name, start, end):
+    duration = end - start
+    with _lock:
+        total = _totals.get(name)
+        if total is None:
+            total = _totals[name] = [0, 0.0, 0.0]
+        total[0] += 1
+        total[1] += duration
+        if duration > total[2]:
+            total[2] = duration
+        if len(_events) < MAX_EVENTS:
+            _events.append({'name': name, 'ph': 'X', 'ts': _us(start),
+                'dur': int(duration * 1000000), 'pid': _pid,
+                'tid': thread.get_ident()})
+
+class timer(object):
+    """Context manager that records how long its block took as name."""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            _record(self.name, self.start, time.time())
+            self.start = None
+
+def timed(name=None):
+    """Decorator that records each call of the decorated function. name
+    defaults to the function's module and name."""
+    def decorator(func):
+        label = name if name else u'%s.%s' % (func.__module__,
+            func.__name__)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(label, start, time.time())
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    """Adds value to the counter, name."""
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+def instant(name):
+    """Records that name happened now (eg. a stage of startup)."""
+    if enabled:
+        with _lock:
+            if len(_events) < MAX_EVENTS:
+                _events.append({'name': name, 'ph': 'i', 's': 'g',
+                    'ts': _us(time.time()), 'pid': _pid,
+                    'tid': thread.get_ident()})
+
+def summary():
+    """Returns a dictionary with the totals of each timer
+    (calls, total and longest call in seconds) and the counters."""
+    with _lock:
+        timers = dict((name, {'calls': calls, 'total': total,
+            'max': longest}) for name, (calls, total, longest)
+            in _totals.iteritems())
+        return {'timers': timers, 'counters': dict(_counters)}
+
+def report():
+    """Returns the summary as text, slowest timers first."""
+    info = summary()
+    lines = [u'%10s %10s %10s  %s' % ('Calls', 'Total (s)', 'Max (s)',
+        'Timer')]
+    for name, t in sorted(info['timers'].iteritems(),
+        key=lambda item: item[1]['total'], reverse=True):
+        lines.append(u'%10d %10.3f %10.3f  %s' % (t['calls'], t['total'],
+            t['max'], name))
+    if info['counters']:
+        lines.append(u'%10s  %s' % ('Count', 'Counter'))
+        for name, value in sorted(info['counters'].iteritems()):
+            lines.append(u'%10s  %s' % (value, name))
+    return u'\n'.join(lines)
+
+def trace():
+    """Returns the recorded events in the Trace Event Format."""
+    info = summary()
+    with _lock:
+        events = list(_events)
+    now = _us(time.time())
+    events.extend({'name': name, 'ph': 'C', 'ts': now, 'pid': _pid,
+        'tid': 0, 'args': {'value': value}}
+        for name, value in info['counters'].iteritems())
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': _pid,
+        'tid': 0, 'args': {'name': 'puddletag'}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+        'otherData': info}
+
+def write_trace(trace_filename=None):
+    if trace_filename is None:
+        trace_filename = filename
+    fo = open(trace_filename, 'w')
+    try:
+        json.dump(trace(), fo)
+    finally:
+        fo.close()
+
+def _write_at_exit():
+    if not filename or not (_events or _counters):
+        return
+    try:
+        write_trace()
+    except EnvironmentError:
+        logging.exception(u'Could not write the profiling trace.')
+        return
+    logging.info(u'Profiling trace written to %s\n%s', filename, report())
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
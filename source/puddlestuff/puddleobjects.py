@@ -8,12 +8,13 @@ Contains objects used throughout puddletag"""
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 from PyQt4.QtSvg import *
-import json, sys, os,pdb,shutil
+import atexit, json, sys, os,pdb,shutil, threading
 from collections import defaultdict
+from contextlib import contextmanager
 
 from itertools import groupby # for unique function.
 from bisect import bisect_left, insort_left # for unique function.
-from copy import copy
+from copy import copy, deepcopy
 import audioinfo
 from audioinfo import (IMAGETYPES, DESCRIPTION, DATA, IMAGETYPE, DEFAULT_COVER,
     encode_fn, decode_fn, INFOTAGS)
@@ -33,6 +34,20 @@ MSGARGS = (QMessageBox.Warning, QMessageBox.Yes or QMessageBox.Default,
     QMessageBox.No or QMessageBox.Escape, QMessageBox.YesAll)
 from functools import partial
 from puddlestuff.translations import translate
+from puddlestuff import profiling
+
+try:
+    from scandir import scandir
+except ImportError:
+    try:
+        from os import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from Levenshtein import distance as _c_levenshtein
+except ImportError:
+    _c_levenshtein = None
 
 # Parameters for string distance function.
 # Words that can be moved to the end of a string using a comma.
@@ -198,6 +213,153 @@ class CoverButton(QPushButton):
     def currentIndex(self):
         return self._index
 
+#Seconds after a change before config files are written.
+WRITE_DELAY = 2.0
+
+_config_files = {}
+_config_lock = threading.Lock()
+
+class _ConfigFile(object):
+    """Parsed contents of a config file, shared by every PuddleConfig
+    object that uses it.
+
+    Changes are written back WRITE_DELAY seconds after the first one
+    (so that the file's written once for a burst of changes), when
+    flush is called or at exit. The file's replaced atomically. If
+    something else wrote to the file in the meantime, only the changed
+    keys are written over its new contents."""
+
+    def __init__(self, filename):
+        object.__init__(self)
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.dirty = False
+        #(section, key) of each unsaved change.
+        self.pending = set()
+        self.transactions = 0
+        self._timer = None
+        self.read()
+
+    def _signature(self):
+        try:
+            info = os.stat(self.filename)
+        except EnvironmentError:
+            return None
+        return (info.st_mtime, info.st_size)
+
+    def read(self):
+        with self.lock:
+            self.data = defaultdict(lambda: {})
+            self.signature = self._signature()
+            self.dirty = False
+            self.pending = set()
+            if self.signature is None:
+                return
+            try:
+                self.data.update(json.loads(open(self.filename, 'r').read()))
+            except:
+                pass
+
+    def _merge(self):
+        """Reads the file again, keeping the unsaved changes."""
+        with self.lock:
+            data, pending = self.data, self.pending
+            self.read()
+            for section, key in pending:
+                if section in data and key in data[section]:
+                    self.data[section][key] = data[section][key]
+            self.pending = pending
+            self.dirty = bool(pending)
+
+    def check(self):
+        """Reads the file again if it was changed by something else."""
+        with self.lock:
+            if self._signature() != self.signature:
+                self._merge()
+
+    def changed(self, section, key):
+        with self.lock:
+            self.dirty = True
+            self.pending.add((section, key))
+            if self.transactions or self._timer is not None:
+                return
+            self._timer = threading.Timer(WRITE_DELAY, self._flush_later)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except EnvironmentError:
+            logging.exception(u'Could not save %s', self.filename)
+
+    def flush(self, force=False):
+        """Writes unsaved changes to the file. If force is True, it's
+        written even if there aren't any."""
+        with self.lock:
+            timer, self._timer = self._timer, None
+            if timer is not None:
+                timer.cancel()
+            self._write(force)
+        #Otherwise, the timer's thread may still be running at exit.
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+
+    def _write(self, force):
+        with self.lock:
+            if not (self.dirty or force):
+                return
+            if not force and self.signature is not None and \
+                self._signature() is None:
+                #Removed since it was read, so the changes are dropped
+                #rather than creating it again.
+                self.read()
+                return
+            current = self._signature()
+            if current is not None and current != self.signature:
+                self._merge()
+
+            filename = self.filename
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.exists(dirname):
+                try:
+                    os.makedirs(dirname)
+                except EnvironmentError:
+                    pass
+
+            temp = filename + '.tmp'
+            with open(temp, 'w') as fo:
+                fo.write(json.dumps(dict(self.data), indent=2))
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp, filename)
+            self.signature = self._signature()
+            self.dirty = False
+            self.pending = set()
+
+def _config_file(filename):
+    filename = os.path.abspath(filename)
+    with _config_lock:
+        try:
+            config = _config_files[filename]
+        except KeyError:
+            config = _config_files[filename] = _ConfigFile(filename)
+            return config
+    config.check()
+    return config
+
+def flush_configs():
+    """Writes the unsaved changes of all config files."""
+    with _config_lock:
+        configs = _config_files.values()
+    for config in configs:
+        try:
+            config.flush()
+        except EnvironmentError:
+            logging.exception(u'Could not save %s', config.filename)
+
+atexit.register(flush_configs)
+
 class PuddleConfig(object):
     """Module that allows you to values from INI config files, similar to
     Qt's Settings module (Created it because PyQt4.4.3 has problems with
@@ -206,7 +368,11 @@ class PuddleConfig(object):
     Only two functions of interest:
 
     get -> load a key from a specified section
-    set -> save a key section"""
+    set -> save a key section
+
+    The contents of each file are read once and shared by all
+    PuddleConfig objects. Changes are written shortly after they're
+    made. Use transaction to write several at once."""
     def __init__(self, filename = None):
         if not filename:
             filename = os.path.join(CONFIGDIR, 'puddletag.conf')
@@ -215,12 +381,16 @@ class PuddleConfig(object):
         self.setSection = self.set
         self.load = self.get
 
+    data = property(lambda self: self._config.data)
+
     def get(self, section, key, default, getint = False):
-        settings = self.data
-        try:
-            value = self.data[section][key]
-        except KeyError:
-            return default
+        with self._config.lock:
+            try:
+                value = self.data[section][key]
+            except KeyError:
+                return default
+            if isinstance(value, (list, dict)):
+                value = deepcopy(value)
 
         if isinstance(default, bool):
             if value is True or value == 'True':
@@ -237,41 +407,47 @@ class PuddleConfig(object):
             return value
 
     def set(self, section = None, key = None, value = None):
-        settings = self.data
         if isinstance(value, QString):
             value = unicode(value)
-        if section in self.data:
-            settings[section][key] = value
-        else:
-            settings[section] = {}
-            settings[section][key] = value
-        self.save()
+        elif isinstance(value, (list, dict)):
+            value = deepcopy(value)
+        with self._config.lock:
+            settings = self.data
+            if section in settings:
+                settings[section][key] = value
+            else:
+                settings[section] = {}
+                settings[section][key] = value
+            self._config.changed(section, key)
+
+    @contextmanager
+    def transaction(self):
+        """Context manager within which changes aren't written. They're
+        written together when the outermost transaction ends."""
+        config = self._config
+        with config.lock:
+            config.transactions += 1
+        try:
+            yield self
+        finally:
+            with config.lock:
+                config.transactions -= 1
+                flush = not config.transactions and config.dirty
+            if flush:
+                config.flush()
 
     def reload(self):
-        self.data = defaultdict(lambda: {})
-        if os.path.exists(self.filename):
-            try:
-                self.data.update(json.loads(open(self.filename, 'r').read()))
-            except:
-                pass
+        self._config.flush()
+        self._config.read()
 
     def save(self):
-        actions =  self.data.get('puddleactions')
-        filename = self.filename
-        if not os.path.exists(filename):
-            dirname = os.path.dirname(filename)
-            try:
-                os.makedirs(dirname)
-            except:
-                pass
-        
-        with open(filename, 'w') as fo:
-            fo.write(json.dumps(dict(self.data), indent=2))
+        """Writes the file now."""
+        self._config.flush(True)
 
     def _setFilename(self, filename):
         self._filename = filename
         self.savedir = os.path.dirname(filename)
-        self.reload()
+        self._config = _config_file(filename)
 
     def _getFilename(self):
         return self._filename
@@ -385,6 +561,105 @@ def ratio(str1, str2):
     return 1 - dist
 
 
+def _bounded_levenshtein(s1, s2, limit):
+    """Returns the edit distance between s1 and s2 if it's <= limit.
+    Otherwise, some value > limit is returned."""
+    if _c_levenshtein is not None:
+        return _c_levenshtein(s1, s2)
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    if not s1:
+        return len(s2)
+
+    previous_row = xrange(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1 != c2)
+            current_row.append(min(insertions, deletions, substitutions))
+        if min(current_row) > limit:
+            return limit + 1
+        previous_row = current_row
+
+    return previous_row[-1]
+
+class RatioScorer(object):
+    """Computes ratio for many pairs of strings.
+
+    Each string is prepared once. Pairs of strings that don't contain
+    any of the SD_PATTERNS are compared directly and skipped if their
+    lengths and characters show they can't score more than minimum.
+    Other pairs use ratio. Results are cached by pair.
+
+    score returns None for pairs whose ratio is <= minimum. Otherwise,
+    the same value as ratio."""
+
+    def __init__(self, minimum=None):
+        self.minimum = minimum
+        self._prepared = {}
+        self._scores = {}
+
+    def prepare(self, text):
+        try:
+            return self._prepared[text]
+        except KeyError:
+            pass
+
+        normalized = text.lower()
+        for word in SD_END_WORDS:
+            if normalized.endswith(', %s' % word):
+                normalized = '%s %s' % (word, normalized[:-len(word)-2])
+        plain = not any(re.search(pat, normalized) for pat, w in SD_PATTERNS)
+        basic = re.sub(r'[^a-z0-9]', '', normalized.lower())
+        counts = {}
+        for c in basic:
+            counts[c] = counts.get(c, 0) + 1
+        prepared = self._prepared[text] = (text, plain, basic, counts)
+        return prepared
+
+    def _plain_ratio(self, basic1, counts1, basic2, counts2):
+        if not basic1 and not basic2:
+            return 1 - (0.0 + 0.0)
+        length = float(max(len(basic1), len(basic2)))
+        minimum = self.minimum
+        if minimum is None:
+            limit = len(basic1) + len(basic2)
+        else:
+            #Largest distance that could still give a ratio > minimum.
+            limit = int((1 - minimum) * length) + 1
+            if abs(len(basic1) - len(basic2)) > limit:
+                return
+            missing = max(
+                sum(max(0, n - counts2.get(c, 0)) for c, n in counts1.iteritems()),
+                sum(max(0, n - counts1.get(c, 0)) for c, n in counts2.iteritems()))
+            if missing > limit:
+                return
+        distance = _bounded_levenshtein(basic1, basic2, limit)
+        if distance > limit:
+            return
+        return 1 - (distance / length + 0.0)
+
+    def score(self, prepared1, prepared2):
+        key = (prepared1[0], prepared2[0])
+        try:
+            return self._scores[key]
+        except KeyError:
+            pass
+
+        if prepared1[1] and prepared2[1]:
+            score = self._plain_ratio(prepared1[2], prepared1[3],
+                prepared2[2], prepared2[3])
+        else:
+            score = ratio(prepared1[0], prepared2[0])
+
+        if score is not None and self.minimum is not None and \
+            score <= self.minimum:
+            score = None
+        self._scores[key] = score
+        return score
+
 dirlevels = lambda a: len(a.split('/'))
 
 def removeslash(x):
@@ -617,6 +892,22 @@ class compare:
 
 natcasecmp = compare().natcasecmp
 
+_natcasekeys = {}
+
+def natcasekey(value):
+    """Key function that sorts the same way as natcasecmp.
+
+    value can be a string or a list of strings. Keys are cached by value
+    so sorting the same values again doesn't recompute them."""
+    text = u"".join(value).lower()
+    try:
+        return _natcasekeys[text]
+    except KeyError:
+        if len(_natcasekeys) > 100000:
+            _natcasekeys.clear()
+        key = _natcasekeys[text] = compare().natsort_key(text)
+        return key
+
 def dupes(l, method = None):
     if method is None:
         method = lambda a,b: int(a==b)
@@ -639,34 +930,107 @@ def dupes(l, method = None):
                 groups.append([i])
     return [z for z in groups if len(z) > 1]
 
-def getfiles(files, subfolders = False):
+def _dir_entries(dirpath):
+    """Yields (path, is_dir) for each entry in dirpath.
+
+    is_dir follows symlinks."""
+    join = os.path.join
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            try:
+                yield entry.path, entry.is_dir()
+            except EnvironmentError:
+                continue
+    else:
+        isdir = os.path.isdir
+        for name in os.listdir(dirpath):
+            filepath = join(dirpath, name)
+            yield filepath, isdir(filepath)
+
+def filespec_matcher(filespec, matchcase=False):
+    """Returns a function that checks whether a path matches
+    filespec (a ';' separated list of glob patterns) or None if
+    filespec is empty."""
+    if not filespec or not filespec.strip():
+        return None
+    regexp = u'|'.join(map(translate_filename_pattern,
+        [z.strip() for z in filespec.split(u';')]))
+    if matchcase:
+        return re.compile(regexp).match
+    return re.compile(regexp, re.I).match
+
+def scanfiles(files, subfolders=False, extensions=None, filespec=None,
+    matchcase=False):
+    """Generator yielding the files in files (a path or list of paths).
+
+    Directories are read exactly once, subdirectories are only
+    descended into if subfolders is True. Symlinked directories
+    are followed, but each directory (by device and inode) is only
+    visited once so symlink loops and duplicates are skipped.
+
+    extensions is a list of file extensions (without the dot). Files
+    found in directories are only yielded if their extension is in it.
+    Files passed directly aren't filtered by extension.
+
+    filespec is a ';' separated list of glob patterns
+    (see translate_filename_pattern) that paths have to match."""
     if isinstance(files, basestring):
         files = [files]
 
+    if extensions is not None:
+        extensions = set(e.lower() for e in extensions)
+    match = filespec_matcher(filespec, matchcase)
+    splitext = os.path.splitext
     isdir = os.path.isdir
-    join = os.path.join
 
-    temp = []
+    visited = set()
+    def not_visited(dirpath):
+        try:
+            info = os.stat(dirpath)
+        except EnvironmentError:
+            return False
+        key = (info.st_dev, info.st_ino)
+        if key in visited:
+            return False
+        visited.add(key)
+        return True
 
-    if not subfolders:
-        for f in files:
-            if not isdir(f):
-                yield f
-            else:
-                dirname, subs, fnames = os.walk(f).next()
-                for fname in fnames:
-                    yield join(dirname, fname)
-    else:
-        for f in files:
-            if not isdir(f):
+    for f in files:
+        if not isdir(f):
+            if match is None or match(f):
                 yield f
-            else:                
-                for dirname, subs, fnames in os.walk(f):
-                    for fname in fnames:
-                        yield join(dirname, fname)
-                    for sub in subs:
-                        for fname in getfiles(join(dirname, sub), subfolders):
-                            pass
+            continue
+
+        if not not_visited(f):
+            continue
+        dirs = [f]
+        while dirs:
+            dirpath = dirs.pop()
+            subdirs = []
+            try:
+                with profiling.timer('scanfiles.read_dir'):
+                    entries = list(_dir_entries(dirpath))
+            except EnvironmentError:
+                logging.exception(u'Could not read directory %s',
+                    decode_fn(dirpath))
+                continue
+            profiling.count('scanfiles.dirs')
+            profiling.count('scanfiles.entries', len(entries))
+
+            for filepath, is_dir in entries:
+                if is_dir:
+                    if subfolders and not_visited(filepath):
+                        subdirs.append(filepath)
+                    continue
+                if extensions is not None and \
+                    splitext(filepath)[1][1:].lower() not in extensions:
+                    continue
+                if match is None or match(filepath):
+                    yield filepath
+            dirs.extend(reversed(subdirs))
+
+def getfiles(files, subfolders = False):
+    return scanfiles(files, subfolders)
 
 def gettags(files) :
     return (gettag(audio) for audio in files)
@@ -718,13 +1082,7 @@ def translate_filename_pattern(pat):
     return res + '\Z'
 
 def fnmatch(pattern, files, matchcase=False):
-    regexp = u'|'.join(map(translate_filename_pattern, 
-        [z.strip() for z in pattern.split(u';')]))
-    if matchcase:
-        match = re.compile(regexp).match
-    else:
-        match = re.compile(regexp, re.I).match
-    return filter(match, files)
+    return filter(filespec_matcher(pattern, matchcase), files)
 
 def gettaglist():
     cparser = PuddleConfig()
@@ -920,15 +1278,6 @@ def progress(func, pstring, maximum, threadfin = None):
         thread.start()
     return s
 
-def timemethod(method):
-    def f(*args, **kwargs):
-        name = method.__name__
-        t = time.time()
-        ret = method(*args, **kwargs)
-        print name, time.time() - t
-        return ret
-    return f
-
 class HeaderSetting(QDialog):
     """A dialog that allows you to edit the header of a TagTable widget."""
     def __init__(self, tags=None, parent=None, showok=True, showedits=True):
@@ -2186,15 +2535,40 @@ class PuddleDock(QDockWidget):
     when...uhm...it changes visibility."""
     _controls = {}
 
-    def __init__(self, title, control=None, parent=None, status=None):
+    def __init__(self, title, control=None, parent=None, status=None,
+        deferred=False):
+        """If deferred is True, control is only created when the dock
+        is first shown (or createControl is called)."""
         QDockWidget.__init__(self, translate("Dialogs", title), parent)
         self.title = title
+        self._control = None
+        self._factory = None
         if control:
-            control = control(status=status)
             self.setObjectName(title)
-            self._control = control
-            self._controls.update({title: control})
-            self.setWidget(control)
+            self._factory = (control, status)
+            if deferred:
+                self.connect(self, SIGNAL('visibilityChanged(bool)'),
+                    self._showDeferred)
+            else:
+                self.createControl()
+
+    def createControl(self):
+        """Creates the dock's control if it hasn't been yet, emitting
+        'controlcreated' with it. Returns the control."""
+        if self._factory is None:
+            return self._control
+        control, status = self._factory
+        self._factory = None
+        control = control(status=status)
+        self._control = control
+        self._controls.update({self.title: control})
+        self.setWidget(control)
+        self.emit(SIGNAL('controlcreated'), control)
+        return control
+
+    def _showDeferred(self, visible):
+        if visible:
+            self.createControl()
 
     def setVisible(self, visible):
         QDockWidget.setVisible(self, visible)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys, resource, os
+import sys, resources, os
 
 from copy import copy, deepcopy
 
@@ -675,13 +675,15 @@ class SettingsDialog(QDialog):
             self.setMinimumWidth(self.sizeHint().width())
 
     def saveSettings(self):
-        for z in self._widgets.values():
-            try:
-                z[1].applySettings(z[2])
-            except SettingsError, e:
-                QMessageBox.warning(self, 'puddletag',
-                    translate('Settings', 'An error occurred while saving the settings of <b>%1</b>: %2').arg(z[0]).arg(unicode(e)))
-                return
+        #The config file's written once, after all the settings are set.
+        with PuddleConfig().transaction():
+            for z in self._widgets.values():
+                try:
+                    z[1].applySettings(z[2])
+                except SettingsError, e:
+                    QMessageBox.warning(self, 'puddletag',
+                        translate('Settings', 'An error occurred while saving the settings of <b>%1</b>: %2').arg(z[0]).arg(unicode(e)))
+                    return
         self.close()
 
 if __name__ == "__main__":
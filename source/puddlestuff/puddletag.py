@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 import sys, os
 from puddlestuff.puddleobjects import (PuddleConfig, PuddleDock, winsettings,
-    progress, PuddleStatus, errormsg, dircmp, encode_fn, get_icon)
+    progress, PuddleStatus, errormsg, dircmp, encode_fn, get_icon,
+    flush_configs)
 
 status = PuddleStatus()
 
@@ -11,13 +12,9 @@ import tagmodel
 from tagmodel import TagTable
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-import pdb, resource
-import mainwin.dirview, mainwin.tagpanel, mainwin.patterncombo
-import mainwin.filterwin, mainwin.storedtags, mainwin.logdialog
+import pdb, resources
 import mainwin.action_dialogs, mainwin.tagtools
-import mainwin.previews, mainwin.artwork
-import puddlestuff.masstag.dialogs
-import puddlestuff.webdb
+import mainwin.previews
 import loadshortcuts as ls
 import m3u, findfunc, genres
 
@@ -40,6 +37,8 @@ import action_shortcuts, traceback
 import plugins
 from puddlestuff.translations import translate
 from copy import copy
+from importlib import import_module
+from puddlestuff.startuptimes import mark
 
 pyqtRemoveInputHook()
 
@@ -62,6 +61,19 @@ plugins.status = status
 confirmations.add('preview_mode', True, translate("Confirmations", 'Confirm when exiting preview mode.'))
 confirmations.add('delete_files', True, translate("Confirmations", 'Confirm when deleting files.'))
 
+#Modules containing the controls of the tool windows. They're
+#imported when the main window's created.
+DOCK_MODULES = ('puddlestuff.mainwin.tagpanel', 'puddlestuff.mainwin.artwork',
+    'puddlestuff.mainwin.dirview', 'puddlestuff.mainwin.patterncombo',
+    'puddlestuff.mainwin.filterwin', 'puddlestuff.webdb',
+    'puddlestuff.mainwin.storedtags', 'puddlestuff.mainwin.logdialog',
+    'puddlestuff.masstag.dialogs')
+
+#Tool windows whose controls are only created when they're first shown.
+#Their controls mustn't be used by actions or need signals emitted
+#before they're created.
+DEFERRED_DOCKS = ('Tag Sources', 'Mass Tagging')
+
 def create_tool_windows(parent, extra=None):
     """Creates the dock widgets for the main window (parent) using
     the modules stored in puddlestuff/mainwin.
@@ -72,12 +84,7 @@ def create_tool_windows(parent, extra=None):
     docks = []
     cparser = PuddleConfig()
     cparser.filename = ls.menu_path
-    widgets = (mainwin.tagpanel, mainwin.artwork,
-        mainwin.dirview, mainwin.patterncombo, mainwin.filterwin,
-        puddlestuff.webdb, mainwin.storedtags, mainwin.logdialog,
-        puddlestuff.masstag.dialogs)
-    
-    controls = [z.control for z in widgets]
+    controls = [import_module(z).control for z in DOCK_MODULES]
     controls.extend(mainwin.action_dialogs.controls)
     if extra:
         controls.extend(extra)
@@ -90,7 +97,7 @@ def create_tool_windows(parent, extra=None):
         except IndexError:
             pass
 
-        p = PuddleDock(z[0], z[1], parent, status)
+        p = PuddleDock(z[0], z[1], parent, status, name in DEFERRED_DOCKS)
         
         parent.addDockWidget(z[2], p)
 
@@ -107,6 +114,7 @@ def create_tool_windows(parent, extra=None):
         if scut:
             action.setShortcut(scut)
         actions.append(action)
+        mark(u'Created %s' % name)
     return actions, docks
 
 def create_context_menus(controls, actions):
@@ -243,6 +251,7 @@ def load_plugins():
     from puddlestuff.pluginloader import load_plugins
     plugins = load_plugins()
     puddlestuff.findfunc.functions.update(plugins[constants.FUNCTIONS])
+    puddlestuff.findfunc.clear_format_cache()
     puddlestuff.functions.no_preview.extend(plugins[constants.FUNCTIONS_NO_PREVIEW])
     puddlestuff.tagsources.tagsources.extend(plugins[constants.TAGSOURCE])
     puddlestuff.musiclib.extralibs = plugins[constants.MUSICLIBS]
@@ -294,6 +303,7 @@ class MainWin(QMainWindow):
         self.gensettings = [('&Load last folder at startup', False, 1)]
         self._playlist = None
         plugin_dialogs, plugin_modules = load_plugins()
+        mark('Loaded plugins')
 
         self.setWindowTitle("puddletag")
         self.setDockNestingEnabled(True)
@@ -316,6 +326,9 @@ class MainWin(QMainWindow):
                                 
         ls.create_files()
         winactions, self._docks = create_tool_windows(self)
+        for dock in self._docks:
+            self.connect(dock, SIGNAL('controlcreated'),
+                self._controlCreated)
         status['dialogs'] = PuddleDock._controls
         self.createStatusBar()
 
@@ -351,6 +364,7 @@ class MainWin(QMainWindow):
         connect_action_shortcuts(all_actions)
         create_context_menus(controls, all_actions)
         status['actions'] = all_actions
+        mark('Created actions and menus')
 
         for m in plugin_modules:
             if hasattr(m, 'init'):
@@ -366,9 +380,11 @@ class MainWin(QMainWindow):
                 self.addDock(*win, connect=False)
             except:
                 logging.exception("Error while loading Plugin dialog.")
+        mark('Initialized plugins')
 
         self.restoreSettings()
         self.emit(SIGNAL('always'), True)
+        mark('Restored settings')
 
     def addDock(self, name, dialog, position, visibility=True, connect=True):
         controls = PuddleDock._controls.values()
@@ -381,6 +397,26 @@ class MainWin(QMainWindow):
         self.restoreDockWidget(dock)
         return PuddleDock._controls[name]
 
+    def _controlCreated(self, control):
+        """Sets up the control of a tool window whose creation
+        was deferred until it was shown."""
+        controls = PuddleDock._controls
+        name = [k for k, v in controls.items() if v is control][0]
+        others = [c for c in controls.values() if c is not control]
+        connect_control(control, others + [mainwin.previews.obj])
+
+        actions = [a for a in status['actions']
+            if getattr(a, 'control', None) == name]
+        connect_actions(actions, controls)
+        create_context_menus({name: control}, status['actions'])
+
+        if hasattr(control, 'loadSettings'):
+            control.loadSettings()
+        if hasattr(control, 'gensettings'):
+            val = dict(load_gen_settings(control.gensettings))
+            control.applyGenSettings(val, 0)
+            control.applyGenSettings(val, 1)
+
     def addShortcuts(self, menu_title, actions, toolbar=False, save=False):
         if not actions:
             return
@@ -474,24 +510,28 @@ class MainWin(QMainWindow):
         if tagmodel.has_previews(parent=self, msg=preview_msg):
             e.ignore()
             return False
-        controls = PuddleDock._controls
-        for control in PuddleDock._controls.values():
-            if hasattr(control, 'saveSettings'):
-                try:
-                    control.saveSettings(self)
-                except TypeError:
-                    control.saveSettings()
-
         cparser = PuddleConfig()
+        with cparser.transaction():
+            controls = PuddleDock._controls
+            for control in PuddleDock._controls.values():
+                if hasattr(control, 'saveSettings'):
+                    try:
+                        control.saveSettings(self)
+                    except TypeError:
+                        control.saveSettings()
+
+            if self._lastdir:
+                cparser.set('main', 'lastfolder',
+                    unicode(self._lastdir[0], 'utf8'))
+            cparser.set("main", "maximized", self.isMaximized())
         settings = QSettings(constants.QT_CONFIG, QSettings.IniFormat)
-        if self._lastdir:
-            cparser.set('main', 'lastfolder', unicode(self._lastdir[0], 'utf8'))
-        cparser.set("main", "maximized", self.isMaximized())
         settings.setValue('main/state', QVariant(self.saveState()))
 
         headstate = self._table.horizontalHeader().saveState()
         settings.setValue('table/header', QVariant(headstate))
         genres.save_genres(status['genres'])
+        audioinfo.tagcache.set_cache(None)
+        flush_configs()
         e.accept()
 
     def createStatusBar(self):
@@ -569,6 +609,9 @@ class MainWin(QMainWindow):
         self.emit(SIGNAL('loadFiles'), None, [filename], append)
 
     def openPrefs(self):
+        #The settings pages of tool windows are needed.
+        for dock in self._docks:
+            dock.createControl()
         win = SettingsDialog(PuddleDock._controls.values(), self, status)
         win.show()
 
@@ -634,6 +677,23 @@ class MainWin(QMainWindow):
 
         filepath = os.path.join(cparser.savedir, 'mappings')
         audioinfo.setmapping(audioinfo.loadmapping(filepath, mapping))
+
+        audioinfo.image_budget.limit = cparser.get('tags',
+            'image_memory_mb', 64) * 1024 ** 2
+
+        try:
+            audioinfo.set_padding(
+                cparser.get('tags', 'padding', audioinfo.PADDING_DEFAULT),
+                cparser.get('tags', 'padding_size', 8 * 1024, True))
+        except ValueError:
+            logging.error(u'Invalid padding policy in the config file.')
+
+        if cparser.get('tagcache', 'enabled', True):
+            try:
+                audioinfo.tagcache.set_cache(audioinfo.tagcache.TagCache(
+                    os.path.join(constants.SAVEDIR, 'tagcache.db')))
+            except Exception:
+                logging.exception('Could not open the tag cache.')
         status['genres'] = genres.load_genres()
 
         connect_controls(controls + [mainwin.previews.obj])
@@ -694,22 +754,24 @@ class MainWin(QMainWindow):
         self.emit(SIGNAL('viewfilled'), val)
 
     def _updateStatus(self, files):
-        if not files:
-            return '00 (00:00:00 | 00 KB)'
-        numfiles = len(files)
         stats = [(int(z.size), lnglength(z.length)) for z in files]
-        totalsize = sum([z[0] for z in stats])
-        totallength = strlength(sum([z[1] for z in stats]))
+        return self._statusText(len(files), sum([z[0] for z in stats]),
+            sum([z[1] for z in stats]))
 
-        sizetext = str_filesize(totalsize)
-        return '%d (%s | %s)' % (numfiles, totallength, sizetext)
+    def _statusText(self, numfiles, totalsize, totallength):
+        if not numfiles:
+            return '00 (00:00:00 | 00 KB)'
+        return '%d (%s | %s)' % (numfiles, strlength(totallength),
+            str_filesize(totalsize))
 
     def lockLayout(self):
         for dw in self._docks:
             dw.setTitleBarWidget(QWidget())
 
     def updateSelectedStats(self, *args):
-        self._selectedstats.setText(self._updateStatus(status['selectedfiles']))
+        stats = status['selectionstats']
+        self._selectedstats.setText(self._statusText(len(stats), stats.size,
+            stats.length))
 
     def updateTotalStats(self, *args):
         self._totalstats.setText(self._updateStatus(status['alltags']))
@@ -735,24 +797,32 @@ class MainWin(QMainWindow):
             fin()
             return
 
+        def written(row, result):
+            failed_rows[0] = row
+            if isinstance(result, EnvironmentError):
+                failed_rows.append(row)
+            elif result:
+                lib_updates.append(result)
+
+        writer = model.writeRows(rows, tagiter, True, written)
+
         def func():
-            for row, f in izip(rows, tagiter):
-                failed_rows[0] = row
-                try:
-                    update = setRowData(row, f, undo=True)
-                    if update:
-                        lib_updates.append(update)
-                    yield None
-                except EnvironmentError, e:
-                    failed_rows.append(row)
+            for row, result in writer:
+                if isinstance(result, EnvironmentError):
                     filename = model.taginfo[row][PATH]
-                    m = rename_error_msg(e, filename)
+                    m = rename_error_msg(result, filename)
                     if row == rows[-1]:
                         yield m, 1
                     else:
                         yield m, len(rows)
+                else:
+                    yield None
 
         def finished():
+            #If writing was cancelled or stopped after an error, the rows
+            #still being written are finished here, so that their undo
+            #entries and library updates are part of this write.
+            writer.close()
             self.__updateDirs = True
             self.updateDirs([])
             if previews and failed_rows[1:]:
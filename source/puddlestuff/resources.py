@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Registers puddletag's Qt resources (icons, default menus, actions...).
+
+They're loaded from the binary resource file, puddletag.rcc, which Qt maps
+straight from disk. If it doesn't exist, the module generated by pyrcc4
+(resource.py) is imported instead.
+
+Both are built from resourec.qrc. Run update_resources.py after
+regenerating resource.py to update puddletag.rcc."""
+
+import logging
+import os
+
+from PyQt4.QtCore import QResource
+
+RCC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'puddletag.rcc')
+
+def load_resources(filename=RCC_PATH):
+    """Registers the resources in filename. Returns True if they were
+    read from it, False if resource.py had to be used."""
+    if os.path.exists(filename) and QResource.registerResource(filename):
+        return True
+    logging.debug(u'Could not load %s. Using resource.py.', filename)
+    import puddlestuff.resource
+    return False
+
+loaded_from_rcc = load_resources()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Totals for the files selected in the file-view.
+
+SelectionStats is updated as files are selected and deselected, so that
+what's shown for the selection (the status bar, the Tag Panel, the
+Artwork panel...) doesn't have to go through all the selected files every
+time the selection changes.
+
+>>>stats = SelectionStats()
+>>>stats.setFiles(selected_files)
+>>>stats.size, stats.length, stats.values('artist')
+(52428800, 3600, {u'Artist': 9, u'': 1})
+>>>stats.invalidate([edited_file]) #Recalculated when next read."""
+
+import hashlib
+
+from itertools import izip
+
+from puddlestuff.audioinfo import DATA, MIMETYPE, DESCRIPTION, IMAGETYPE
+from puddlestuff.audioinfo import lnglength
+from puddlestuff.constants import SEPARATOR
+
+#Indexes of the values kept for each selected file.
+AUDIO, SIZE, LENGTH, VALUES, IMAGETAGS, IMAGES = range(6)
+
+#Image key of a file that hasn't been calculated yet.
+_UNSET = object()
+
+def to_text(value):
+    """Returns value as it's shown in the Tag Panel."""
+    if isinstance(value, basestring):
+        return value
+    return SEPARATOR.join(value)
+
+def image_key(audio):
+    """Returns a key that's equal for files with the same images or None
+    if audio has no images. The image data's loaded to calculate it."""
+    if not getattr(audio, 'IMAGETAGS', None):
+        return None
+    images = audio.images
+    if not images:
+        return None
+    return tuple((hashlib.md5(image.get(DATA, '')).digest(),
+        image.get(MIMETYPE), image.get(DESCRIPTION), image.get(IMAGETYPE))
+        for image in images)
+
+class SelectionStats(object):
+    """Keeps the number of selected files, their total size and length,
+    how many times each value of each field occurs and which image tags
+    they support.
+
+    Only the files added or removed by setFiles are looked at. Files whose
+    tags change must be passed to invalidate."""
+
+    def __init__(self):
+        object.__init__(self)
+        self.clear()
+
+    def clear(self):
+        #id(audio): [audio, size, length, {field: text}, imagetags, image key]
+        self._files = {}
+        self._dirty = set()
+        #field: {text: number of files}
+        self._values = {}
+        #image tag: number of files
+        self._imagetags = {}
+        self._size = 0
+        self._length = 0
+        self.first = None
+
+    def __len__(self):
+        return len(self._files)
+
+    def __nonzero__(self):
+        return bool(self._files)
+
+    def setFiles(self, audios):
+        """Sets the selected files to the list, audios. Only files that
+        weren't previously selected are read."""
+        files = self._files
+        keys = map(id, audios)
+        selected = set(keys)
+        removed = [key for key in files if key not in selected]
+        if removed:
+            for key in removed:
+                self._remove(files.pop(key))
+            self._dirty.intersection_update(files)
+        if len(files) < len(selected):
+            for key, audio in izip(keys, audios):
+                if key not in files:
+                    files[key] = self._add(audio)
+        self.first = audios[0] if audios else None
+
+    def invalidate(self, audios=None):
+        """Marks the tags of audios (all the files if None) as changed.
+        They're read again the next time a total's needed."""
+        if audios is None:
+            self._dirty.update(self._files)
+            return
+        files = self._files
+        self._dirty.update(key for key in (id(audio) for audio in audios)
+            if key in files)
+
+    def _update(self):
+        if not self._dirty:
+            return
+        files = self._files
+        for key in self._dirty:
+            entry = files[key]
+            self._remove(entry)
+            files[key] = self._add(entry[AUDIO])
+        self._dirty.clear()
+
+    def _add(self, audio):
+        values = dict((field, to_text(value)) for field, value
+            in audio.usertags.iteritems())
+        imagetags = tuple(getattr(audio, 'IMAGETAGS', ()))
+        entry = [audio, int(audio.size), lnglength(audio.length), values,
+            imagetags, _UNSET]
+
+        self._size += entry[SIZE]
+        self._length += entry[LENGTH]
+        counts = self._values
+        for field, text in values.iteritems():
+            try:
+                field_counts = counts[field]
+            except KeyError:
+                field_counts = counts[field] = {}
+            field_counts[text] = field_counts.get(text, 0) + 1
+        counts = self._imagetags
+        for tag in imagetags:
+            counts[tag] = counts.get(tag, 0) + 1
+        return entry
+
+    def _remove(self, entry):
+        self._size -= entry[SIZE]
+        self._length -= entry[LENGTH]
+        counts = self._values
+        for field, text in entry[VALUES].iteritems():
+            field_counts = counts[field]
+            if field_counts[text] > 1:
+                field_counts[text] -= 1
+            else:
+                del(field_counts[text])
+                if not field_counts:
+                    del(counts[field])
+        counts = self._imagetags
+        for tag in entry[IMAGETAGS]:
+            if counts[tag] > 1:
+                counts[tag] -= 1
+            else:
+                del(counts[tag])
+
+    def _getSize(self):
+        self._update()
+        return self._size
+
+    size = property(_getSize, doc='Total size of the files in bytes.')
+
+    def _getLength(self):
+        self._update()
+        return self._length
+
+    length = property(_getLength, doc='Total length of the files in seconds.')
+
+    def values(self, field):
+        """Returns a dictionary with the values of field (as shown in the
+        Tag Panel) as keys and the number of files with that value as
+        values. Files without field are counted as u''.
+
+        Only editable fields are kept. The values of others (eg.
+        __filename) are read from each file."""
+        self._update()
+        if field.startswith('__'):
+            counts = {}
+            for entry in self._files.itervalues():
+                try:
+                    text = to_text(entry[AUDIO][field])
+                except KeyError:
+                    continue
+                counts[text] = counts.get(text, 0) + 1
+        else:
+            counts = dict(self._values.get(field, {}))
+        missing = len(self._files) - sum(counts.itervalues())
+        if missing:
+            counts[u''] = counts.get(u'', 0) + missing
+        return counts
+
+    def imagetags(self):
+        """Returns the union of the image tags of the files."""
+        self._update()
+        return set(self._imagetags)
+
+    def images(self):
+        """Like audioinfo.commonimages, returns the images of the files if
+        they're all equal, 0 if they aren't and None if none of the
+        files have images.
+
+        The images of each file are compared using a digest that's kept
+        until the file's deselected or invalidated."""
+        self._update()
+        first = key = _UNSET
+        for entry in self._files.itervalues():
+            if entry[IMAGES] is _UNSET:
+                entry[IMAGES] = image_key(entry[AUDIO])
+            if key is _UNSET:
+                first, key = entry[AUDIO], entry[IMAGES]
+            elif entry[IMAGES] != key:
+                return 0
+        if key is _UNSET or key is None:
+            return None
+        return first.images
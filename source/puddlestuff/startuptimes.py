@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Records how long each stage of puddletag's startup takes.
+
+>>>mark('Loaded plugins')
+>>>mark('Created main window')
+>>>print report()"""
+
+import logging
+import time
+
+from puddlestuff import profiling
+
+#Time this module was imported, ie. roughly when puddletag was started.
+START = time.time()
+
+_marks = []
+
+def mark(stage):
+    """Records that stage has just finished."""
+    _marks.append((stage, time.time()))
+    profiling.instant(stage)
+
+def marks():
+    """Returns a list of (stage, seconds it took, seconds since start)."""
+    ret = []
+    last = START
+    for stage, t in _marks:
+        ret.append((stage, t - last, t - START))
+        last = t
+    return ret
+
+def report():
+    lines = [u'Startup times (seconds):']
+    for stage, duration, total in marks():
+        lines.append(u'%7.3f %7.3f  %s' % (duration, total, stage))
+    return u'\n'.join(lines)
+
+def log_report(level=logging.DEBUG):
+    logging.log(level, report())
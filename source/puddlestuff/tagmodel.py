@@ -2,7 +2,7 @@
 
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
-import sys,os, audioinfo, resource, pdb
+import sys,os, audioinfo, resources, pdb
 from operator import itemgetter
 from copy import copy, deepcopy
 from subprocess import Popen
@@ -11,23 +11,28 @@ import audioinfo
 from audioinfo import (PATH, FILENAME, DIRPATH, EXTENSION,
     usertags, setmodtime, FILETAGS, READONLY, INFOTAGS, DIRNAME,
     EXTENSION, CaselessDict)
-from puddleobjects import (unique, safe_name, partial, natcasecmp, gettag,
-    HeaderSetting, getfiles, ProgressWin, PuddleStatus, PuddleThread, 
+from puddleobjects import (unique, safe_name, partial, natcasekey, gettag,
+    HeaderSetting, scanfiles, ProgressWin, PuddleStatus, PuddleThread, 
     progress, PuddleConfig, singleerror, winsettings, issubfolder,
-    timemethod, encode_fn, decode_fn, fnmatch)
+    encode_fn, decode_fn, fnmatch)
 from musiclib import MusicLibError
 import time, re
 from errno import EEXIST
 import traceback
 from itertools import izip
-from collections import defaultdict
-from util import write, rename_file, real_filetags, to_string
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+from util import write, rename_file, real_filetags, to_string, RenameLocks
 from constants import SELECTIONCHANGED, SEPARATOR, BLANK
 import puddlestuff.confirmations as confirmations
 import logging, shutil
 from puddlestuff.translations import translate
 from puddlestuff.util import rename_error_msg
-from puddlestuff.audio_filter import parse as filter_audio
+from puddlestuff.audio_filter import compile_filter
+from puddlestuff.audioinfo.parallel import parse_files, cpu_count
+from puddlestuff.undojournal import UndoJournal
+from puddlestuff import profiling
+from puddlestuff.selectionstats import SelectionStats
 
 the_break = False
 
@@ -40,6 +45,12 @@ HIGHLIGHTCOLOR = Qt.green
 SHIFT_RETURN = 2
 RETURN_ONLY = 1
 
+#Number of rows whose rendered cells are kept by TagModel.data.
+RENDER_CACHE_ROWS = 4096
+
+#Font flags of a cell (see TagModel.data).
+FONT_NORMAL, FONT_BOLD, FONT_ITALIC = range(3)
+
 def _default_audio_player():
     if sys.platform.startswith("linux"):
         return u'xdg-open'
@@ -134,6 +145,15 @@ def has_previews(tags=None, parent=None, msg=None):
             return True
     return False
 
+def sort_key(fields):
+    """Returns a key function for sorting files by fields.
+
+    Sorting with it is equivalent to sorting by each field in turn
+    using natcasecmp, ie. the last field is the primary one."""
+    fields = fields[::-1]
+    return lambda audio: [natcasekey(audio.get(field, u''))
+        for field in fields]
+
 def tag_in_file(tag, audio):
     if tag in audio:
         return tag
@@ -283,34 +303,12 @@ def model_tag(model, base = audioinfo.AbstractTag):
     return ModelTag
 
 def _Tag(model):
-    splitext = path.splitext
-    extensions = audioinfo.extensions
-
     options = [[Kind[0], model_tag(model, Kind[1]), Kind[2]] for Kind
         in audioinfo.options]
     filetypes = dict([(z[0],z) for z in options])
-    extensions = dict([(k, filetypes[v[0]]) for k, v in extensions.items()])
-    
-    def ReplacementTag(filename):
-        fileobj = file(filename, "rb")
-        ext = splitext(filename)[1][1:]
-        try:
-            return extensions[ext][1](filename)
-        except KeyError:
-            pass
-
-        try:
-            header = fileobj.read(128)
-            results = [Kind[0].score(filename, fileobj, header) for Kind in options]
-        finally:
-            fileobj.close()
-        results = zip(results, options)
-        results.sort()
-        score, Kind = results[-1]
-
-        if score > 0: return Kind[1](filename)
-        else: return None
-    return ReplacementTag
+    extensions = dict([(k, filetypes[v[0]]) for k, v in
+        audioinfo.extensions.items()])
+    return audioinfo.tag_loader(extensions, options)
 
 class Properties(QDialog):
     def __init__(self, info, parent=None):
@@ -481,10 +479,20 @@ class TagModel(QAbstractTableModel):
         status['previewmode'] = False
         self._previewBackground = None
         self._selectionBackground = None
-        self._undo = defaultdict(lambda: {})
-        self._previewUndo = defaultdict(lambda: {})
+        self._undo = UndoJournal()
+        self._previewUndo = UndoJournal()
         self.sortFields = []
         self.reverseSort = True
+        #id(audio): (audio, {field: (text, font flags)}, background)
+        #of rows that have been shown, oldest first.
+        self._rendered = OrderedDict()
+        #font flags: QVariant(QFont)
+        self._fonts = {}
+        #True while dataChanged is emitted for a change in colours or fonts.
+        self._restyling = False
+        self.connect(self, SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
+            self._dataChanged)
+        self.connect(self, SIGNAL('filesChanged'), self.clearRenderCache)
 
         if taginfo is not None:
             self.taginfo = unique(taginfo)
@@ -505,10 +513,10 @@ class TagModel(QAbstractTableModel):
 
     def _setFontSize(self, size):
         self._fontSize = size
+        self._fonts = {}
         top = self.index(self.rowCount(), 0)
         bottom = self.index(self.rowCount() -1, self.columnCount() -1)
-        self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-            top, bottom)
+        self._restyle(top, bottom)
 
     def _getFontSize(self):
         return self._fontSize
@@ -546,8 +554,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             top = self.index(min(rows), 0)
             bottom = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                top, bottom)
+            self._restyle(top, bottom)
 
     previewBackground = property(_get_pBg, _set_pBg)
 
@@ -572,6 +579,7 @@ class TagModel(QAbstractTableModel):
         else:
             self._savedundolevel = self.undolevel
         self._previewMode = value
+        self.filesChanged()
         status['previewmode'] = value
         self.emit(SIGNAL('previewModeChanged'), value)
 
@@ -586,8 +594,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             top = self.index(min(rows), 0)
             bottom = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                top, bottom)
+            self._restyle(top, bottom)
 
     selectionBackground = property(_get_sBg, _set_sBg)
 
@@ -607,26 +614,62 @@ class TagModel(QAbstractTableModel):
 
     undolevel = property(_getUndoLevel, _setUndoLevel)
 
+    def _getUndoLimit(self):
+        return self._undo.limit
+
+    def _setUndoLimit(self, value):
+        """Sets the number of bytes of undo data kept in memory. Older
+        levels are moved to disk."""
+        self._undo.limit = value
+        self._previewUndo.limit = value
+
+    undoLimit = property(_getUndoLimit, _setUndoLimit)
+
     def _addUndo(self, audio, undo):
         if self.previewMode:
-            self._previewUndo[self.undolevel][audio] = undo
+            self._previewUndo.add(self.undolevel, audio, undo)
         else:
-            self._undo[self.undolevel][audio] = undo
+            self._undo.add(self.undolevel, audio, undo)
 
     def applyFilter(self, pattern=None, matchcase=True):
-        self.taginfo = self.taginfo + self._filtered
-        taginfo = self.taginfo
         if (not pattern) and (not self._filtered):
             return
         elif not pattern:
+            taginfo = self.taginfo + self._filtered
             self._filtered = []
-            self.reset()
+            self._changeLayout(taginfo)
+            self.emit(SIGNAL('modelReset'))
             return
+        self.taginfo = self.taginfo + self._filtered
 
-        filtered = [(filter_audio(a, pattern), a) for a in self.taginfo]
+        matches = compile_filter(pattern)
+        filtered = [(matches(a), a) for a in self.taginfo]
         self._filtered = [z[1] for z in filtered if not z[0]]
-        self.taginfo = [z[1] for z in filtered if z[0]]
-        self.reset()
+        self._changeLayout([z[1] for z in filtered if z[0]])
+        self.emit(SIGNAL('modelReset'))
+
+    def _changeLayout(self, taginfo):
+        """Replaces self.taginfo with taginfo, a reordered or filtered
+        version of it, without resetting the model.
+
+        Persistent indexes (eg. the selection) are moved to the new rows
+        of their files or invalidated if a file's no longer shown."""
+        self.emit(SIGNAL('layoutAboutToBeChanged()'))
+        old_taginfo = self.taginfo
+        self.taginfo = taginfo
+
+        old_indexes = self.persistentIndexList()
+        if old_indexes:
+            rows = dict((id(audio), row) for row, audio in enumerate(taginfo))
+            new_indexes = []
+            for index in old_indexes:
+                row = rows.get(id(old_taginfo[index.row()]))
+                if row is None:
+                    new_indexes.append(QModelIndex())
+                else:
+                    new_indexes.append(self.index(row, index.column()))
+            self.changePersistentIndexList(old_indexes, new_indexes)
+        self.emit(SIGNAL('layoutChanged()'))
 
     def changeFolder(self, olddir, newdir):
         """Used for changing the directory of all the files in olddir to newdir.
@@ -665,7 +708,103 @@ class TagModel(QAbstractTableModel):
             except TypeError:
                 return unicode(val)
 
+    def clearRenderCache(self, audios=None):
+        """Removes the rendered cells of audios (all rows if None)
+        from the cache used by data."""
+        if audios is None:
+            self._rendered.clear()
+            return
+        pop = self._rendered.pop
+        for audio in audios:
+            pop(id(audio), None)
+
+    def filesChanged(self, audios=None):
+        """Marks the tags of audios (all files if None) as changed, for
+        changes that don't emit dataChanged. Should be called after
+        they've changed.
+
+        Emits filesChanged. The render cache is cleared by the slot
+        connected to it, which is queued to the GUI thread if this is
+        called from another one (eg. while writing), since data only
+        uses the cache from the GUI thread."""
+        self.emit(SIGNAL('filesChanged'), audios)
+
+    def _restyle(self, top, bottom):
+        """Emits dataChanged for rows whose colours or font changed,
+        but not their tags."""
+        self._restyling = True
+        try:
+            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
+                top, bottom)
+        finally:
+            self._restyling = False
+
+    def _dataChanged(self, top, bottom):
+        if not (top.isValid() and bottom.isValid()) or \
+            bottom.row() - top.row() >= RENDER_CACHE_ROWS:
+            audios = None
+        else:
+            audios = self.taginfo[top.row(): bottom.row() + 1]
+        if self._restyling:
+            self.clearRenderCache(audios)
+        else:
+            self.filesChanged(audios)
+
+    def _row(self, audio):
+        try:
+            return self._rendered[id(audio)]
+        except KeyError:
+            pass
+        color = getattr(audio, 'color', None)
+        if color:
+            background = QVariant(color)
+        elif self.previewMode and audio.preview:
+            background = QVariant(self.previewBackground)
+        else:
+            background = QVariant()
+        row = self._rendered[id(audio)] = (audio, {}, background)
+        if len(self._rendered) > RENDER_CACHE_ROWS:
+            self._rendered.popitem(False)
+        return row
+
+    def _cell(self, audio, field):
+        """Returns (text shown, font flags) for field of audio.
+        text is None if audio doesn't have field."""
+        cells = self._row(audio)[1]
+        if field in cells:
+            return cells[field]
+
+        try:
+            text = self._toString(audio[field])
+        except (KeyError, IndexError):
+            text = None
+
+        flags = FONT_NORMAL
+        if field in audio.preview:
+            real = self._toString(audio.realvalue(field, u''))
+            if (text or u'') != real:
+                flags = FONT_BOLD
+            else:
+                flags = FONT_ITALIC
+        cells[field] = (text, flags)
+        return text, flags
+
+    def _font(self, flags):
+        try:
+            return self._fonts[flags]
+        except KeyError:
+            pass
+        f = QFont()
+        if f.pointSize() != self.fontSize:
+            f.setPointSize(self.fontSize)
+        f.setBold(flags == FONT_BOLD)
+        f.setItalic(flags == FONT_ITALIC)
+        self._fonts[flags] = QVariant(f)
+        return self._fonts[flags]
+
     def data(self, index, role=Qt.DisplayRole):
+        """The text, font and background of each cell are cached per row
+        until the row changes. See clearRenderCache."""
         row = index.row()
         if not index.isValid() or not (0 <= row < len(self.taginfo)):
             return QVariant()
@@ -674,8 +813,10 @@ class TagModel(QAbstractTableModel):
             try:
                 audio = self.taginfo[row]
                 tag = self.headerdata[index.column()][1]
-                val = self._toString(audio[tag])
-            except (KeyError, IndexError):
+            except IndexError:
+                return QVariant()
+            val = self._cell(audio, tag)[0]
+            if val is None:
                 return QVariant()
 
             if role == Qt.ToolTipRole:
@@ -698,25 +839,10 @@ class TagModel(QAbstractTableModel):
                 return QVariant(QString(tooltip))
             return QVariant(val)
         elif role == Qt.BackgroundColorRole:
-            audio = self.taginfo[row]
-            if audio.color:
-                return QVariant(audio.color)
-            elif self.previewMode and audio.preview:
-                return QVariant(self.previewBackground)
+            return self._row(self.taginfo[row])[2]
         elif role == Qt.FontRole:
-            
             field = self.headerdata[index.column()][1]
-            f = QFont()
-            if f.pointSize() != self.fontSize:
-                f.setPointSize(self.fontSize)
-            audio = self.taginfo[row]
-            if field in audio.preview:
-                real = audio.realvalue(field, u'')
-                if self._toString(audio[field]) != self._toString(real):
-                    f.setBold(True)
-                else:
-                    f.setItalic(True)
-            return QVariant(f)
+            return self._font(self._cell(self.taginfo[row], field)[1])
         return QVariant()
 
     def deleteTag(self, row=None, audio=None, delete=True):
@@ -727,9 +853,12 @@ class TagModel(QAbstractTableModel):
             tags['__image'] = audio['__image']
         except KeyError:
             pass
+        #Added before deleting so that lazily loaded images are
+        #read while they're still in the file.
+        self._addUndo(audio, tags)
         if delete:
             audio.delete()
-        self._addUndo(audio, tags)
+        self.filesChanged([audio])
 
     def deleteTags(self, rows):
         [self.deleteTag(row) for row in rows]
@@ -780,8 +909,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             top = self.index(min(rows), 0)
             bottom = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                top, bottom)
+            self._restyle(top, bottom)
 
     def insertColumns(self, column, count, parent = QModelIndex(), data=None):
         self.beginInsertColumns (parent, column, column + count)
@@ -837,11 +965,10 @@ class TagModel(QAbstractTableModel):
                 z.library = None
 
         if append:
-            for field in self.sortFields:
-                getter = lambda audio: audio.get(field, u'')
-                taginfo.sort(natcasecmp, getter, self.reverseSort)
+            taginfo.sort(key=sort_key(self.sortFields),
+                reverse=self.reverseSort)
 
-            filenames = [z.filepath for z in self.taginfo]
+            filenames = set(z.filepath for z in self.taginfo)
             self.taginfo.extend([z for z in taginfo if z.filepath
                 not in filenames])
 
@@ -911,8 +1038,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             top = self.index(min(rows), 0)
             bottom = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                top, bottom)
+            self._restyle(top, bottom)
     
     def setColors(self, tags):
         for f in self._colored:
@@ -929,8 +1055,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             top = self.index(min(rows), 0)
             bottom = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                top, bottom)
+            self._restyle(top, bottom)
         self._colored = tags
 
     def removeColumns(self, column, count, parent = QModelIndex()):
@@ -969,8 +1094,10 @@ class TagModel(QAbstractTableModel):
         #of files currently in the model then the TableView isn't updated.
         #Why the fuck I don't know, but this signal, intercepted by the table,
         #updates the view and makes everything work okay.
-        self.emit(SIGNAL('modelReset'))
-        QAbstractTableModel.reset(self)
+        self.filesChanged()
+        with profiling.timer('TagModel.reset'):
+            self.emit(SIGNAL('modelReset'))
+            QAbstractTableModel.reset(self)
 
     def rowColors(self, rows = None, clear=False):
         """Changes the background of rows to green.
@@ -998,8 +1125,7 @@ class TagModel(QAbstractTableModel):
         if rows:
             firstindex = self.index(min(rows), 0)
             lastindex = self.index(max(rows), self.columnCount() - 1)
-            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
-                firstindex, lastindex)
+            self._restyle(firstindex, lastindex)
 
     def rowCount(self, index = QModelIndex()):
         return len(self.taginfo)
@@ -1072,6 +1198,7 @@ class TagModel(QAbstractTableModel):
             undo_val = dict([(tag, copy(audio[tag])) if tag in audio
                 else (tag, []) for tag in tags])
             audio.update(tags)
+            self.filesChanged([audio])
             if undo:
                 if audio._temp:
                     undo_val.update(audio._temp)
@@ -1079,21 +1206,126 @@ class TagModel(QAbstractTableModel):
                 self._addUndo(audio, undo_val)
             return
         else:
-            artist = audio.get('artist', u'')
-            undo_val = write(audio, tags, self.saveModification, justrename)
-            if undo and undo_val:
-                self._addUndo(audio, undo_val)
-
-            if DIRNAME in tags or DIRPATH in tags:
-                self.changeFolder(oldpath, audio.dirpath)
-                self.emit(SIGNAL('dirsmoved'),
-                    [[oldpath, audio.dirpath]])
-            if justrename and audio.library:
-                audio.save(True)
-            ret = (artist, tags)
+            try:
+                written = self._writeRow(audio, tags, justrename)
+            finally:
+                self.filesChanged([audio])
+            ret = self._finishRow(audio, tags, written, undo, justrename)
 
         return ret
 
+    def _writeRow(self, audio, tags, justrename=False, rename_lock=None):
+        """Writes tags to the file of audio.
+
+        Only touches audio, so can be run in another thread. The
+        returned value is passed to _finishRow."""
+        artist = audio.get('artist', u'')
+        oldpath = audio.dirpath
+        undo_val = write(audio, tags, self.saveModification, justrename,
+            rename_lock)
+        return artist, oldpath, undo_val
+
+    def _finishRow(self, audio, tags, written, undo=False, justrename=False):
+        artist, oldpath, undo_val = written
+        if undo and undo_val:
+            self._addUndo(audio, undo_val)
+
+        if DIRNAME in tags or DIRPATH in tags:
+            self.changeFolder(oldpath, audio.dirpath)
+            self.emit(SIGNAL('dirsmoved'),
+                [[oldpath, audio.dirpath]])
+        if justrename and audio.library:
+            audio.save(True)
+        return (artist, tags)
+
+    def writeRows(self, rows, tagiter, undo=True, finished=None,
+        workers=None):
+        """Generator that writes the tags in tagiter to rows, like
+        setRowData, using workers threads (defaults to the number of CPUs).
+
+        Yields (row, result) in the order of rows, where result is
+        the value setRowData returns or the EnvironmentError raised
+        while writing the row. Undo entries are added in the same order.
+
+        Renames in the same directory are done one at a time. Rows that
+        move directories or belong to the library are written after
+        the preceding rows finished.
+
+        If the generator is closed early, rows being written are
+        finished but not yielded. finished(row, result) is called
+        for every row that was written, including those. Callers that
+        stop iterating should close it before adding the next undo level,
+        since otherwise that's done whenever it's garbage collected."""
+        taginfo = self.taginfo
+
+        if self.previewMode:
+            for row, tags in izip(rows, tagiter):
+                ret = self.setRowData(row, tags, undo=undo)
+                if finished is not None:
+                    finished(row, ret)
+                yield row, ret
+            return
+
+        if workers is None:
+            workers = cpu_count()
+        workers = max(workers, 1)
+
+        cancelled = []
+        rename_lock = RenameLocks()
+        def write_row(audio, tags):
+            if cancelled:
+                return
+            try:
+                return self._writeRow(audio, tags, False, rename_lock)
+            except EnvironmentError, e:
+                return e
+
+        def finish(row, audio, tags, written):
+            if written is not None and \
+                not isinstance(written, EnvironmentError):
+                try:
+                    written = self._finishRow(audio, tags, written, undo)
+                except EnvironmentError, e:
+                    written = e
+            self.filesChanged([audio])
+            if finished is not None:
+                finished(row, written)
+            return row, written
+
+        pool = ThreadPool(workers)
+        pending = deque()
+        try:
+            for row, tags in izip(rows, tagiter):
+                audio = taginfo[row]
+                if audio.library or DIRNAME in tags or DIRPATH in tags:
+                    while pending:
+                        row_, audio_, tags_, result = pending.popleft()
+                        yield finish(row_, audio_, tags_, result.get())
+                    try:
+                        written = self._writeRow(audio, tags)
+                    except EnvironmentError, e:
+                        written = e
+                    yield finish(row, audio, tags, written)
+                    continue
+
+                pending.append((row, audio, tags,
+                    pool.apply_async(write_row, (audio, tags))))
+                if len(pending) > workers * 2:
+                    row_, audio_, tags_, result = pending.popleft()
+                    yield finish(row_, audio_, tags_, result.get())
+
+            while pending:
+                row, audio, tags, result = pending.popleft()
+                yield finish(row, audio, tags, result.get())
+        finally:
+            cancelled.append(True)
+            while pending:
+                row, audio, tags, result = pending.popleft()
+                written = result.get()
+                if written is not None:
+                    finish(row, audio, tags, written)
+            pool.terminate()
+
     def setTestData(self, rows, previews=None):
         """A method that allows you to change the visible data of
         the model without writing tags.
@@ -1152,20 +1384,18 @@ class TagModel(QAbstractTableModel):
         elif reverse is None:
             reverse = False
 
+        key = sort_key(fields)
         if files and rows:
-            for field in fields:
-                f = lambda audio: audio.get(field, u'')
-                files.sort(natcasecmp, f, reverse)
+            files.sort(key=key, reverse=reverse)
+            taginfo = self.taginfo[::]
             for index, row in enumerate(rows):
-                self.taginfo[row] = files[index]
+                taginfo[row] = files[index]
         else:
-            for field in fields:
-                f = lambda audio: audio.get(field, u'')
-                self.taginfo.sort(natcasecmp, f, reverse)                
+            taginfo = sorted(self.taginfo, key=key, reverse=reverse)
 
         self.reverseSort = reverse
         self.sortFields = fields
-        self.reset()
+        self._changeLayout(taginfo)
         self.emit(SIGNAL('sorted'))
 
     def supportedDropActions(self):
@@ -1198,7 +1428,7 @@ class TagModel(QAbstractTableModel):
 
         get_row = self.taginfo.index
 
-        for audio, undo_tags in undo[level].items():
+        for audio, undo_tags in undo.pop(level):
             row = get_row(audio)
             rows.append(row)
             if self.previewMode:
@@ -1211,7 +1441,6 @@ class TagModel(QAbstractTableModel):
                     oldfiles.append(deepcopy(audio.tags))
                 edited.append(self.setRowData(row, undo_tags, False))
 
-        del(undo[level])
         if rows:
             self.updateTable(rows)
             if edited:
@@ -1357,6 +1586,7 @@ class TagTable(QTableView):
         self._restore = False
         self._selectedRows = []
         self._selectedColumns = []
+        self.selectionStats = SelectionStats()
         self._select = True
         self._playlist = False
         self.filespec = ''
@@ -1379,6 +1609,7 @@ class TagTable(QTableView):
         self.setItemDelegate(delegate)
             
         self.subFolders = False
+        self.loadProcesses = 0
 
         def sep():
             separator = QAction(self)
@@ -1415,6 +1646,7 @@ class TagTable(QTableView):
         status['firstselection'] = self._firstSelection
         status['selectedcolumns'] = self._getSelectedColumns
         status['selectedtags'] = self._getSelectedTags
+        status['selectionstats'] = self.selectionStats
         status['alltags'] = lambda: self.model().taginfo
         status['allfiles'] = lambda: self.model().taginfo
         status['table'] = self
@@ -1853,16 +2085,17 @@ class TagTable(QTableView):
                 filenames = files
             else:
                 filenames = []
-            for fname in getfiles(dirs, subfolders):
-                filenames.append(fname)
-                yield reading_dir
-
             if self.filespec and self.filespec.strip():
                 filenames = fnmatch(self.filespec, filenames)
 
+            for fname in scanfiles(dirs, subfolders, audioinfo.extensions,
+                self.filespec):
+                filenames.append(fname)
+                yield reading_dir
+
             yield len(filenames)
 
-            for fname in filenames:
+            for fname in parse_files(filenames, self.loadProcesses):
                 tag = gettag(fname)
                 if tag is not None:
                     tags.append(tag)
@@ -1911,6 +2144,7 @@ class TagTable(QTableView):
             self.verticalHeader().setDefaultSectionSize(rowsize)
 
         cparser = PuddleConfig()
+        self.loadProcesses = cparser.get('table', 'load_processes', 0)
         preview_color = cparser.get('table', 'preview_color', [192, 255, 192], True)
         default = QPalette().color(QPalette.Mid).getRgb()[:-1]
         selection_color = cparser.get('table', 'selected_color', default, True)
@@ -1919,6 +2153,8 @@ class TagTable(QTableView):
 
         model.previewBackground = QColor.fromRgb(*preview_color)
         model.selectionBackground = QColor.fromRgb(*selection_color)
+        model.undoLimit = cparser.get('table', 'undo_memory_mb',
+            64, True) * 1024 ** 2
 
         sort_fields = cparser.get('table', 'sort_fields', [])
         reverse = cparser.get('table', 'sort_reverse', False, True)
@@ -2096,6 +2332,7 @@ class TagTable(QTableView):
         self.connect(model, SIGNAL('modelReset'), self.selectionChanged)
         self.connect(model, SETDATAERROR, self.writeError)
         self.connect(model, SIGNAL('fileChanged()'), self.selectionChanged)
+        self.connect(model, SIGNAL('filesChanged'), self._filesChanged)
         self.connect(model, SIGNAL('aboutToSort'), self.saveBeforeReset)
         self.connect(model, SIGNAL('sorted'), self.restoreSort)
         self.connect(model, SIGNAL('previewModeChanged'), 
@@ -2164,7 +2401,6 @@ class TagTable(QTableView):
 
         I've set selected an deselected as None, because I sometimes
         want self.selectedRows updated without hassle."""
-        t = time.time()
         if selected is not None and deselected is not None:
             QTableView.selectionChanged(self, selected, deselected)
         taginfo = self.model().taginfo
@@ -2172,12 +2408,23 @@ class TagTable(QTableView):
 
         selectedRows = set()
         selectedColumns = set()
+        isColumnHidden = self.isColumnHidden
         
-        for z in self.selectedIndexes():
-            selectedRows.add(z.row())
-            selectedColumns.add(z.column())
-        self.selectedRows = sorted(list(selectedRows))
-        self.selectedColumns = sorted(list(selectedColumns))
+        #Going through the ranges instead of selectedIndexes, which
+        #creates an index for every selected cell.
+        for selrange in self.selectionModel().selection():
+            columns = [column for column in
+                xrange(selrange.left(), selrange.right() + 1)
+                if not isColumnHidden(column)]
+            if columns:
+                selectedRows.update(xrange(selrange.top(),
+                    selrange.bottom() + 1))
+                selectedColumns.update(columns)
+        self.selectedRows = sorted(row for row in selectedRows
+            if row < len(taginfo))
+        self.selectedColumns = sorted(selectedColumns)
+        self.selectionStats.setFiles([taginfo[row] for row in
+            self.selectedRows])
 
         if self._select:
             self.emit(SIGNAL('itemSelectionChanged()'))
@@ -2188,6 +2435,9 @@ class TagTable(QTableView):
             model.highlight(self.selectedRows)
             self.emit(SIGNAL(SELECTIONCHANGED))
 
+    def _filesChanged(self, audios):
+        self.selectionStats.invalidate(audios)
+
     def saveBeforeReset(self):
         self.setCursor(Qt.BusyCursor)
         self._savedSelection = self.saveSelection()
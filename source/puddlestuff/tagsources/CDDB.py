@@ -8,6 +8,9 @@
 # CVS ID: $Id: CDDB.py,v 1.8 2003/08/31 23:18:43 che_fox Exp $
 
 import urllib, string, socket, os, struct, re
+from cStringIO import StringIO
+
+from puddlestuff import tagsources
 
 name = 'CDDB.py'
 version = 1.4
@@ -22,6 +25,9 @@ else:
 proto = 5
 default_server = 'http://freedb.freedb.org/~cddb/cddb.cgi'
 
+def urlopen(url):
+    return StringIO(tagsources.urlopen(url))
+
 def query(track_info, server_url=default_server,
 	  user=default_user, host=hostname, client_name=name,
           client_version=version):
@@ -40,7 +46,7 @@ def query(track_info, server_url=default_server,
 	  (server_url, query_str, user, host, client_name,
            client_version, proto)
 
-    response = urllib.urlopen(url)
+    response = urlopen(url)
     
     # Four elements in header: status, category, disc-id, title
     header = string.split(string.rstrip(response.readline()), ' ', 3)
@@ -82,7 +88,7 @@ def read(category, disc_id, server_url=default_server,
 	  (server_url, category, disc_id, user, host, client_name,
            client_version, proto)
 
-    response = urllib.urlopen(url)
+    response = urlopen(url)
     
     header = string.split(string.rstrip(response.readline()), ' ', 3)
 
@@ -4,9 +4,7 @@ import os
 from os.path import join, exists
 import re
 from sgmllib import SGMLParser
-import socket
 import urlparse
-import urllib2
 
 from PyQt4.QtCore import QObject, SIGNAL
 
@@ -15,6 +13,9 @@ from puddlestuff.constants import CONFIGDIR
 from puddlestuff.findfunc import tagtofilename
 from puddlestuff.puddleobjects import PuddleConfig
 from puddlestuff.util import translate
+from puddlestuff.tagsources import webclient
+from puddlestuff.tagsources.webclient import (get_useragent, set_useragent,
+    RequestError)
 
 
 class FoundEncoding(Exception):
@@ -45,7 +46,6 @@ SAVECOVERS = False
 
 mapping = {}
 status_obj = QObject()
-useragent = "puddletag/" + puddlestuff.version_string
 
 
 def get_encoding(page, decode=False, default=None):
@@ -148,18 +148,6 @@ def set_status(msg):
     status_obj.emit(SIGNAL('statusChanged'), msg)
 
 
-def get_useragent():
-    if useragent:
-        return useragent
-    else:
-        return 'puddetag/' + puddlestuff.version_string
-
-
-def set_useragent(agent):
-    global useragent
-    useragent = agent
-
-
 def to_file(data, name):
     if os.path.exists(name):
         return to_file(data, name + '_')
@@ -173,38 +161,24 @@ def url_encode_non_ascii(b):
     return re.sub('[\x80-\xFF]', lambda c: '%%%02x' % ord(c.group(0)), b)
 
 
-def urlopen(url, mask=True, code=False):
+def urlopen(url, mask=True, code=False, cache=True):
+    """Retrieves url using the shared webclient.
+
+    Returns the page's data or (data, status code) if code is True.
+    Raises RetrievalError if the page couldn't be retrieved."""
     try:
-        request = urllib2.Request(url)
-        if useragent:
-            request.add_header('User-Agent', useragent)
-        page = urllib2.build_opener().open(request)
-        if page.code == 403:
-            raise RetrievalError(
-                translate("Tag Sources", 'HTTPError 403: Forbidden'))
-        elif page.code == 404:
-            raise RetrievalError(
-                translate("Tag Sources", "Page doesn't exist"))
-        if code:
-            return page.read(), page.code
-        else:
-            return page.read()
-    except urllib2.URLError as e:
-        try:
-            msg = u'%s (%s)' % (e.reason.strerror, e.reason.errno)
-        except AttributeError:
-            msg = unicode(e)
-        try:
-            raise RetrievalError(msg, e.code)
-        except AttributeError:
-            raise RetrievalError(
-                translate("Defaults", "Connection Error: %s ") % e.args[1])
-    except socket.error as e:
-        msg = u'%s (%s)' % (e.strerror, e.code)
-        raise RetrievalError(msg)
-    except EnvironmentError as e:
-        msg = u'%s (%s)' % (e.strerror, e.code)
-        raise RetrievalError(msg)
+        page = webclient.request(url, cache=cache)
+    except RequestError as e:
+        raise RetrievalError(
+            translate("Defaults", "Connection Error: %s ") % e.args[0])
+
+    if page.code >= 400:
+        raise RetrievalError(
+            u'HTTP Error %d: %s' % (page.code, page.reason), page.code)
+    if code:
+        return page.data, page.code
+    else:
+        return page.data
 
 
 def write_log(text):
@@ -233,12 +207,46 @@ class MetaProcessor(SGMLParser):
                 raise error
 
 
-tagsources = []
-for source in ('acoust_id', 'amazon', 'amg', 'discogs', 'freedb',
-               'musicbrainz'):
-    try:
-        tagsources.append(getattr(
-            import_module('puddlestuff.tagsources.' + source),
-            'info'))
-    except ImportError:
-        pass
+class SourceList(list):
+    """List of the tag sources (the info class of each module).
+
+    The built-in tag sources are listed by module name and imported the
+    first time the list is read. Tag sources added by plugins before
+    that are kept after them."""
+    def __init__(self, modules):
+        list.__init__(self)
+        self._modules = list(modules)
+
+    def load(self):
+        if not self._modules:
+            return
+        modules, self._modules = self._modules, []
+        sources = []
+        for source in modules:
+            try:
+                sources.append(getattr(
+                    import_module('puddlestuff.tagsources.' + source),
+                    'info'))
+            except ImportError:
+                pass
+        list.__setitem__(self, slice(0, 0), sources)
+
+def _loading(name):
+    method = getattr(list, name)
+    def func(self, *args):
+        self.load()
+        return method(self, *args)
+    func.__name__ = name
+    return func
+
+#append and extend are left alone so that plugins can add
+#tag sources without the built-in ones being imported.
+for _name in ('__iter__', '__len__', '__getitem__', '__getslice__',
+    '__contains__', '__reversed__', '__repr__', '__eq__', '__ne__',
+    '__add__', '__setitem__', '__delitem__', '__setslice__',
+    '__delslice__', 'index', 'count', 'insert', 'pop', 'remove',
+    'reverse', 'sort'):
+    setattr(SourceList, _name, _loading(_name))
+
+tagsources = SourceList(('acoust_id', 'amazon', 'amg', 'discogs', 'freedb',
+    'musicbrainz'))
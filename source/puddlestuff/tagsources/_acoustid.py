@@ -35,6 +35,8 @@ import time
 import gzip
 from StringIO import StringIO
 
+from puddlestuff.tagsources import ratelimit
+
 API_BASE_URL = 'http://api.acoustid.org/v2/'
 DEFAULT_META = 'recordings'
 REQUEST_INTERVAL = 0.33 # 3 requests/second.
@@ -85,27 +87,19 @@ class WebServiceError(AcoustidError):
 
 class _rate_limit(object):
     """A decorator that limits the rate at which the function may be
-    called.  The rate is controlled by the REQUEST_INTERVAL module-level
-    constant; set the value to zero to disable rate limiting. The
-    limiting is thread-safe; only one thread may be in the function at a
-    time (acts like a monitor in this sense).
+    called.  The rate is that of the API host's token bucket in
+    puddlestuff.tagsources.ratelimit, which is shared with all other
+    requests to it. Set REQUEST_INTERVAL to zero to disable rate limiting.
     """
     def __init__(self, fun):
         self.fun = fun
-        self.last_call = 0.0
-        self.lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
-        with self.lock:
-            # Wait until request_rate time has passed since last_call,
-            # then update last_call.
-            since_last_call = time.time() - self.last_call
-            if since_last_call < REQUEST_INTERVAL:
-                time.sleep(REQUEST_INTERVAL - since_last_call)
-            self.last_call = time.time()
-
-            # Call the original function.
-            return self.fun(*args, **kwargs)
+        if REQUEST_INTERVAL:
+            ratelimit.wait(API_BASE_URL)
+
+        # Call the original function.
+        return self.fun(*args, **kwargs)
 
 def _compress(data):
     """Compress a string to a gzip archive."""
@@ -1,9 +1,5 @@
-import contextlib
-import httplib
 import logging
 import os, pdb
-import time
-import urllib2
 
 from collections import defaultdict
 from itertools import chain, izip, product, starmap
@@ -19,8 +15,11 @@ except ImportError:
 import puddlestuff.audioinfo as audioinfo
 
 from puddlestuff.audioinfo import stringtags
-from puddlestuff.constants import SPINBOX, TEXT
-from puddlestuff.tagsources import set_status, write_log, SubmissionError
+from puddlestuff.constants import CONFIGDIR, SPINBOX, TEXT
+from puddlestuff.puddleobjects import PuddleConfig
+from puddlestuff.tagsources import (set_status, write_log, SubmissionError,
+    webclient)
+from puddlestuff.tagsources.fingerprints import fingerprint_files
 from puddlestuff.tagsources.musicbrainz import retrieve_album
 from puddlestuff.translations import translate
 from puddlestuff.util import escape_html, isempty, to_string
@@ -37,6 +36,12 @@ FILE_MSG = translate('AcoustID', u'File #%1: %2')
 
 API_KEY = "gT8GJxhO"
 
+cparser = PuddleConfig(os.path.join(CONFIGDIR, 'tagsources.conf'))
+
+#Number of fingerprints sent per lookup and submit request.
+LOOKUP_BATCH = cparser.get('acoustid', 'lookup_batch', 20)
+SUBMIT_BATCH = cparser.get('acoustid', 'submit_batch', 10)
+
 def album_hash(d):
     h = u''
     if u'album' in d:
@@ -104,6 +109,25 @@ def fingerprint_file(fn):
     except TypeError:
         return acoustid._fingerprint_file_fpcalc(fn)
 
+def file_fingerprints(fns):
+    """Generator yielding (found, result) for each of fns.
+
+    found is True if the fingerprint was read from the file's tag.
+    result is (duration, fingerprint) or the exception raised while
+    computing the fingerprint. Fingerprints that aren't in tags are
+    computed in parallel, ahead of being yielded."""
+    in_tags = map(id_in_tag, fns)
+    computed = fingerprint_files([fn.filepath for fn, fp in
+        zip(fns, in_tags) if not fp], fingerprint_file)
+    try:
+        for fp in in_tags:
+            if fp:
+                yield True, fp
+            else:
+                yield False, computed.next()[1]
+    finally:
+        computed.close()
+
 def id_in_tag(tag):
     
     if 'acoustid_fingerprint' in tag:
@@ -118,6 +142,36 @@ def id_in_tag(tag):
 
     return (duration, fp)
 
+def lookup_many(apikey, fingerprints, meta='releases recordings tracks'):
+    """Looks up a list of (duration, fingerprint) pairs in a single
+    request.
+
+    Returns a list containing a response for each fingerprint, in
+    order, that's the same as one returned by acoustid.lookup."""
+    params = {
+        'format': 'json',
+        'client': apikey,
+        'meta': meta,
+        }
+    for i, (duration, fp) in enumerate(fingerprints):
+        params['duration.%d' % i] = int(duration)
+        params['fingerprint.%d' % i] = fp
+
+    data = acoustid._api_request(acoustid._get_lookup_url(), params)
+    if data.get('status') != 'ok':
+        return [data] * len(fingerprints)
+    if 'fingerprints' not in data:
+        return [data] + [{'status': 'ok', 'results': []}] * \
+            (len(fingerprints) - 1)
+
+    ret = [{'status': 'ok', 'results': []} for fp in fingerprints]
+    for result in data['fingerprints']:
+        try:
+            ret[int(result['index'])]['results'] = result.get('results', [])
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+    return ret
+
 def match(apikey, path, fp=None, dur=None, meta='releases recordings tracks'):
     """Look up the metadata for an audio file. If ``parse`` is true,
     then ``parse_lookup_result`` is used to return an iterator over
@@ -255,7 +309,6 @@ class AcoustID(object):
             [translate("AcoustID", 'Minimum Score'), SPINBOX, [0, 100, 80]],
             [translate("AcoustID", "AcoustID Key"), TEXT, u""]
             ]
-        self.__lasttime = time.time()
         acoustid._send_request = self._send_request
         self.__user_key = ""
 
@@ -263,65 +316,83 @@ class AcoustID(object):
         """Given a urllib2 Request object, make the request and return a
         tuple containing the response data and headers.
         """
-        if time.time() - self.__lasttime < 0.4:
-            time.sleep(time.time() - self.__lasttime + 0.1)
         try:
-            with contextlib.closing(urllib2.urlopen(req)) as f:
-                return f.read(), f.info()
-        except urllib2.HTTPError, exc:
-            raise acoustid.WebServiceError('HTTP status %i' % exc.code, exc.read())
-        except httplib.BadStatusLine:
-            raise acoustid.WebServiceError('bad HTTP status line')
-        except IOError:
+            page = webclient.request(req.get_full_url(), req.get_data(),
+                dict(req.header_items()), cache=False)
+        except webclient.RequestError:
             raise acoustid.WebServiceError('connection failed')
+        if page.code >= 400:
+            raise acoustid.WebServiceError('HTTP status %i' % page.code,
+                page.data)
+        return page.data, page.headers
         
+    def _fingerprint_batches(self, fns, size, file_msg=None):
+        """Generator yielding lists of up to size
+        (index, file, (duration, fingerprint)) tuples.
+
+        Files that couldn't be fingerprinted are logged and skipped."""
+        batch = []
+        fingerprints = file_fingerprints(fns)
+        try:
+            for i, (fn, (found, fp)) in enumerate(izip(fns, fingerprints)):
+                try:
+                    disp_fn = audioinfo.decode_fn(fn.filepath)
+                except AttributeError:
+                    disp_fn = fn['__path']
+                if file_msg is None:
+                    write_log(disp_fn)
+                else:
+                    write_log(file_msg.arg(i + 1).arg(disp_fn))
+                write_log(FOUND_ID_MSG if found else CALCULATE_MSG)
+
+                if isinstance(fp, acoustid.FingerprintGenerationError):
+                    write_log(FP_ERROR_MSG.arg(unicode(fp)))
+                    continue
+                elif isinstance(fp, Exception):
+                    raise fp
+
+                batch.append((i, fn, fp))
+                if len(batch) >= size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            fingerprints.close()
+
     def search(self, artist, fns=None):
 
         tracks = []
         albums = []
 
         fns_len = len(fns)
-        for i, fn in enumerate(fns):
-            try:
-                disp_fn = audioinfo.decode_fn(fn.filepath)
-            except AttributeError:
-                disp_fn = fn['__path']
-            write_log(disp_fn)
-            try:
-
-                fp = id_in_tag(fn)
-                if fp:
-                    write_log(FOUND_ID_MSG)
-                    dur, fp = fp
-                else:
-                    write_log(CALCULATE_MSG)
-                    dur, fp = (None, None)
-
-                write_log(RETRIEVE_MSG.arg(i + 1).arg(fns_len))
-                set_status(RETRIEVE_MSG.arg(i + 1).arg(fns_len))
+        batches = self._fingerprint_batches(fns, max(LOOKUP_BATCH, 1))
+        try:
+            for batch in batches:
+                msg = RETRIEVE_MSG.arg(batch[-1][0] + 1).arg(fns_len)
+                write_log(msg)
+                set_status(msg)
 
-                data, fp = match("gT8GJxhO", fn.filepath, fp, dur)
+                responses = lookup_many(API_KEY, [fp for i, fn, fp in batch])
                 write_log(translate('AcoustID', "Parsing Data"))
-                
-                info = parse_lookup_result(data, fp=fp)
-            except acoustid.FingerprintGenerationError, e:
-                write_log(FP_ERROR_MSG.arg(unicode(e)))
-                continue
-            except acoustid.WebServiceError, e:
-                set_status(WEB_ERROR_MSG.arg(unicode(e)))
-                write_log(WEB_ERROR_MSG.arg(unicode(e)))
-                break
-
-            if hasattr(info, 'items'):
-                albums.append([{}])
-                info['#exact'] = fn
-                tracks.append(info)
-            elif info is not None:
-                for album, track in info:
-                    if track and track['#score'] >= self.min_score:
-                        track['#exact'] = fn
-                        tracks.append(track)
-                        albums.append(album if album else [{}])
+
+                for (i, fn, (dur, fp)), data in izip(batch, responses):
+                    info = parse_lookup_result(data, fp=fp)
+                    if hasattr(info, 'items'):
+                        albums.append([{}])
+                        info['#exact'] = fn
+                        tracks.append(info)
+                    elif info is not None:
+                        for album, track in info:
+                            if track and track['#score'] >= self.min_score:
+                                track['#exact'] = fn
+                                tracks.append(track)
+                                albums.append(album if album else [{}])
+        except acoustid.WebServiceError, e:
+            set_status(WEB_ERROR_MSG.arg(unicode(e)))
+            write_log(WEB_ERROR_MSG.arg(unicode(e)))
+        finally:
+            batches.close()
 
         return starmap(retrieve_album_info, best_match(albums, tracks))
 
@@ -331,49 +402,29 @@ class AcoustID(object):
                 "Please enter AcoustID user key in settings."))
 
         fns_len = len(fns)
-        data = []
-        for i, fn in enumerate(fns):
-
-            try:
-                disp_fn = audioinfo.decode_fn(fn.filepath)
-            except AttributeError:
-                disp_fn = fn['__path']
-            write_log(FILE_MSG.arg(i + 1).arg(disp_fn))
-
-            try:
-                fp = id_in_tag(fn)
-                if fp:
-                    write_log(FOUND_ID_MSG)
-                    dur, fp = fp
-                else:
-                    write_log(CALCULATE_MSG)
-                    dur, fp = fingerprint_file(fn.filepath)
-
-                info = {
-                    'duration':unicode(dur),
-                    'fingerprint': unicode(fp),
-                    }
-
-                info.update(convert_for_submit(fn))
-                data.append(info)
-
-                if len(data) > 9 or i == fns_len - 1:
-                    msg = SUBMIT_MSG.arg(i - len(data) + 2)
-                    msg = msg.arg(i + 1).arg(fns_len)
-                    write_log(msg)
-                    set_status(msg)
-                    acoustid.submit(API_KEY, self.__user_key, data)
-                    data = []
-
-            except acoustid.FingerprintGenerationError, e:
-                traceback.print_exc()
-                write_log(FP_ERROR_MSG.arg(unicode(e)))
-                continue
-            except acoustid.WebServiceError, e:
-                traceback.print_exc()
-                set_status(SUBMIT_ERROR_MSG.arg(unicode(e)))
-                write_log(SUBMIT_ERROR_MSG.arg(unicode(e)))
-                break
+        batches = self._fingerprint_batches(fns, max(SUBMIT_BATCH, 1),
+            FILE_MSG)
+        try:
+            for batch in batches:
+                data = []
+                for i, fn, (dur, fp) in batch:
+                    info = {
+                        'duration':unicode(dur),
+                        'fingerprint': unicode(fp),
+                        }
+                    info.update(convert_for_submit(fn))
+                    data.append(info)
+
+                msg = SUBMIT_MSG.arg(batch[0][0] + 1)
+                msg = msg.arg(batch[-1][0] + 1).arg(fns_len)
+                write_log(msg)
+                set_status(msg)
+                acoustid.submit(API_KEY, self.__user_key, data)
+        except acoustid.WebServiceError, e:
+            set_status(SUBMIT_ERROR_MSG.arg(unicode(e)))
+            write_log(SUBMIT_ERROR_MSG.arg(unicode(e)))
+        finally:
+            batches.close()
 
     def retrieve(self, info):
         return None
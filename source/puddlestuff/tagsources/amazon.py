@@ -121,7 +121,8 @@ def keyword_search(keywords):
             'Keywords': keywords,
             'AssociateTag': u'puddletag-20'}
     url = create_aws_url(access_key, secret_key, query_pairs)
-    xml = urlopen(url)
+    #Signed urls are never the same, so they're not worth caching.
+    xml = urlopen(url, cache=False)
     return parse_search_xml(xml)
 
 def parse_album_xml(text, album=None):
@@ -210,7 +211,7 @@ def retrieve_album(info, image=MEDIUMIMAGE):
         write_log(translate('Amazon',
             'Retrieving XML: %1 - %2').arg(
                 info.get('artist', u'')).arg(info.get('album', u'')))
-    xml = urlopen(url)
+    xml = urlopen(url, cache=False)
     
     if isinstance(info, basestring):
         tracks = parse_album_xml(xml)
@@ -1,17 +1,12 @@
 # -*- coding: utf-8 -*-
-import cStringIO
 from copy import deepcopy
-import gzip
 import json
 import re
-import socket
-import time
-import urllib2
 
 from puddlestuff.audioinfo import DATA, isempty
 from puddlestuff.constants import CHECKBOX, COMBO, TEXT
 from puddlestuff.tagsources import (
-    find_id, write_log, RetrievalError, iri_to_uri, get_useragent)
+    find_id, write_log, RetrievalError, iri_to_uri, webclient)
 from puddlestuff.util import translate
 
 R_ID_DEFAULT = 'discogs_id'
@@ -61,13 +56,6 @@ INVALID_KEYS = [
     'series', 'released_formatted', 'identifiers']
 
 
-class LastTime(object):
-    pass
-
-__lasttime = LastTime()
-__lasttime.time = time.time()
-
-
 def convert_dict(d, keys=None):
     if keys is None:
         keys = TRACK_KEYS
@@ -301,35 +289,16 @@ def search(artist=None, album=None):
 
 def urlopen(url):
     url = iri_to_uri(url)
-    request = urllib2.Request(url)
-    request.add_header('Accept-Encoding', 'gzip')
-    request.add_header('User-Agent', get_useragent())
-
-    if time.time() - __lasttime.time < 1:
-        time.sleep(1)
-    __lasttime.time = time.time()
 
     try:
-        data = urllib2.urlopen(request).read()
-    except urllib2.URLError as e:
-        try:
-            msg = u'%s (%s)' % (e.reason.strerror, e.reason.errno)
-        except AttributeError:
-            msg = unicode(e)
-        raise RetrievalError(msg)
-    except socket.error as e:
-        msg = u'%s (%s)' % (e.strerror, e.errno)
-        raise RetrievalError(msg)
-    except EnvironmentError, e:
-        msg = u'%s (%s)' % (e.strerror, e.errno)
-        raise RetrievalError(msg)
+        page = webclient.request(url)
+    except webclient.RequestError as e:
+        raise RetrievalError(e.args[0])
 
-    try:
-        data = gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
-    except IOError:
-        "Gzipped data not returned."
+    if page.code >= 400:
+        raise RetrievalError(u'HTTP Error %d: %s' % (page.code, page.reason))
 
-    return data
+    return page.data
 
 
 class Discogs(object):
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Computes audio fingerprints in parallel and keeps them on disk.
+
+Fingerprinting (running fpcalc) takes far longer than looking up the
+result, so fingerprints are stored in an SQLite database along with the
+duration of the file. An entry is used as long as the file's path, size
+and modification time are the same as when it was stored.
+
+>>>for filename, result in fingerprint_files(filenames, fingerprint_file):
+...     if isinstance(result, Exception):
+...         print result
+...     else:
+...         duration, fp = result"""
+
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+from os.path import join
+
+from puddlestuff.constants import CONFIGDIR
+
+FS_ENC = sys.getfilesystemencoding()
+
+DB_PATH = join(CONFIGDIR, 'fingerprints.db')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _encode(filename):
+    if isinstance(filename, unicode):
+        return filename.encode(FS_ENC)
+    return filename
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def file_key(filename):
+    """Returns the (size, mtime) tuple used to check if filename
+    changed since its fingerprint was stored."""
+    info = os.stat(filename)
+    return (info.st_size, info.st_mtime)
+
+
+class FingerprintCache(object):
+    """SQLite backed store of (duration, fingerprint) pairs.
+
+    Methods of interest:
+        get -> Retrieve the fingerprint of a file.
+        put -> Store one.
+
+    All methods are safe to call from multiple threads."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+            '(path BLOB PRIMARY KEY, size INTEGER, mtime REAL, '
+            'duration INTEGER, fingerprint TEXT)')
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, filename, key=None):
+        """Returns the stored (duration, fingerprint) of filename or None
+        if it wasn't found or the file changed since it was stored."""
+        filename = _encode(filename)
+        if key is None:
+            key = file_key(filename)
+        with self._lock:
+            if self._conn is None:
+                return
+            row = self._conn.execute('SELECT size, mtime, duration, '
+                'fingerprint FROM fingerprints WHERE path=?',
+                (sqlite3.Binary(filename),)).fetchone()
+        if row is not None and tuple(row[:2]) == key:
+            return row[2], row[3]
+
+    def put(self, filename, duration, fingerprint, key=None):
+        filename = _encode(filename)
+        if key is None:
+            key = file_key(filename)
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute('INSERT OR REPLACE INTO fingerprints '
+                'VALUES (?, ?, ?, ?, ?)', (sqlite3.Binary(filename),)
+                + tuple(key) + (duration, fingerprint))
+            self._conn.commit()
+
+
+def get_cache():
+    """Returns the FingerprintCache stored at DB_PATH, opening it
+    if needed. Returns None if it couldn't be opened."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = FingerprintCache(DB_PATH)
+            except (EnvironmentError, sqlite3.Error):
+                logging.exception(u'Could not open the fingerprint cache.')
+                return
+        return _cache
+
+
+def _cached(cache, filename):
+    if cache is None:
+        return
+    try:
+        return cache.get(filename)
+    except (EnvironmentError, sqlite3.Error):
+        return
+
+
+def _store(cache, filename, result):
+    if cache is None:
+        return
+    try:
+        cache.put(filename, *result)
+    except (EnvironmentError, sqlite3.Error):
+        logging.exception(u'Could not store fingerprint.')
+
+
+def _call(func, filename):
+    try:
+        return func(filename)
+    except Exception, e:
+        return e
+
+
+def fingerprint_files(filenames, func, processes=None, cache=True):
+    """Generator yielding (filename, (duration, fingerprint)) for each
+    of filenames in the order passed.
+
+    func(filename) is called to compute fingerprints that aren't cached.
+    Up to processes (defaults to the number of CPUs) calls are run at
+    a time in worker threads, so that many fpcalc processes run in
+    parallel. Each file is fingerprinted once, even if it's passed
+    more than once.
+
+    If func raises an exception, it's yielded in place of the tuple.
+
+    cache can be a FingerprintCache, True to use the default one
+    or False to not use one."""
+    if cache is True:
+        cache = get_cache()
+    elif not cache:
+        cache = None
+
+    if processes is None or processes < 1:
+        processes = cpu_count()
+
+    results = {}
+    to_compute = []
+    for filename in filenames:
+        if filename in results:
+            continue
+        results[filename] = _cached(cache, filename)
+        if results[filename] is None:
+            to_compute.append(filename)
+
+    if not to_compute:
+        for filename in filenames:
+            yield filename, results[filename]
+        return
+
+    pool = ThreadPool(min(processes, len(to_compute)))
+    try:
+        pending = dict((filename, pool.apply_async(_call, (func, filename)))
+            for filename in to_compute)
+        for filename in filenames:
+            if filename in pending:
+                result = pending.pop(filename).get()
+                if not isinstance(result, Exception):
+                    _store(cache, filename, result)
+                results[filename] = result
+            yield filename, results[filename]
+    finally:
+        pool.terminate()
@@ -1,4 +1,4 @@
-import json, pdb, re, sys, time, urllib, urllib2
+import json, pdb, re, sys, urllib, urllib2
 
 from collections import defaultdict
 from itertools import chain
@@ -470,7 +470,6 @@ class MusicBrainz(object):
     group_by = [u'album', 'artist']
     def __init__(self):
         super(MusicBrainz, self).__init__()
-        self.__lasttime = time.time()
         self.__image_size = LARGE
         self.__num_images = 0
         self.__get_images = True
@@ -519,9 +518,6 @@ class MusicBrainz(object):
             return self.search(album, [artist], 100)
 
     def search(self, album, artists=u'', limit=40):
-        if time.time() - self.__lasttime < 1000:
-            time.sleep(1)
-
         ret = []
         check_matches = False
         if isempty(artists):
@@ -558,7 +554,6 @@ class MusicBrainz(object):
                         unicode(e))
             raise RetrievalError(unicode(e))
         write_log(u'Retrieved search results.')
-        self.__lasttime = time.time()
         return parse_album_search(xml)
 
     def retrieve(self, albuminfo):
@@ -566,10 +561,7 @@ class MusicBrainz(object):
             album_id = albuminfo['#album_id']
         except TypeError:
             album_id = albuminfo
-        if time.time() - self.__lasttime < 1000:
-            time.sleep(1)
         ret = retrieve_album(album_id)
-        self.__lasttime = time.time()
         image = self.retrieve_covers(album_id)
         if image:
             ret[0]['__image'] = image
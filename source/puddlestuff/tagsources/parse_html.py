@@ -4,10 +4,11 @@
 #while we're at it, we also wrap url fetching.
 
 import re
-import urllib2
 
 import lxml.html
 
+from puddlestuff.tagsources import webclient
+
 def classify(seq, key_func):
     result = {}
     for item in seq:
@@ -108,7 +109,7 @@ class SoupWrapper(object):
         return SoupWrapper(self.element.getparent())
 
 def fetch_page(url):
-    return urllib2.urlopen(url).read()
+    return webclient.request(url).data
 
 def parse(page):
     p = lxml.html.document_fromstring(page)
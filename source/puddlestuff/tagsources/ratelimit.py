@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Limits the rate at which requests are sent to web services.
+
+Each host has a token bucket that holds up to burst tokens and is
+refilled at rate tokens per second. Every request takes a token and
+waits if none is left, but only until its token is due. Callers are
+served in the order they asked, even when they're in different threads.
+
+>>>wait('http://musicbrainz.org/ws/2/release/...')
+>>>stats()['musicbrainz.org']
+{'requests': 1, 'throttled': 0, 'wait': 0.0, 'max_wait': 0.0}
+
+Limits for hosts not in LIMITS (or set with set_limit) can be set in the
+rate_limits key of the tagsources section in tagsources.conf, as a
+dictionary of host: [rate, burst]. Hosts without a limit aren't
+throttled."""
+
+import threading
+import time
+import urlparse
+
+from os.path import join
+
+from puddlestuff.constants import CONFIGDIR
+from puddlestuff.puddleobjects import PuddleConfig
+
+#Default (rate, burst) of the web services used by the tag sources.
+LIMITS = {
+    'musicbrainz.org': (1.0, 1),
+    'api.discogs.com': (1.0, 1),
+    'www.discogs.com': (1.0, 1),
+    'api.acoustid.org': (3.0, 3),
+    'freedb.freedb.org': (1.0, 1),
+    }
+
+_buckets = {}
+_limits = {}
+_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Allows rate requests per second with bursts of up to
+    burst requests.
+
+    Methods of interest:
+        acquire -> Wait for a token.
+        stats -> Dictionary of the time spent waiting."""
+
+    def __init__(self, rate, burst=1):
+        object.__init__(self)
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._stats = {'requests': 0, 'throttled': 0, 'wait': 0.0,
+            'max_wait': 0.0}
+
+    def acquire(self):
+        """Takes a token, sleeping until it's available.
+
+        Returns the number of seconds waited."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            #Tokens can go negative, which reserves the next ones
+            #for callers that are already waiting.
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+            stats = self._stats
+            stats['requests'] += 1
+            if delay > 0:
+                stats['throttled'] += 1
+                stats['wait'] += delay
+                stats['max_wait'] = max(stats['max_wait'], delay)
+
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def stats(self):
+        """Returns a dictionary with the number of requests made,
+        how many were throttled ('throttled'), the total number of
+        seconds spent waiting ('wait') and the longest wait
+        ('max_wait')."""
+        with self._lock:
+            return self._stats.copy()
+
+
+def _host(url):
+    if '/' in url:
+        return (urlparse.urlsplit(url).hostname or url).lower()
+    return url.lower()
+
+
+def _load_limits():
+    cparser = PuddleConfig(join(CONFIGDIR, 'tagsources.conf'))
+    limits = dict(LIMITS)
+    for host, value in cparser.get('tagsources', 'rate_limits', {}).items():
+        try:
+            rate, burst = value
+            limits[host.lower()] = (float(rate), int(burst))
+        except (TypeError, ValueError):
+            continue
+    return limits
+
+
+def limiter(url):
+    """Returns the TokenBucket of the host of url (a url or hostname)
+    or None if requests to it aren't limited."""
+    host = _host(url)
+    with _lock:
+        if not _limits:
+            _limits.update(_load_limits())
+        try:
+            return _buckets[host]
+        except KeyError:
+            pass
+        limit = _limits.get(host)
+        if limit is None or limit[0] <= 0:
+            return
+        bucket = _buckets[host] = TokenBucket(*limit)
+        return bucket
+
+
+def set_limit(url, rate, burst=1):
+    """Sets the limit of url's host to rate requests a second with
+    bursts of up to burst requests. A rate of 0 removes the limit."""
+    host = _host(url)
+    with _lock:
+        if not _limits:
+            _limits.update(_load_limits())
+        _limits[host] = (rate, burst)
+        _buckets.pop(host, None)
+
+
+def stats():
+    """Returns a dictionary of host: TokenBucket.stats()."""
+    with _lock:
+        buckets = _buckets.items()
+    return dict((host, bucket.stats()) for host, bucket in buckets)
+
+
+def wait(url):
+    """Waits until a request can be sent to url's host.
+
+    Returns the number of seconds waited."""
+    bucket = limiter(url)
+    if bucket is None:
+        return 0.0
+    return bucket.acquire()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""HTTP client shared by the tag sources.
+
+Connections are kept alive and reused for requests to the same host.
+Successful GET responses are stored on disk and returned without
+contacting the server for cache_ttl seconds after they were retrieved.
+Older entries are revalidated using their ETag and Last-Modified headers.
+
+>>>response = request('http://musicbrainz.org/ws/2/release/...')
+>>>response.code, response.data
+(200, '<?xml ...')
+>>>stats()
+{'hits': 0, 'misses': 1, 'revalidated': 0, 'requests': 1, 'reused': 0}
+
+Only GET requests are cached. Pass cache=False to always go to the
+server. Network errors are raised as RequestError. HTTP error statuses
+are returned as responses like any other."""
+
+import cPickle as pickle
+import base64
+import cStringIO
+import gzip
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from os.path import join, exists
+
+import puddlestuff
+from puddlestuff import profiling
+from puddlestuff.constants import CONFIGDIR
+from puddlestuff.puddleobjects import PuddleConfig
+from puddlestuff.tagsources import ratelimit
+
+#Statuses that are followed to the location they point to.
+REDIRECTS = (301, 302, 303, 307)
+MAX_REDIRECTS = 5
+
+#Methods that are sent again if a reused connection fails.
+IDEMPOTENT = ('GET', 'HEAD')
+
+#Idle connections kept open per host.
+MAX_IDLE = 4
+
+TIMEOUT = 30
+
+#Number of entries stored after which the cache is pruned to cache_size.
+PRUNE_INTERVAL = 100
+
+cparser = PuddleConfig(join(CONFIGDIR, 'tagsources.conf'))
+
+cache_dir = cparser.get('tagsources', 'cache_dir', join(CONFIGDIR, 'webcache'))
+#Seconds a cached response is used without revalidating it.
+cache_ttl = cparser.get('tagsources', 'cache_ttl', 7 * 24 * 60 * 60, True)
+#Maximum size of the cache in megabytes.
+cache_size = cparser.get('tagsources', 'cache_size', 100, True)
+
+useragent = "puddletag/" + puddlestuff.version_string
+
+_idle = {}
+_lock = threading.Lock()
+_stored = 0
+_stats = dict.fromkeys(['hits', 'misses', 'revalidated', 'requests',
+    'reused'], 0)
+
+
+class RequestError(EnvironmentError):
+    pass
+
+
+class Response(object):
+    """Retrieved page.
+
+    code -> HTTP status.
+    reason -> Status message.
+    headers -> Dictionary of headers, with lowercase keys.
+    data -> Body of the response (decompressed if it was gzipped).
+    url -> URL the data was retrieved from (after redirects).
+    cached -> True if the response came from the cache."""
+
+    def __init__(self, code, reason, headers, data, url, cached=False):
+        object.__init__(self)
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        self.url = url
+        self.cached = cached
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+    profiling.count('webclient.' + key, value)
+
+
+def get_useragent():
+    if useragent:
+        return useragent
+    else:
+        return 'puddetag/' + puddlestuff.version_string
+
+
+def set_useragent(agent):
+    global useragent
+    useragent = agent
+
+
+def set_cache(dirpath=None, ttl=None, size=None):
+    """Changes the cache settings. Pass ttl=0 to disable caching."""
+    global cache_dir, cache_ttl, cache_size
+    if dirpath is not None:
+        cache_dir = dirpath
+    if ttl is not None:
+        cache_ttl = ttl
+    if size is not None:
+        cache_size = size
+
+
+def stats():
+    """Returns a dictionary with the number of responses served from
+    the cache ('hits'), revalidated with the server ('revalidated') or
+    not found in it ('misses'), the number of requests sent ('requests')
+    and how many of those reused an open connection ('reused')."""
+    with _lock:
+        return _stats.copy()
+
+
+def _cache_filename(url):
+    return join(cache_dir, hashlib.sha1(url).hexdigest())
+
+
+def _load_entry(url):
+    filename = _cache_filename(url)
+    if not exists(filename):
+        return
+    try:
+        with open(filename, 'rb') as fo:
+            entry = pickle.load(fo)
+    except Exception:
+        logging.exception(u'Invalid web cache entry for %s', url)
+        clear_cache(url)
+        return
+    if entry.get('url') == url:
+        return entry
+
+
+def _write_entry(url, entry):
+    filename = _cache_filename(url)
+    temp = u'%s.%d.%d' % (filename, os.getpid(),
+        threading.current_thread().ident)
+    try:
+        if not exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(temp, 'wb') as fo:
+            pickle.dump(entry, fo, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+    except EnvironmentError:
+        logging.exception(u'Could not cache %s', url)
+        if exists(temp):
+            os.remove(temp)
+        return False
+    return True
+
+
+def _store_entry(url, response):
+    global _stored
+    if 'no-store' in response.headers.get('cache-control', ''):
+        return
+
+    entry = {'url': url, 'time': time.time(), 'code': response.code,
+        'reason': response.reason, 'headers': response.headers,
+        'data': response.data}
+    if not _write_entry(url, entry):
+        return
+
+    with _lock:
+        _stored += 1
+        prune = _stored >= PRUNE_INTERVAL
+        if prune:
+            _stored = 0
+    if prune:
+        prune_cache()
+
+
+def clear_cache(url=None):
+    """Removes the cached response for url. If None, the whole
+    cache is cleared."""
+    if url is not None:
+        filenames = [_cache_filename(url)]
+    elif exists(cache_dir):
+        filenames = [join(cache_dir, z) for z in os.listdir(cache_dir)]
+    else:
+        filenames = []
+
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except EnvironmentError:
+            pass
+
+
+def prune_cache(size=None):
+    """Removes the least recently stored entries until the cache is
+    smaller than size megabytes (defaults to cache_size)."""
+    size = (cache_size if size is None else size) * 1024 * 1024
+    if not exists(cache_dir):
+        return
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        filename = join(cache_dir, name)
+        try:
+            info = os.stat(filename)
+        except EnvironmentError:
+            continue
+        entries.append((info.st_mtime, info.st_size, filename))
+        total += info.st_size
+
+    entries.sort()
+    for mtime, filesize, filename in entries:
+        if total <= size:
+            break
+        try:
+            os.remove(filename)
+        except EnvironmentError:
+            continue
+        total -= filesize
+
+
+def _connection_key(url):
+    """Returns ((scheme, host, port, tunnel), path, proxy headers) for
+    url taking proxies into account. tunnel is the (host, port) of the
+    proxy used for HTTPS connections."""
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise RequestError(u'Unsupported URL: %s' % url)
+    host = parts.hostname
+    port = parts.port or (443 if scheme == 'https' else 80)
+    path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host):
+        return (scheme, host, port, None), path, {}
+
+    proxy = urlparse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+    headers = {}
+    if proxy.username:
+        auth = '%s:%s' % (urllib.unquote(proxy.username),
+            urllib.unquote(proxy.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + \
+            base64.b64encode(auth)
+    proxy_addr = (proxy.hostname, proxy.port or 80)
+    if scheme == 'http':
+        return ('http', proxy_addr[0], proxy_addr[1], None), url, headers
+    return (scheme, host, port, proxy_addr), path, headers
+
+
+def _connect(key, proxy_headers):
+    scheme, host, port, tunnel = key
+    if tunnel:
+        conn = httplib.HTTPSConnection(tunnel[0], tunnel[1], timeout=TIMEOUT)
+        conn.set_tunnel(host, port, proxy_headers)
+    elif scheme == 'https':
+        conn = httplib.HTTPSConnection(host, port, timeout=TIMEOUT)
+    else:
+        conn = httplib.HTTPConnection(host, port, timeout=TIMEOUT)
+    return conn
+
+
+def _checkout(key):
+    with _lock:
+        idle = _idle.get(key)
+        if idle:
+            return idle.pop()
+
+
+def _checkin(key, conn):
+    with _lock:
+        idle = _idle.setdefault(key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def close_connections():
+    """Closes all idle connections."""
+    with _lock:
+        connections = [c for idle in _idle.values() for c in idle]
+        _idle.clear()
+    for conn in connections:
+        conn.close()
+
+
+def _send(method, url, data, headers):
+    """Sends a single request and returns the Response.
+
+    A connection that was kept open may have been closed by the server
+    in the meantime, so failed GET requests on reused connections are
+    sent again on a new one. Other requests aren't, since the server may
+    have acted on them already."""
+    key, path, proxy_headers = _connection_key(url)
+    if key[3] is None:
+        headers = dict(headers, **proxy_headers)
+
+    ratelimit.wait(url)
+
+    conn = _checkout(key)
+    reused = conn is not None
+    while True:
+        if conn is None:
+            conn = _connect(key, proxy_headers)
+        try:
+            conn.request(method, path, data, headers)
+            page = conn.getresponse()
+            body = page.read()
+            break
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            conn = None
+            if reused and method in IDEMPOTENT:
+                reused = False
+                continue
+            if isinstance(e, socket.error):
+                try:
+                    msg = u'%s (%s)' % (e.strerror or e.args[0], e.errno)
+                except (AttributeError, IndexError):
+                    msg = unicode(e)
+                raise RequestError(msg)
+            raise RequestError(u'%s: %s' % (e.__class__.__name__, e))
+
+    _count('requests')
+    if reused:
+        _count('reused')
+
+    if page.will_close:
+        conn.close()
+    else:
+        _checkin(key, conn)
+
+    response_headers = dict(page.getheaders())
+    if response_headers.get('content-encoding') == 'gzip':
+        try:
+            body = gzip.GzipFile(fileobj=cStringIO.StringIO(body)).read()
+            del(response_headers['content-encoding'])
+        except (IOError, EOFError):
+            "Not gzipped."
+
+    return Response(page.status, page.reason, response_headers, body, url)
+
+
+@profiling.timed('webclient.request')
+def request(url, data=None, headers=None, cache=True):
+    """Retrieves url and returns a Response.
+
+    If data is given, it's POSTed to the server (as a form unless
+    headers has a Content-Type). headers is a dictionary of extra request
+    headers. The User-Agent is added if not present.
+
+    Requests sent to the server are rate limited by ratelimit.wait.
+    Responses served from the cache aren't.
+
+    Raises RequestError if the server couldn't be contacted."""
+    if isinstance(url, unicode):
+        url = url.encode('utf8')
+
+    method = 'GET' if data is None else 'POST'
+    cache = cache and method == 'GET' and cache_ttl > 0
+
+    send_headers = {'Accept-Encoding': 'gzip',
+        'User-Agent': get_useragent()}
+    if headers:
+        send_headers.update((k.title(), v) for k, v in headers.iteritems())
+    if data is not None and 'Content-Type' not in send_headers:
+        send_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    entry = _load_entry(url) if cache else None
+    if entry is not None:
+        if time.time() - entry['time'] < cache_ttl:
+            _count('hits')
+            return Response(entry['code'], entry['reason'], entry['headers'],
+                entry['data'], url, True)
+        if 'etag' in entry['headers']:
+            send_headers['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            send_headers['If-Modified-Since'] = \
+                entry['headers']['last-modified']
+
+    location = url
+    for i in xrange(MAX_REDIRECTS + 1):
+        response = _send(method, location, data, send_headers)
+        if response.code not in REDIRECTS or \
+            'location' not in response.headers:
+            break
+        location = urlparse.urljoin(location, response.headers['location'])
+        if response.code == 303:
+            method, data = 'GET', None
+            send_headers.pop('Content-Type', None)
+            send_headers.pop('Content-Encoding', None)
+        send_headers.pop('If-None-Match', None)
+        send_headers.pop('If-Modified-Since', None)
+
+    if not cache:
+        return response
+
+    if entry is not None and response.code == 304:
+        _count('revalidated')
+        entry['time'] = time.time()
+        _write_entry(url, entry)
+        return Response(entry['code'], entry['reason'], entry['headers'],
+            entry['data'], url, True)
+
+    _count('misses')
+    if response.code == 200:
+        _store_entry(url, response)
+    return response
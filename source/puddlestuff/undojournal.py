@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Compact storage of the undo levels of the tag table.
+
+Undo entries are dictionaries of field: old value for each file changed
+by an action. Instead of keeping each dictionary as is, values are
+stored as tuples shared by all the entries that have the same value
+(eg. the old album of every file in a directory). Image data is stored
+once per distinct image, keyed by its SHA1 digest.
+
+When the journal uses more than limit bytes, the oldest levels are
+pickled to a temporary file and read back when they're undone.
+
+>>>journal = UndoJournal()
+>>>journal.add(0, audio, {'artist': [u'Old Artist']})
+>>>0 in journal
+True
+>>>journal.pop(0)
+[(audio, {'artist': [u'Old Artist']})]"""
+
+import cPickle as pickle
+import hashlib
+import logging
+import tempfile
+
+from collections import OrderedDict
+
+from puddlestuff.audioinfo import DATA
+
+#Default number of bytes kept in memory.
+DEFAULT_LIMIT = 64 * 1024 * 1024
+
+#Approximate overhead in bytes of each stored value.
+OVERHEAD = 64
+
+
+class _Images(tuple):
+    """Stored images. Each item is (image without its data, digest)."""
+
+
+def _size(value):
+    return OVERHEAD + sum(len(z) for z in value
+        if isinstance(z, basestring)) * 2
+
+
+class UndoJournal(object):
+    """Stores the undo entries of each undo level.
+
+    Methods of interest:
+        add -> Add an entry for a file.
+        pop -> Remove a level and return its entries.
+        clear -> Remove all levels.
+
+    Levels can be checked for with the in operator."""
+
+    def __init__(self, limit=DEFAULT_LIMIT):
+        object.__init__(self)
+        self.limit = limit
+        self.size = 0
+        self._levels = {}
+        #level: (offset, files) of the levels written to self._file
+        self._spilled = {}
+        self._file = None
+        #Shared values. tuple: [tuple, references]
+        self._values = {}
+        #digest: [data, references]
+        self._blobs = {}
+
+    def __contains__(self, level):
+        return level in self._levels or level in self._spilled
+
+    def __len__(self):
+        return len(self._levels) + len(self._spilled)
+
+    def _share(self, value):
+        value = tuple(value)
+        try:
+            stored = self._values.get(value)
+        except TypeError: #Unhashable
+            return list(value)
+        if stored is None:
+            stored = self._values[value] = [value, 0]
+            self.size += _size(value)
+        stored[1] += 1
+        return stored[0]
+
+    def _store_images(self, images):
+        ret = []
+        for image in images:
+            image = image.copy()
+            if DATA not in image:
+                ret.append((image, None))
+                continue
+            data = image.pop(DATA)
+            digest = hashlib.sha1(data).digest()
+            stored = self._blobs.get(digest)
+            if stored is None:
+                stored = self._blobs[digest] = [data, 0]
+                self.size += len(data) + OVERHEAD
+            stored[1] += 1
+            ret.append((image, digest))
+        return _Images(ret)
+
+    def _encode(self, undo):
+        entry = {}
+        for key, value in undo.iteritems():
+            if key == '__image':
+                entry[key] = self._store_images(value)
+            elif isinstance(value, list):
+                entry[key] = self._share(value)
+            else:
+                entry[key] = value
+        return entry
+
+    def _decode(self, entry):
+        undo = {}
+        for key, value in entry.iteritems():
+            if isinstance(value, _Images):
+                images = []
+                for image, digest in value:
+                    image = image.copy()
+                    if digest is not None:
+                        image[DATA] = self._blobs[digest][0]
+                    images.append(image)
+                undo[key] = images
+            elif isinstance(value, tuple):
+                undo[key] = list(value)
+            else:
+                undo[key] = value
+        return undo
+
+    def _release(self, entry):
+        for value in entry.itervalues():
+            if isinstance(value, _Images):
+                for image, digest in value:
+                    if digest is None:
+                        continue
+                    stored = self._blobs[digest]
+                    stored[1] -= 1
+                    if stored[1] <= 0:
+                        del(self._blobs[digest])
+                        self.size -= len(stored[0]) + OVERHEAD
+            elif isinstance(value, tuple):
+                stored = self._values[value]
+                stored[1] -= 1
+                if stored[1] <= 0:
+                    del(self._values[value])
+                    self.size -= _size(value)
+
+    def add(self, level, audio, undo):
+        """Stores undo, the dictionary of old values of audio, in level
+        replacing any previous entry for audio in that level."""
+        entries = self._levels.get(level)
+        if entries is None:
+            if level in self._spilled:
+                self._load(level)
+                entries = self._levels[level]
+            else:
+                entries = self._levels[level] = OrderedDict()
+        if audio in entries:
+            self._release(entries.pop(audio))
+        entries[audio] = self._encode(undo)
+        if self.limit is not None and self.size > self.limit:
+            self._spill()
+
+    def pop(self, level):
+        """Removes level and returns a list of its (audio, undo dictionary)
+        pairs in the order they were added.
+
+        Raises KeyError if the level doesn't exist."""
+        if level in self._spilled:
+            self._load(level)
+        entries = self._levels.pop(level)
+        ret = [(audio, self._decode(entry)) for audio, entry
+            in entries.iteritems()]
+        for entry in entries.itervalues():
+            self._release(entry)
+        return ret
+
+    def clear(self):
+        self._levels.clear()
+        self._spilled.clear()
+        self._values.clear()
+        self._blobs.clear()
+        self.size = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _spill(self):
+        """Writes the oldest levels to disk until the journal's smaller
+        than self.limit. The newest level is always kept in memory."""
+        while self.size > self.limit and len(self._levels) > 1:
+            level = min(self._levels)
+            entries = self._levels[level]
+            data = [self._decode(entry) for entry in entries.itervalues()]
+            try:
+                if self._file is None:
+                    self._file = tempfile.TemporaryFile(prefix='puddletag')
+                self._file.seek(0, 2)
+                offset = self._file.tell()
+                pickle.dump(data, self._file, pickle.HIGHEST_PROTOCOL)
+            except (EnvironmentError, pickle.PicklingError):
+                logging.exception(u'Could not write undo level to disk.')
+                self.limit = None
+                return
+            del(self._levels[level])
+            self._spilled[level] = (offset, entries.keys())
+            for entry in entries.itervalues():
+                self._release(entry)
+
+    def _load(self, level):
+        offset, files = self._spilled.pop(level)
+        self._file.seek(offset)
+        data = pickle.load(self._file)
+        entries = self._levels[level] = OrderedDict()
+        for audio, undo in zip(files, data):
+            entries[audio] = self._encode(undo)
+        if not self._spilled:
+            self._file.close()
+            self._file = None
@@ -7,19 +7,23 @@ from PyQt4.QtGui import QAction, QApplication
 from StringIO import StringIO
 from copy import copy, deepcopy
 from audioinfo import (FILETAGS, setmodtime, PATH, FILENAME,
-    EXTENSION, MockTag, DIRPATH, DIRNAME, READONLY, fn_hash, isempty)
+    EXTENSION, MockTag, DIRPATH, DIRNAME, READONLY, fn_hash, isempty,
+    tagcache, CaselessDict)
 from errno import EEXIST
 import os, pdb, re
 from puddleobjects import (encode_fn, decode_fn, issubfolder, natcasecmp,
     open_resourcefile, safe_name)
 import puddlestuff.translations
+from puddlestuff import profiling
 translate = puddlestuff.translations.translate
 import errno, traceback
 from puddlestuff.constants import BLANK, SEPARATOR, LOG_FILENAME
 from operator import itemgetter
 from itertools import imap
 import logging
+import threading
 
+from contextlib import contextmanager
 from xml.sax.saxutils import escape as escape_html
 import shutil
 
@@ -171,6 +175,39 @@ def pprint_tag(tags, fmt=u"<b>%s</b>: %s<br />", show_read_only=False):
 
         return u"".join(imap(map_func, items))
 
+class RenameLocks(object):
+    """Serializes renames of files in the same directories.
+
+    Passed as the rename_lock argument of write when files are written
+    from multiple threads. Renames into or out of the same directory
+    wait for each other, so that checks for existing files still work.
+    Renames in unrelated directories, and tag saves, can run at the
+    same time."""
+
+    def __init__(self):
+        object.__init__(self)
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def __call__(self, audio, fn_fields):
+        dirpaths = set([audio.dirpath])
+        if PATH in fn_fields:
+            dirpaths.add(os.path.dirname(os.path.normpath(os.path.join(
+                audio.dirpath, encode_fn(to_string(fn_fields[PATH]))))))
+
+        #Always acquired in the same order to prevent deadlocks.
+        with self._lock:
+            locks = [self._locks.setdefault(d, threading.Lock())
+                for d in sorted(dirpaths)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
 def rename_file(audio, tags):
     """If tags(a dictionary) contains a PATH key, then the file
     in self.taginfo[row] is renamed based on that.
@@ -259,15 +296,26 @@ def to_string(value):
     else:
         return to_string(value[0])
 
-def write(audio, tags, save_mtime = True, justrename=False):
+@profiling.timed('util.write')
+def write(audio, tags, save_mtime = True, justrename=False,
+    rename_lock=None):
     """A function to update one row.
     row is the row, tags is a dictionary of tags.
 
     If undo`is True, then an undo level is created for this file.
     If justrename is True, then (if tags contain a PATH or EXTENSION key)
     the file is just renamed i.e not tags are written.
+
+    rename_lock (eg. a RenameLocks object) is called with audio and the
+    filename fields to get the context manager held while the file
+    is renamed.
     """
-    tags = deepcopy(tags)
+    #Values are replaced rather than modified, so a shallow copy's
+    #enough and avoids copying image data for every file.
+    if isinstance(tags, CaselessDict):
+        tags = CaselessDict(tags)
+    else:
+        tags = dict(tags)
     renamed = False
     if audio.library and (ARTIST in tags or ALBUM in tags):
         artist = audio.get(ARTIST, u'')
@@ -290,19 +338,24 @@ def write(audio, tags, save_mtime = True, justrename=False):
         if not audio.IMAGETAGS:
             del(tags['__image'])
         else:
-            undo['__image'] = audio.images
+            undo['__image'] = copy(audio.images)
 
     try:
         if fn_fields:
             for key in fn_fields:
                 if key in fn_hash:
                     undo[key] = getattr(audio, fn_hash[key])
-            renamed = rename_file(audio, fn_fields)
+            if rename_lock is None:
+                renamed = rename_file(audio, fn_fields)
+            else:
+                with rename_lock(audio, fn_fields):
+                    renamed = rename_file(audio, fn_fields)
         
         if not justrename:
             user_only = dict_diff(audio, without_file(tags))
             if user_only:
                 audio.update(user_only)
+                tagcache.invalidate(audio.filepath)
                 audio.save()
             elif not user_only and not renamed:
                 return {}
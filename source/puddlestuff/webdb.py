@@ -555,6 +555,26 @@ def tag_source_search(ts, group, files):
 
     return ret, files
 
+def initialized_sources(status):
+    """Returns the tag source objects used by the Tag Sources and Mass
+    Tagging windows. They're created (and stored in status) the first
+    time it's called."""
+    if status['initialized_tagsources'] is not None:
+        return status['initialized_tagsources']
+
+    sources = [z() for z in tagsources]
+    sources.extend(load_mp3tag_sources())
+
+    for ts in sources:
+        if hasattr(ts, 'preferences') and not isinstance(ts, QWidget):
+            try:
+                ts.applyPrefs(load_source_prefs(ts.name, ts.preferences))
+            except:
+                continue
+
+    status['initialized_tagsources'] = sources
+    return sources
+
 class MainWin(QWidget):
     def __init__(self, status, parent = None):
         QWidget.__init__(self, parent)
@@ -571,17 +591,7 @@ class MainWin(QWidget):
         self.fieldMapping = audioinfo.mapping
 
         self._status = status
-        self.__sources = [z() for z in tagsources]
-        self.__sources.extend(load_mp3tag_sources())
-
-        for ts in self.__sources:
-            if hasattr(ts, 'preferences') and not isinstance(ts, QWidget):
-                try:
-                    ts.applyPrefs(load_source_prefs(ts.name, ts.preferences))
-                except:
-                    continue
-
-        status['initialized_tagsources'] = self.__sources
+        self.__sources = initialized_sources(status)
 
         self.curSource = self.__sources[0]
         self.__sourceFields = [[] for z in self.__sources]
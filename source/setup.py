@@ -24,6 +24,7 @@ setup(
         'puddlestuff.libraries', 'puddlestuff.audioinfo',
         'puddlestuff.tagsources', 'puddlestuff.tagsources.mp3tag',
         'puddlestuff.masstag', 'puddlestuff.plugins'],
+    package_data={'puddlestuff': ['puddletag.rcc']},
 
     keywords='tagging ogg mp3 apev2 mp4 id3',
     license='GNU General Public License v2',
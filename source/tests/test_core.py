@@ -0,0 +1,793 @@
+# -*- coding: utf-8 -*-
+"""Tests for the parts of puddlestuff that don't need a QApplication.
+
+Run from the source directory with:
+
+    python -m unittest discover -s tests"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from puddlestuff import audio_filter, audioinfo, findfunc, masstag
+from puddlestuff.audioinfo import tagcache, util
+from puddlestuff.constants import SEPARATOR
+from puddlestuff.puddleobjects import PuddleConfig
+from puddlestuff.selectionstats import SelectionStats
+from puddlestuff.tagsources import ratelimit, webclient
+from puddlestuff.undojournal import UndoJournal
+
+#The duplicates modules import each other as top-level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(audioinfo.__path__[0]),
+    'duplicates'))
+import dupefuncs
+from matchfuncs import _ratio, exact
+
+#A silent MPEG frame. Enough of them make a file mutagen can parse.
+MP3_FRAME = '\xff\xfb\x90\x00' + '\x00' * 413
+
+PNG = '\x89PNG\r\n\x1a\n' + 'x' * 20000
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def path(self, name):
+        return os.path.join(self.dirpath, name)
+
+    def write_file(self, name, data):
+        filename = self.path(name)
+        fo = open(filename, 'wb')
+        fo.write(data)
+        fo.close()
+        return filename
+
+class Parsed(object):
+    """Stands in for a mutagen class."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = open(filename, 'rb').read()
+
+class TagCacheTest(TempDirTest):
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.cache = tagcache.TagCache(self.path('cache.db'))
+
+    def tearDown(self):
+        tagcache.set_cache(None)
+        self.cache.close()
+        TempDirTest.tearDown(self)
+
+    def test_key_changes_with_file(self):
+        filename = self.write_file('a', 'abc')
+        key = tagcache.file_key(filename)
+        self.assertEqual(key, tagcache.file_key(filename))
+        self.write_file('a', 'abcd')
+        self.assertNotEqual(key, tagcache.file_key(filename))
+
+    def test_hit_and_miss(self):
+        tagcache.set_cache(self.cache)
+        filename = self.write_file('a', 'abc')
+        audio, images = tagcache.load(filename, Parsed)
+        self.assertEqual(images, None)
+        self.assertTrue(tagcache.is_cached(filename))
+
+        cached = tagcache.load(filename, Parsed)[0]
+        self.assertTrue(cached is not audio)
+        self.assertEqual(cached.data, 'abc')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        self.write_file('a', 'abcd')
+        self.assertFalse(tagcache.is_cached(filename))
+        self.assertEqual(tagcache.load(filename, Parsed)[0].data, 'abcd')
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_other_filetype_misses(self):
+        class Other(Parsed):
+            pass
+        filename = self.write_file('a', 'abc')
+        self.cache.put(filename, Parsed, Parsed(filename))
+        self.assertEqual(self.cache.get(filename, Other), None)
+        self.assertNotEqual(self.cache.get(filename, Parsed), None)
+
+    def test_invalidate(self):
+        filenames = [self.write_file(unicode(i), 'abc') for i in range(5)]
+        for filename in filenames:
+            self.cache.put(filename, Parsed, Parsed(filename))
+
+        self.cache.invalidate(filenames[0])
+        self.cache.invalidate(filenames[1:3] + [self.path('missing')])
+        self.assertEqual([self.cache.contains(f) for f in filenames],
+            [False, False, False, True, True])
+        stats = self.cache.stats()
+        self.assertEqual((stats['invalidated'], stats['entries']), (3, 2))
+
+        self.cache.invalidate()
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_images_not_cached(self):
+        tagcache.set_cache(self.cache)
+        filename = self.write_file('a.mp3', MP3_FRAME * 50)
+        tag = audioinfo.Tag(filename)
+        tag['title'] = [u'Title']
+        tag['__image'] = [{'data': PNG}]
+        tag.save()
+
+        audioinfo.Tag(filename)
+        size = self.cache._conn.execute('SELECT length(data) FROM files'
+            ).fetchone()[0]
+        self.assertTrue(size < len(PNG))
+
+        tag = audioinfo.Tag(filename)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(tag['title'], [u'Title'])
+        self.assertEqual(tag['__num_images'], u'1')
+        self.assertEqual(tag.images[0]['data'], PNG)
+
+class CompileFormatTest(unittest.TestCase):
+    """The results were recorded from parsefunc before format strings
+    were compiled."""
+
+    audio = {'artist': [u'Art/ist'], 'title': [u'Ti"tle'], 'track': [u'3'],
+        'album': [u'A%lb%um'], 'genre': [u'Pop', u'Rock'], '__path': u'x.mp3'}
+    state = {'__counter': u'4'}
+    extra = {'x': u'X'}
+
+    results = [
+        (u'', u''),
+        (u'plain text', u'plain text'),
+        (u'%artist% - %title%', u'Art/ist - Ti"tle'),
+        (u'$num(%track%, 2). %title%', u'03. Ti"tle'),
+        (u'$upper($left(%artist%, 3))', u'ART'),
+        (u'$replace(%artist%, /, \\,)', u'Art,ist'),
+        (u'%nope%', u''),
+        (u'%genre%', u'Pop'),
+        (u'$if(%nope%, yes, no)', u'no'),
+        (u'"quoted, text"', u'quoted, text'),
+        (u'\\$num(1, 2)', u'\\01'),
+        (u'%album%', u'A%lb%um'),
+        (u'$num(%__counter%, 3)', u'004'),
+        (u'%x%', u'X'),
+        (u'100%', u'100'),
+        (u'$len(%genre%)', u'3'),
+        ]
+
+    path_results = [
+        (u'%artist% - %title%', ([], u'Art/ist - Ti"tle')),
+        (u'%artist%/%album%/%track%', ([7, 15], u'Art/ist/A%lb%um/3')),
+        (u'$lower(%artist%)/$num(%track%,2)', ([7], u'art/ist/03')),
+        ]
+
+    def test_results(self):
+        for pattern, result in self.results:
+            compiled = findfunc.compile_format(pattern)
+            self.assertEqual(compiled(self.audio, state=self.state,
+                extra=self.extra), result, pattern)
+            self.assertEqual(findfunc.parsefunc(pattern, self.audio,
+                state=self.state, extra=self.extra), result, pattern)
+
+    def test_path_sep(self):
+        for pattern, result in self.path_results:
+            compiled = findfunc.compile_format(pattern, u'/')
+            self.assertEqual(compiled(self.audio), result, pattern)
+
+    def test_cached(self):
+        pattern = u'%artist% - %title%'
+        self.assertTrue(findfunc.compile_format(pattern) is
+            findfunc.compile_format(pattern))
+        self.assertFalse(findfunc.compile_format(pattern) is
+            findfunc.compile_format(pattern, u'/'))
+
+    def test_unclosed(self):
+        for pattern in [u'$num(%track%, 2', u'$upper(']:
+            self.assertRaises(findfunc.ParseError, findfunc.compile_format,
+                pattern)
+
+class CompileFilterTest(unittest.TestCase):
+    """The results were recorded from audio_filter.parse before filter
+    expressions were compiled."""
+
+    audios = [
+        {'artist': [u'Carl Douglas'], 'title': [u'Kung Fu'], 'track': [u'14'],
+            '__filename': u'clen.mp3', 'genre': [u'Pop']},
+        {'artist': [u'Beatles'], 'title': [u'Help'], 'track': [u'3'],
+            'year': [u'1990'], '__filename': u'a.mp3'},
+        {'title': [u'x'], 'track': [u'20'], 'year': [u'10'],
+            '__filename': u'b.mp3'},
+        ]
+
+    results = [
+        (u'beatles', [False, True, False]),
+        (u'Carl', [True, False, False]),
+        (u'not carl', [False, True, True]),
+        (u'artist is "Carl Douglas"', [True, False, False]),
+        (u'artist equal "CARL douglas"', [True, False, False]),
+        (u'artist has arl', [True, False, False]),
+        (u'__filename has clen', [True, False, False]),
+        (u'title matches "^k.*g$"', [False, False, False]),
+        (u'not missing artist', [True, True, False]),
+        (u'present genre or missing year', [True, False, False]),
+        (u'artist and title', [True, True, False]),
+        (u'%track% greater 14', [False, False, True]),
+        (u'%track% greater "$add($len(%artist%), 5)"', [False, False, True]),
+        (u'%track% less %year%', [False, True, False]),
+        (u'track less 5 and not artist has x', [False, True, False]),
+        (u'(not missing artist) and (20 greater 19)', [True, True, False]),
+        (u'not (20 greater 19)', [False, False, False]),
+        ]
+
+    def test_results(self):
+        for expr, result in self.results:
+            matches = audio_filter.compile_filter(expr)
+            self.assertEqual([bool(matches(a)) for a in self.audios],
+                result, expr)
+            self.assertEqual([audio_filter.parse(a, expr)
+                for a in self.audios], result, expr)
+
+    def test_cached(self):
+        expr = u'artist has arl'
+        self.assertTrue(audio_filter.compile_filter(expr) is
+            audio_filter.compile_filter(expr))
+
+class RatioDupesTest(unittest.TestCase):
+    """The indexed search must find the same groups as brute force."""
+
+    words = [u'love', u'you', u'the', u'night', u'dance', u'Song', u'me',
+        u'a', u'remix', u'live', u'(edit)', u'']
+
+    def strings(self, rand, number):
+        strings = []
+        for index in range(number):
+            text = u' '.join(rand.choice(self.words)
+                for z in range(rand.randint(0, 4)))
+            if text and rand.random() < 0.4:
+                i = rand.randrange(len(text))
+                text = text[:i] + rand.choice(u'abcxyz ') + text[i + 1:]
+            strings.append((index, text))
+        return strings
+
+    def test_same_as_brute_force(self):
+        rand = random.Random(1)
+        for trial in range(20):
+            strings = self.strings(rand, rand.randint(0, 120))
+            for threshold in [0.3, 0.5, 0.7, 0.85, 1.0]:
+                self.assertEqual(
+                    dupefuncs._ratio_dupes(strings, _ratio, threshold),
+                    dupefuncs._brute_dupes(strings, _ratio, threshold),
+                    (trial, threshold))
+
+    def test_finddupes(self):
+        strings = self.strings(random.Random(2), dupefuncs.MIN_INDEXED * 2)
+        for func in [_ratio, exact]:
+            self.assertEqual(dupefuncs.finddupes(strings, func, 0.8),
+                dupefuncs._brute_dupes(strings, func, 0.8))
+
+class HungarianTest(unittest.TestCase):
+    def weights(self, rand, rows, columns):
+        weights = {}
+        for row in rows:
+            weights[row] = dict((column, rand.choice([0.7, 0.8, 0.9, 1.0]))
+                for column in columns if rand.random() < 0.5)
+        return weights
+
+    def best_total(self, weights, rows, columns):
+        return max(sum(weights[row].get(column, 0) for row, column
+            in zip(rows, chosen))
+            for chosen in itertools.permutations(columns, len(rows)))
+
+    def test_maximum_weight(self):
+        rand = random.Random(3)
+        for trial in range(200):
+            rows = range(rand.randint(1, 5))
+            columns = range(10, 10 + rand.randint(len(rows), 6))
+            weights = self.weights(rand, rows, columns)
+            pairs = masstag._hungarian(weights, rows, columns)
+
+            self.assertEqual(len(set(r for r, c in pairs)), len(pairs))
+            self.assertEqual(len(set(c for r, c in pairs)), len(pairs))
+            for row, column in pairs:
+                self.assertTrue(column in weights[row])
+            total = sum(weights[row][column] for row, column in pairs)
+            self.assertAlmostEqual(total,
+                self.best_total(weights, rows, columns))
+
+    def test_assign_matches(self):
+        rand = random.Random(4)
+        for trial in range(100):
+            files = range(rand.randint(1, 6))
+            tracks = range(rand.randint(1, 6))
+            matched = self.weights(rand, files, tracks)
+            assigned = masstag.assign_matches(matched)
+
+            self.assertEqual(len(set(assigned.values())), len(assigned))
+            total = sum(matched[f][t] for t, f in assigned.iteritems())
+            if len(files) <= len(tracks):
+                best = self.best_total(matched, files, tracks)
+            else:
+                by_track = dict((t, dict((f, matched[f][t]) for f in files
+                    if t in matched[f])) for t in tracks)
+                best = self.best_total(by_track, tracks, files)
+            self.assertAlmostEqual(total, best)
+
+class FakeClock(object):
+    """Replaces the time module in ratelimit."""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time, ratelimit.time = ratelimit.time, self.clock
+
+    def tearDown(self):
+        ratelimit.time = self._time
+
+    def test_burst(self):
+        bucket = ratelimit.TokenBucket(2.0, 3)
+        self.assertEqual([bucket.acquire() for z in range(3)], [0.0] * 3)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        self.assertEqual(self.clock.slept, [0.5])
+
+    def test_waiters_reserve_tokens(self):
+        #Callers that haven't finished sleeping still hold their token.
+        bucket = ratelimit.TokenBucket(1.0)
+        delays = [bucket.acquire() for z in range(4)]
+        for delay, expected in zip(delays, [0.0, 1.0, 2.0, 3.0]):
+            self.assertAlmostEqual(delay, expected)
+
+    def test_refill(self):
+        bucket = ratelimit.TokenBucket(1.0, 2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.now += 1.5
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        #Never more than burst tokens, however long it's idle.
+        self.clock.now += 100
+        self.assertEqual([bucket.acquire() for z in range(2)], [0.0] * 2)
+        self.assertAlmostEqual(bucket.acquire(), 1.0)
+
+    def test_stats(self):
+        bucket = ratelimit.TokenBucket(4.0)
+        for z in range(3):
+            bucket.acquire()
+        stats = bucket.stats()
+        self.assertEqual((stats['requests'], stats['throttled']), (3, 2))
+        self.assertAlmostEqual(stats['wait'], 0.75)
+        self.assertAlmostEqual(stats['max_wait'], 0.5)
+
+def flac_data():
+    """Returns a minimal FLAC file without any metadata but STREAMINFO."""
+    rate = 44100
+    info = (rate << 44) | (1 << 41) | (15 << 36) | rate * 10
+    streaminfo = struct.pack('>HH', 4096, 4096) + '\0' * 6 + \
+        struct.pack('>Q', info) + '\0' * 16
+    return 'fLaC\x80' + struct.pack('>I', len(streaminfo))[1:] + \
+        streaminfo + '\xff\xf8' + '\0' * 100
+
+class PaddingTest(TempDirTest):
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self._padding = util.padding_policy, util.padding_size
+
+    def tearDown(self):
+        util.set_padding(*self._padding)
+        TempDirTest.tearDown(self)
+
+    def test_default(self):
+        util.set_padding(util.PADDING_DEFAULT)
+        self.assertEqual(util.new_padding(100, 10 ** 6, lambda: 5), 5)
+        self.assertEqual(util.new_padding(-1, 10 ** 6, lambda: 5), 5)
+
+    def test_keep(self):
+        util.set_padding(util.PADDING_KEEP, 4096)
+        default = lambda: self.fail('default padding used')
+        #Existing padding's never trimmed.
+        self.assertEqual(util.new_padding(0, 10 ** 6, default), 0)
+        self.assertEqual(util.new_padding(10 ** 5, 10 ** 6, default), 10 ** 5)
+        #Tags that don't fit get padding_size or 0.1% of the data.
+        self.assertEqual(util.new_padding(-1, 10 ** 6, default), 4096)
+        self.assertEqual(util.new_padding(-1, 10 ** 8, default),
+            1024 + 10 ** 5)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, util.set_padding, 'trim')
+
+    def test_saved_in_place(self):
+        if not util.MUTAGEN_PADDING:
+            return
+        util.set_padding(util.PADDING_KEEP, 4096)
+        filename = self.write_file('a.flac', flac_data())
+        tag = audioinfo.Tag(filename)
+        tag['title'] = [u'Title']
+        tag.save()
+
+        stats = util.save_stats()
+        tag = audioinfo.Tag(filename)
+        tag['title'] = [u'A longer title']
+        tag.save()
+        self.assertEqual(util.save_stats()['in_place'],
+            stats['in_place'] + 1)
+        self.assertEqual(audioinfo.Tag(filename)['title'],
+            [u'A longer title'])
+
+class TemporaryImagesTest(unittest.TestCase):
+    def test_images_removed(self):
+        tag = {}
+        image = {audioinfo.DATA: PNG, audioinfo.MIMETYPE: u'image/png'}
+        def add():
+            tag['cover'] = PNG
+            return [image]
+        remove = lambda: tag.pop('cover')
+        loader = lambda: [image]
+
+        with util.TemporaryImages(add, remove, loader) as saved:
+            self.assertEqual(tag, {'cover': PNG})
+        self.assertEqual(tag, {})
+        self.assertFalse(saved.images.loaded)
+        self.assertEqual(saved.images[0][audioinfo.DATA], PNG)
+
+        saved = util.TemporaryImages(add, remove, loader)
+        def fail():
+            with saved:
+                raise IOError
+        self.assertRaises(IOError, fail)
+        self.assertEqual((tag, saved.images), ({}, []))
+
+class UndoJournalTest(unittest.TestCase):
+    def test_round_trip(self):
+        journal = UndoJournal()
+        audios = [object() for z in range(3)]
+        image = {'data': PNG, 'description': u'Cover'}
+        undos = [{'artist': [u'Artist'], 'title': [u'Title %d' % i],
+            '__image': [image]} for i in range(3)]
+        for audio, undo in zip(audios, undos):
+            journal.add(0, audio, undo)
+        journal.add(1, audios[0], {'artist': []})
+
+        self.assertTrue(0 in journal and 1 in journal)
+        self.assertEqual(len(journal), 2)
+        self.assertEqual(journal.pop(1), [(audios[0], {'artist': []})])
+        self.assertEqual(journal.pop(0), zip(audios, undos))
+        self.assertFalse(0 in journal)
+        self.assertRaises(KeyError, journal.pop, 0)
+        self.assertEqual(journal.size, 0)
+
+    def test_replace(self):
+        journal = UndoJournal()
+        audio = object()
+        journal.add(0, audio, {'artist': [u'First']})
+        journal.add(0, audio, {'artist': [u'Second']})
+        self.assertEqual(journal.pop(0), [(audio, {'artist': [u'Second']})])
+
+    def test_values_shared(self):
+        journal = UndoJournal()
+        journal.add(0, object(), {'album': [u'Album'], '__image': [
+            {'data': PNG}]})
+        size = journal.size
+        for z in range(100):
+            journal.add(0, object(), {'album': [u'Album'], '__image': [
+                {'data': PNG}]})
+        self.assertEqual(journal.size, size)
+
+    def test_spill(self):
+        journal = UndoJournal(limit=len(PNG) * 2)
+        added = []
+        for level in range(5):
+            audio = object()
+            undo = {'title': [u'Title %d' % level],
+                '__image': [{'data': PNG + str(level)}]}
+            journal.add(level, audio, undo)
+            added.append((audio, undo))
+        self.assertTrue(journal.size <= journal.limit)
+        self.assertTrue(journal._spilled)
+        self.assertEqual(len(journal), 5)
+
+        for level in reversed(range(5)):
+            self.assertEqual(journal.pop(level), [added[level]])
+        self.assertEqual(journal.size, 0)
+        self.assertEqual(journal._file, None)
+
+    def test_add_to_spilled(self):
+        journal = UndoJournal(limit=len(PNG))
+        first, second = object(), object()
+        journal.add(0, first, {'__image': [{'data': PNG + 'a'}]})
+        journal.add(1, object(), {'__image': [{'data': PNG + 'b'}]})
+        self.assertTrue(0 in journal._spilled)
+        journal.add(0, second, {'artist': [u'Artist']})
+        self.assertEqual(journal.pop(0), [
+            (first, {'__image': [{'data': PNG + 'a'}]}),
+            (second, {'artist': [u'Artist']})])
+
+class ConfigFileTest(TempDirTest):
+    def write_json(self, data):
+        return self.write_file('config', json.dumps(data))
+
+    def read_json(self):
+        return json.loads(open(self.path('config')).read())
+
+    def test_shared(self):
+        filename = self.write_json({'general': {'a': 1}})
+        first, second = PuddleConfig(filename), PuddleConfig(filename)
+        with first.transaction():
+            first.set('general', 'a', 2)
+            self.assertEqual(second.get('general', 'a', 0), 2)
+            self.assertEqual(self.read_json(), {'general': {'a': 1}})
+        self.assertEqual(self.read_json(), {'general': {'a': 2}})
+
+    def test_merge(self):
+        filename = self.write_json({'general': {'a': 1, 'b': 1}})
+        config = PuddleConfig(filename)
+        with config.transaction():
+            config.set('general', 'a', 2)
+            config.set('new', 'key', [u'value'])
+            #Written by something else before the changes are.
+            self.write_json({'general': {'a': 1, 'b': 3, 'c': 4},
+                'other': {'x': u'padding'}})
+        self.assertEqual(self.read_json(), {
+            'general': {'a': 2, 'b': 3, 'c': 4},
+            'new': {'key': [u'value']},
+            'other': {'x': u'padding'}})
+
+    def test_external_change_read(self):
+        filename = self.write_json({'general': {'a': 1}})
+        self.assertEqual(PuddleConfig(filename).get('general', 'a', 0), 1)
+        self.write_json({'general': {'a': 10}})
+        self.assertEqual(PuddleConfig(filename).get('general', 'a', 0), 10)
+
+    def test_removed_not_recreated(self):
+        filename = self.write_json({'general': {'a': 1}})
+        config = PuddleConfig(filename)
+        with config.transaction():
+            config.set('general', 'a', 2)
+            os.remove(filename)
+        self.assertFalse(os.path.exists(filename))
+
+class FakeAudio(dict):
+    """Has the attributes of an audioinfo tag used by SelectionStats."""
+    IMAGETAGS = ()
+
+    def __init__(self, tags, size=100, length=u'1:00', images=None):
+        dict.__init__(self, tags)
+        self.size = size
+        self.length = length
+        self.images = images or []
+        if images is not None:
+            self.IMAGETAGS = (audioinfo.MIMETYPE, audioinfo.DATA)
+
+    usertags = property(lambda self: dict((key, value) for key, value
+        in self.iteritems() if not key.startswith('__')))
+
+class SelectionStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.audios = [
+            FakeAudio({'artist': [u'A'], 'album': [u'X'],
+                '__filename': u'1.mp3'}, 100, u'1:00'),
+            FakeAudio({'artist': [u'A'], 'genre': [u'Pop', u'Rock'],
+                '__filename': u'2.mp3'}, 200, u'2:30'),
+            FakeAudio({'artist': [u'B'], '__filename': u'3.mp3'},
+                300, u'1:00:00'),
+            ]
+        self.stats = SelectionStats()
+
+    def test_totals(self):
+        stats = self.stats
+        stats.setFiles(self.audios)
+        self.assertEqual((len(stats), stats.size, stats.length),
+            (3, 600, 60 + 150 + 3600))
+        self.assertTrue(stats.first is self.audios[0])
+        self.assertEqual(stats.values('artist'), {u'A': 2, u'B': 1})
+        self.assertEqual(stats.values('album'), {u'X': 1, u'': 2})
+        self.assertEqual(stats.values('genre'),
+            {u'Pop' + SEPARATOR + u'Rock': 1, u'': 2})
+        self.assertEqual(stats.values('__filename'),
+            {u'1.mp3': 1, u'2.mp3': 1, u'3.mp3': 1})
+        self.assertEqual(stats.values('missing'), {u'': 3})
+
+    def test_add_remove(self):
+        stats = self.stats
+        stats.setFiles(self.audios)
+        stats.setFiles(self.audios[1:])
+        self.assertEqual((len(stats), stats.size), (2, 500))
+        self.assertEqual(stats.values('artist'), {u'A': 1, u'B': 1})
+        self.assertEqual(stats.values('album'), {u'': 2})
+        self.assertTrue(stats.first is self.audios[1])
+
+        stats.setFiles(self.audios[:1])
+        self.assertEqual(stats.values('artist'), {u'A': 1})
+        stats.setFiles([])
+        self.assertFalse(stats)
+        self.assertEqual((stats.size, stats.length, stats.first),
+            (0, 0, None))
+        self.assertEqual(stats.values('artist'), {})
+
+    def test_invalidate(self):
+        stats = self.stats
+        stats.setFiles(self.audios)
+        audio = self.audios[2]
+        audio['artist'] = [u'A']
+        audio['album'] = [u'Y']
+        self.assertEqual(stats.values('artist'), {u'A': 2, u'B': 1})
+
+        stats.invalidate([audio, FakeAudio({})])
+        self.assertEqual(stats.values('artist'), {u'A': 3})
+        self.assertEqual(stats.values('album'), {u'X': 1, u'Y': 1, u'': 1})
+
+        audio.size = 1000
+        stats.invalidate()
+        self.assertEqual(stats.size, 1300)
+
+    def test_images(self):
+        stats = self.stats
+        stats.setFiles(self.audios)
+        self.assertEqual(stats.images(), None)
+        self.assertEqual(stats.imagetags(), set())
+
+        image = {audioinfo.DATA: PNG, audioinfo.MIMETYPE: u'image/png'}
+        with_images = [FakeAudio({}, images=[dict(image)]) for z in range(2)]
+        stats.setFiles(with_images)
+        self.assertEqual(stats.images(), [image])
+        self.assertEqual(stats.imagetags(),
+            set([audioinfo.MIMETYPE, audioinfo.DATA]))
+
+        with_images[1].images = [{audioinfo.DATA: PNG + 'x'}]
+        self.assertEqual(stats.images(), [image])
+        stats.invalidate(with_images[1:])
+        self.assertEqual(stats.images(), 0)
+
+class TestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /etag, /modified and /nostore. /drop closes the connection
+    without responding."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.seen.append((self.command, self.path))
+        if self.path == '/drop':
+            self.close_connection = 1
+            return
+        headers = {}
+        if self.path == '/etag':
+            headers['ETag'] = '"v1"'
+            fresh = self.headers.get('If-None-Match') == '"v1"'
+        elif self.path == '/modified':
+            headers['Last-Modified'] = 'Sat, 01 Jan 2000 00:00:00 GMT'
+            fresh = self.headers.get('If-Modified-Since') == \
+                headers['Last-Modified']
+        else:
+            fresh = False
+            if self.path == '/nostore':
+                headers['Cache-Control'] = 'no-store'
+        if fresh:
+            self.send_response(304)
+            body = ''
+        else:
+            self.send_response(200)
+            body = '%s %d' % (self.path, len(self.server.seen))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.do_GET()
+
+class TestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class WebClientTest(TempDirTest):
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.settings = (webclient.cache_dir, webclient.cache_ttl,
+            webclient.cache_size)
+        webclient.set_cache(self.path('cache'), 60, 100)
+        self.server = TestServer(('127.0.0.1', 0), TestHandler)
+        self.server.seen = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        webclient.close_connections()
+        self.server.shutdown()
+        self.server.server_close()
+        webclient.set_cache(*self.settings)
+        TempDirTest.tearDown(self)
+
+    def expire(self, url):
+        entry = webclient._load_entry(url)
+        entry['time'] -= 3600
+        webclient._write_entry(url, entry)
+
+    def test_ttl_hit(self):
+        url = self.url + '/page'
+        response = webclient.request(url)
+        self.assertEqual((response.code, response.data), (200, '/page 1'))
+        self.assertFalse(response.cached)
+
+        hits = webclient.stats()['hits']
+        response = webclient.request(url)
+        self.assertEqual(response.data, '/page 1')
+        self.assertTrue(response.cached)
+        self.assertEqual(webclient.stats()['hits'], hits + 1)
+        self.assertEqual(len(self.server.seen), 1)
+
+        self.assertEqual(webclient.request(url, cache=False).data, '/page 2')
+
+    def test_revalidate(self):
+        for path in ('/etag', '/modified'):
+            url = self.url + path
+            data = webclient.request(url).data
+            self.expire(url)
+            revalidated = webclient.stats()['revalidated']
+            response = webclient.request(url)
+            self.assertEqual((response.code, response.data), (200, data))
+            self.assertTrue(response.cached)
+            self.assertEqual(webclient.stats()['revalidated'],
+                revalidated + 1)
+            #The revalidated entry is fresh again.
+            self.assertTrue(webclient.request(url).cached)
+        self.assertEqual(len(self.server.seen), 4)
+
+    def test_no_store(self):
+        url = self.url + '/nostore'
+        self.assertEqual(webclient.request(url).data, '/nostore 1')
+        self.assertEqual(webclient.request(url).data, '/nostore 2')
+        self.assertEqual(webclient._load_entry(url), None)
+
+    def test_prune(self):
+        urls = [self.url + '/%d' % i for i in range(3)]
+        for i, url in enumerate(urls):
+            response = webclient.Response(200, 'OK', {}, 'x' * 1000, url)
+            webclient._store_entry(url, response)
+            filename = webclient._cache_filename(url)
+            os.utime(filename, (1000 + i, 1000 + i))
+        size = os.path.getsize(webclient._cache_filename(urls[0]))
+
+        webclient.prune_cache((size * 2.5) / (1024 * 1024))
+        self.assertEqual([webclient._load_entry(url) is not None
+            for url in urls], [False, True, True])
+        webclient.prune_cache(0)
+        self.assertEqual(os.listdir(self.path('cache')), [])
+
+    def test_post_not_resent(self):
+        #Opens a connection that's kept for the next request.
+        webclient.request(self.url + '/page')
+        self.assertRaises(webclient.RequestError, webclient.request,
+            self.url + '/drop', 'a=b')
+        self.assertEqual(self.server.seen[1:], [('POST', '/drop')])
+
+        #GET requests are retried on a new connection.
+        webclient.request(self.url + '/page', cache=False)
+        del(self.server.seen[:])
+        self.assertRaises(webclient.RequestError, webclient.request,
+            self.url + '/drop', cache=False)
+        self.assertEqual(self.server.seen, [('GET', '/drop')] * 2)
+
+if __name__ == '__main__':
+    unittest.main()
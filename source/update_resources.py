@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Creates puddlestuff/puddletag.rcc, the binary version of the resources
+in puddlestuff/resource.py (see puddlestuff/resources.py).
+
+The data in resource.py (generated by pyrcc4) is copied as is. It
+includes files that aren't listed in resourec.qrc (eg. translations),
+so compiling resourec.qrc with Qt's rcc is only done if asked for."""
+import ast, os, struct, sys
+from subprocess import call
+
+usage = '''Usage: python update_resources.py [-h] [--qrc]
+
+Options:
+    --qrc Compile resourec.qrc using rcc instead of converting resource.py.
+    -h Show this message.'''
+
+DIRNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'puddlestuff')
+QRC = os.path.join(DIRNAME, 'resourec.qrc')
+MODULE = os.path.join(DIRNAME, 'resource.py')
+RCC = os.path.join(DIRNAME, 'puddletag.rcc')
+
+#Names of the variables in resource.py.
+BLOBS = ('qt_resource_struct', 'qt_resource_name', 'qt_resource_data')
+
+def read_module(filename):
+    """Returns the (tree, names, data) strings defined in the pyrcc4
+    module, filename."""
+    values = {}
+    for node in ast.parse(open(filename, 'rb').read()).body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            name = getattr(node.targets[0], 'id', None)
+            if name in BLOBS:
+                values[name] = ast.literal_eval(node.value)
+    return tuple(values[z] for z in BLOBS)
+
+def rcc_data(tree, names, data):
+    """Returns the contents of a binary resource file (format version 1).
+
+    The header is 'qres' followed by the format version and the offsets
+    of the tree, data and names (all big-endian 32 bit integers)."""
+    header_size = 4 + 4 * 4
+    data_offset = header_size
+    names_offset = data_offset + len(data)
+    tree_offset = names_offset + len(names)
+    header = 'qres' + struct.pack('>IIII', 1, tree_offset, data_offset,
+        names_offset)
+    return header + data + names + tree
+
+def from_module(module=MODULE, rcc=RCC):
+    fo = open(rcc, 'wb')
+    fo.write(rcc_data(*read_module(module)))
+    fo.close()
+
+def from_qrc(qrc=QRC, rcc=RCC):
+    """Compiles qrc using rcc. Returns False if rcc couldn't be run."""
+    try:
+        return call(['rcc', '-binary', qrc, '-o', rcc]) == 0
+    except OSError:
+        return False
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '-h' in args:
+        print usage
+        sys.exit(0)
+
+    if '--qrc' in args:
+        if not from_qrc():
+            print 'Could not run rcc.'
+            sys.exit(1)
+    else:
+        from_module()
+    print 'Created %s' % RCC